@@ -0,0 +1,8 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Benchmarks for recording and querying notebook history
+
+Run `python -m benchmarks --help` from the top level of the repository.
+"""
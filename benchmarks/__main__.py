@@ -0,0 +1,254 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Grow a history database by replaying synthetic actions, and time how queries
+slow down as it grows
+
+    python -m benchmarks --sizes 1000 10000 100000 --save baseline.json
+    python -m benchmarks --sizes 1000 10000 100000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from janus.janus_sqlite import DbManager
+from benchmarks.notebooks import generate_notebook
+from benchmarks.replay import action_stream, replay
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# actions replayed at a time while growing the database to the next size
+REPLAY_BATCH = 500
+
+def percentiles(samples):
+    """
+    Return dict of the 50th, 90th and 99th percentile of samples in milliseconds
+
+    samples: (list) times in seconds
+    """
+
+    ordered = sorted(samples)
+    if len(ordered) == 0:
+        return {}
+    return {p: round(ordered[min(len(ordered) - 1, len(ordered) * int(p[1:]) // 100)]
+                        * 1000, 3) for p in ('p50', 'p90', 'p99')}
+
+
+def time_query(fn, args_list):
+    """
+    Return percentiles of the time taken to call fn with each set of args
+
+    fn: (func) query to time
+    args_list: (list) of tuples of arguments to call fn with
+    """
+
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def db_size(db_path):
+    """
+    Return bytes used by a database, including its write ahead log
+
+    db_path: (str) path to the database
+    """
+
+    return sum(os.path.getsize(p) for p in (db_path, db_path + '-wal')
+                if os.path.exists(p))
+
+
+def count_versions(db):
+    """
+    Return number of cell versions recorded in a database
+
+    db: (obj) DbManager of the database
+    """
+
+    db.flush()
+    return db.execute_search('SELECT COUNT(*) FROM cells')[0][0]
+
+
+def measure_queries(db, rng, nb_name, nb_paths, samples):
+    """
+    Return percentiles of the time taken by the queries the client makes
+    when showing notebook and cell history
+
+    db: (obj) DbManager of the database
+    rng: (obj) random.Random choosing cells and versions to look up
+    nb_name: (str) hashed path to the notebook to query
+    nb_paths: (list) of [hashed_path, start_time, end_time] for the notebook
+    samples: (int) times to run each query
+    """
+
+    configs = db.get_nb_configs(nb_paths)
+    cell_ids = configs[-1][2]
+    version_ids = list(set(v for c in configs[-samples:] for v in c[3]))
+
+    # look up versions in pages, as the client prefetches them
+    pages = [tuple(rng.sample(version_ids, min(len(version_ids), 20)))
+                for i in range(samples)]
+
+    db.version_cache.clear()
+    return {
+        'get_nb_configs': time_query(db.get_nb_configs,
+                                        [(nb_paths,)] * samples),
+        'get_nb_config_page': time_query(db.get_nb_config_page,
+                                        [(nb_paths, None, 200)] * samples),
+        'get_cell_history': time_query(db.get_cell_history,
+                        [(nb_paths, rng.choice(cell_ids)) for i in range(samples)]),
+        'get_versions': time_query(lambda ids: (db.version_cache.clear(),
+                            db.get_versions(list(ids), nb_paths)),
+                            [(p,) for p in pages]),
+        'search': time_query(db.search, [('word%d' % rng.randint(0, 1000),
+                            nb_paths) for i in range(samples)]),
+        'get_snapshot': time_query(lambda i: (db.version_cache.clear(),
+                            db.get_snapshot(nb_paths, index=i)),
+                            [(rng.randrange(len(configs)),) for i in range(samples)])
+    }
+
+
+def run_benchmarks(sizes, num_notebooks = 4, num_cells = 30, samples = 20,
+                    seed = 0, directory = None, baseline = None, **cell_settings):
+    """
+    Return list of results of growing a database to each size of cell history,
+    with the time taken to record actions and query history at each size
+
+    sizes: (list) numbers of cell versions to measure at, in increasing order
+    num_notebooks: (int) notebooks to spread actions across
+    num_cells: (int) cells each notebook starts with
+    samples: (int) times to run each query at each size
+    seed: (int) seed for the random notebooks and actions
+    directory: (str) where to create the database, a temporary directory if None
+    baseline: (list) results of an earlier run to compare to as we go
+    cell_settings: (dict) settings passed to generate_cell
+    """
+
+    rng = random.Random(seed)
+    tmp_dir = directory or tempfile.mkdtemp(prefix='janus-bench-')
+    db_path = os.path.join(tmp_dir, 'janus_bench.db')
+    db = DbManager(db_path)
+
+    start_time = 1500000000000
+    notebooks = []
+    for i in range(num_notebooks):
+        nb = generate_notebook(rng, num_cells, **cell_settings)
+        stream = action_stream(rng, nb, sys.maxsize, start_time, **cell_settings)
+        notebooks.append(('bench_nb_%d' % i, stream))
+
+    baseline_sizes = {r['size']: r for r in baseline or []}
+    results = []
+    try:
+        num_versions = 0
+        for size in sizes:
+
+            # record actions until the history reaches the next size
+            latencies = []
+            seconds = 0
+            start_versions = num_versions
+            while num_versions < size:
+                for nb_name, stream in notebooks:
+                    batch = [next(stream) for i in range(REPLAY_BATCH // num_notebooks)]
+                    replayed = replay(db, batch, nb_name)
+                    latencies.extend(replayed['latencies'])
+                    seconds += replayed['seconds']
+                added = count_versions(db) - num_versions
+                num_versions += added
+
+            nb_name = notebooks[0][0]
+            nb_paths = [[nb_name, 0, sys.maxsize]]
+            result = {
+                'size': size,
+                'versions': num_versions,
+                'db_bytes': db_size(db_path),
+                'record_action': percentiles(latencies),
+                'actions_per_second': round(len(latencies) / seconds, 1),
+                'versions_per_second': round((num_versions - start_versions)
+                                                / seconds, 1),
+                'queries': measure_queries(db, rng, nb_name, nb_paths, samples)
+            }
+            results.append(result)
+            print_result(result, baseline_sizes.get(size))
+    finally:
+        db.close()
+        if directory is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+def print_result(result, baseline = None):
+    """
+    Print results at one size, and how much slower they are than a baseline
+
+    result: (dict) results at one size, see run_benchmarks
+    baseline: (dict) results at the same size from an earlier run
+    """
+
+    print('%d versions, %.1f MB, %.1f actions/s, %.1f versions/s' % (
+            result['versions'], result['db_bytes'] / 1e6,
+            result['actions_per_second'], result['versions_per_second']))
+    timings = [('record_action', result['record_action'])]
+    timings += sorted(result['queries'].items())
+    for name, timing in timings:
+        line = '  %-20s' % name + '  '.join('%s %8.2fms' % (p, timing[p])
+                                            for p in sorted(timing))
+        if baseline is not None:
+            old = baseline['queries'].get(name) or baseline.get(name)
+            if old and old.get('p50'):
+                line += '  (p50 x%.2f)' % (timing['p50'] / old['p50'])
+        print(line)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                description='Time Janus history queries as the history grows')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                help='numbers of cell versions to measure at, up to 1000000')
+    parser.add_argument('--notebooks', type=int, default=4,
+                help='notebooks to spread actions across')
+    parser.add_argument('--cells', type=int, default=30,
+                help='cells in each notebook')
+    parser.add_argument('--source-lines', type=int, default=10,
+                help='lines of source in each code cell')
+    parser.add_argument('--output-bytes', type=int, default=1000,
+                help='approximate size of each code cell output')
+    parser.add_argument('--image-fraction', type=float, default=0.1,
+                help='chance a code cell output is an image')
+    parser.add_argument('--samples', type=int, default=20,
+                help='times to run each query at each size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory',
+                help='where to keep the database, a temporary directory if unset')
+    parser.add_argument('--save', help='file to save results to as a baseline')
+    parser.add_argument('--compare', help='baseline file to compare results to')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run_benchmarks(sorted(args.sizes), num_notebooks=args.notebooks,
+                samples=args.samples, seed=args.seed, directory=args.directory,
+                baseline=baseline,
+                num_cells=args.cells, source_lines=args.source_lines,
+                output_bytes=args.output_bytes, image_fraction=args.image_fraction)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
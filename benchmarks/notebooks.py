@@ -0,0 +1,122 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Generate synthetic notebooks and edits to them
+"""
+
+import base64
+import copy
+import uuid
+
+def new_cell_id(rng):
+    """
+    Return random cell identifier like those the client creates
+
+    rng: (obj) random.Random generating the notebook
+    """
+
+    return uuid.UUID(int=rng.getrandbits(128)).hex[0:8]
+
+
+def generate_source(rng, num_lines):
+    """
+    Return source of a code cell with a number of lines
+
+    rng: (obj) random.Random generating the notebook
+    num_lines: (int) lines of source
+    """
+
+    lines = []
+    for i in range(num_lines):
+        name = 'x%d' % rng.randint(0, 100)
+        lines.append('%s = %s * %d' % (name, name, rng.randint(0, 10000)))
+    return '\n'.join(lines)
+
+
+def generate_outputs(rng, output_bytes, image_fraction):
+    """
+    Return outputs of a code cell, either a stream of text or a png image
+
+    rng: (obj) random.Random generating the notebook
+    output_bytes: (int) approximate size of the outputs
+    image_fraction: (float) chance the output is an image
+    """
+
+    if output_bytes == 0:
+        return []
+
+    if rng.random() < image_fraction:
+        data = bytes(rng.getrandbits(8) for i in range(output_bytes * 3 // 4))
+        return [{
+            'output_type': 'display_data',
+            'data': {
+                'image/png': base64.b64encode(data).decode(),
+                'text/plain': '<matplotlib.figure.Figure>'
+            },
+            'metadata': {}
+        }]
+
+    text = ''.join(rng.choice('abcdefghij \n') for i in range(output_bytes))
+    return [{'output_type': 'stream', 'name': 'stdout', 'text': text}]
+
+
+def generate_cell(rng, source_lines = 10, output_bytes = 1000,
+                    image_fraction = 0.1, markdown_fraction = 0.2):
+    """
+    Return JSON representation of a cell, as the client sends it
+
+    rng: (obj) random.Random generating the notebook
+    source_lines: (int) lines of source in code cells
+    output_bytes: (int) approximate size of code cell outputs
+    image_fraction: (float) chance a code cell's output is an image
+    markdown_fraction: (float) chance the cell is markdown rather than code
+    """
+
+    metadata = {'janus': {'id': new_cell_id(rng), 'cell_hidden': False,
+                'source_hidden': False, 'output_hidden': False,
+                'versions': [], 'named_versions': []}}
+
+    if rng.random() < markdown_fraction:
+        words = ['word%d' % rng.randint(0, 1000) for i in range(source_lines * 8)]
+        return {'cell_type': 'markdown', 'source': ' '.join(words),
+                'metadata': metadata}
+
+    return {'cell_type': 'code',
+            'source': generate_source(rng, source_lines),
+            'outputs': generate_outputs(rng, output_bytes, image_fraction),
+            'execution_count': rng.randint(1, 100),
+            'metadata': metadata}
+
+
+def generate_notebook(rng, num_cells = 30, **cell_settings):
+    """
+    Return notebook with cells like those the client sends
+
+    rng: (obj) random.Random generating the notebook
+    num_cells: (int) cells in the notebook
+    cell_settings: (dict) settings passed to generate_cell
+    """
+
+    return {'cells': [generate_cell(rng, **cell_settings) for i in range(num_cells)]}
+
+
+def edit_cell(rng, cell, output_bytes = 1000, image_fraction = 0.1):
+    """
+    Return copy of a cell with a line of source changed and, for code cells,
+    new outputs as if the cell were run again
+
+    rng: (obj) random.Random generating the notebook
+    cell: (obj) JSON representation of the cell
+    output_bytes: (int) approximate size of code cell outputs
+    image_fraction: (float) chance a code cell's output is an image
+    """
+
+    cell = copy.deepcopy(cell)
+    lines = cell['source'].split('\n')
+    lines[rng.randrange(len(lines))] = generate_source(rng, 1)
+    cell['source'] = '\n'.join(lines)
+    if cell['cell_type'] == 'code':
+        cell['outputs'] = generate_outputs(rng, output_bytes, image_fraction)
+        cell['execution_count'] += 1
+    return cell
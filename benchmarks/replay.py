@@ -0,0 +1,87 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Replay streams of notebook actions against a DbManager
+"""
+
+import copy
+import time
+
+from benchmarks.notebooks import generate_cell, edit_cell
+
+# relative frequency of each kind of action, roughly as users produce them
+ACTION_WEIGHTS = [
+    ('execute-cell', 6),
+    ('select-cell', 3),
+    ('create-cell', 1),
+    ('delete-cell', 1)
+]
+
+def action_stream(rng, nb, num_actions, start_time = None, **cell_settings):
+    """
+    Yield actions like those the client posts as a user works in a notebook,
+    each with the full notebook as it is after the action
+
+    rng: (obj) random.Random generating the actions
+    nb: (dict) notebook to start from, see notebooks.generate_notebook
+    num_actions: (int) number of actions to yield
+    start_time: (int) time of the first action in milliseconds
+    cell_settings: (dict) settings passed to generate_cell for new cells
+    """
+
+    cells = copy.deepcopy(nb['cells'])
+    t = start_time if start_time is not None else int(time.time() * 1000)
+    names = [n for n, w in ACTION_WEIGHTS for i in range(w)]
+    output_settings = {k: cell_settings[k] for k in ('output_bytes', 'image_fraction')
+                        if k in cell_settings}
+
+    for i in range(num_actions):
+        name = rng.choice(names)
+        index = rng.randrange(len(cells))
+
+        if name == 'execute-cell':
+            cells[index] = edit_cell(rng, cells[index], **output_settings)
+        elif name == 'create-cell':
+            index += 1
+            cells.insert(index, generate_cell(rng, **cell_settings))
+        elif name == 'delete-cell' and len(cells) > 1:
+            del cells[index]
+            index = min(index, len(cells) - 1)
+
+        # users pause between actions for a few seconds
+        t += rng.randint(1000, 10000)
+        yield {
+            'time': t,
+            'name': name,
+            'index': index,
+            'indices': [index],
+            'model': {'cells': list(cells)}
+        }
+
+
+def replay(db, stream, nb_name):
+    """
+    Record each action of a stream, then wait for all of them to be committed.
+    Return dict of the latency of each action in seconds, the total time taken,
+    and the number of actions recorded per second
+
+    db: (obj) DbManager to record actions with
+    stream: (iterable) actions, see action_stream
+    nb_name: (str) hashed path to the notebook the actions are from
+    """
+
+    latencies = []
+    start = time.perf_counter()
+    for action in stream:
+        action_start = time.perf_counter()
+        db.record_action(action, nb_name)
+        latencies.append(time.perf_counter() - action_start)
+    db.flush()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'latencies': latencies,
+        'seconds': elapsed,
+        'actions_per_second': len(latencies) / elapsed if elapsed else None
+    }
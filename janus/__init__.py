@@ -6,14 +6,38 @@ Implements main handler for saving and retrieving notebook history
 """
 
 import os
-import ast
 import json
+import gzip
+import threading
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen, web
+from tornado.ioloop import PeriodicCallback
+from tornado.concurrent import run_on_executor
 
 from notebook.utils import url_path_join
 from notebook.base.handlers import IPythonHandler, path_regex
 
-from .janus_sqlite import DbManager
-from .janus_dir import find_storage_dir, create_dir, hash_path
+from .janus_sqlite import get_db_manager
+from .janus_shards import get_sharded_db_manager
+from .janus_dir import find_storage_dir, create_dir, hash_path, get_janus_config
+from .janus_retention import get_retention_policy
+from .janus_metrics import REGISTRY, QUERY_SECONDS, POST_SECONDS, profile
+from .janus_snapshots import notebook_header, stream_envelope, STREAM_BATCH
+
+# compress JSON responses at least this large for clients that accept gzip
+COMPRESS_MIN_BYTES = 1024
+
+# kinds of GET and POST requests we keep metrics for, anything else is "other"
+QUERY_TYPES = ('config', 'config_page', 'versions', 'cell_history',
+                'version_summary', 'version_diff', 'export_status',
+                'retention_report', 'search', 'snapshot', 'comment')
+POST_TYPES = ('action', 'action_batch', 'log', 'comment', 'export_db', 'cancel_export')
+
+# storage directory and Janus config, resolved once for the server process
+_history_settings = None
+_history_settings_lock = threading.Lock()
 
 class JanusHandler(IPythonHandler):
     """Implements main handler for saving and retrieving notebook history."""
@@ -21,6 +45,21 @@ class JanusHandler(IPythonHandler):
     # object managing connection to notebook history database
     db_manager = None
 
+    # bounded pool of threads running database queries and notebook diffs so
+    # they do not block the notebook server's IOLoop
+    executor = None
+
+    # whether requests may ask to be profiled, set in the Janus config
+    allow_profiling = False
+
+    # retention policy set in the Janus config, or None to keep all history
+    retention_policy = None
+
+    # path on disk of each hashed path notebooks were posted from since the
+    # server started, to tell whether a notebook was moved or copied
+    os_paths = {}
+
+    @gen.coroutine
     def get(self, path=''):
         """
         Retrieve requested data about notebook history
@@ -28,9 +67,6 @@ class JanusHandler(IPythonHandler):
         path: (str) relative path of notebook GET request
         """
 
-        # get db connection
-        self.db_manager = self.get_db()
-
         # hash path to get short, encrypted, and unique notebook identifier
         os_path = self.contents_manager._get_os_path(path)
         hashed_path = hash_path(os_path)
@@ -38,79 +74,472 @@ class JanusHandler(IPythonHandler):
         # either a list of all previous notebook cell configurations
         query_type = self.get_argument('q', None, True)
 
-        path = self.get_argument('path', None, True)
-        start = self.get_argument('start', None, True)
-        end = self.get_argument('end', None, True)
+        args = {
+            'version_ids': self.get_argument('version_ids', None, True),
+            'cell_id': self.get_argument('cell_id', None, True),
+            'cell_ids': self.get_argument('cell_ids', None, True),
+            'before': self.get_argument('before', None, True),
+            'limit': self.get_argument('limit', None, True),
+            'job_id': self.get_argument('job_id', None, True),
+            'query': self.get_argument('query', None, True),
+            'since': self.get_argument('since', None, True),
+            'until': self.get_argument('until', None, True),
+            'at': self.get_argument('at', None, True),
+            'index': self.get_argument('index', None, True),
+            'hashed_path': hashed_path,
+            'profile': (self.allow_profiling
+                        and self.get_argument('profile', None, True) == '1')
+        }
+
+        # every [hashed_path, start, end] range the notebook was saved under,
+        # found from its stable id, or sent by clients from before notebooks
+        # had ids, or a single range for older clients still
+        nb_id = self.get_argument('nb_id', None, True)
+        paths = self.get_argument('paths', None, True)
+        if nb_id:
+            args['paths'] = yield self.notebook_paths(nb_id)
+        elif paths:
+            args['paths'] = json.loads(paths)
+        else:
+            args['paths'] = [[self.get_argument('path', None, True),
+                                self.get_argument('start', None, True),
+                                self.get_argument('end', None, True)]]
+
+        # very large notebooks are sent a batch of cells at a time
+        if (query_type == 'snapshot'
+                and self.get_argument('stream', None, True) == '1'):
+            with QUERY_SECONDS.time(type='snapshot'):
+                yield self.stream_snapshot(args)
+            return
+
+        # answer conditional requests for data the client already has without
+        # running the query
+        etag = yield self.history_etag(query_type, args)
+        if etag is not None:
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+                return
+
+        result = yield self.query_history(query_type, args)
+
+        # cell versions never change once recorded, so browsers can keep them
+        # for good, while a cell's history has to be revalidated
+        if query_type == 'versions':
+            version_ids = json.loads(args['version_ids'])
+            if all(v in result['cells'] for v in version_ids):
+                self.set_header('Cache-Control', 'private, max-age=31536000, immutable')
+            else:
+                self.clear_header('Etag')
+                self.set_header('Cache-Control', 'no-cache')
+        elif query_type == 'version_diff':
+            if result.get('diff') is not None:
+                self.set_header('Cache-Control', 'private, max-age=31536000, immutable')
+            else:
+                self.clear_header('Etag')
+                self.set_header('Cache-Control', 'no-cache')
+        elif etag is not None:
+            self.set_header('Cache-Control', 'private, no-cache')
+
+        self.finish_json(result)
+
+    @run_on_executor
+    def notebook_paths(self, nb_id):
+        """
+        Return list of [hashed_path, start_time, end_time, config_id] of every
+        path a notebook has been saved under
+
+        nb_id: (str) stable notebook identifier
+        """
+
+        return self.get_db().get_notebook_paths(nb_id)
+
+    @run_on_executor
+    def history_etag(self, query_type, args):
+        """
+        Return strong ETag of the response to a query whose result we can tell
+        has not changed without running it, or None
+
+        query_type: (str) kind of data requested
+        args: (dict) arguments of the GET request
+        """
+
+        # profiled requests always run their query
+        if args['profile']:
+            return None
 
-        # paths = ast.literal_eval( self.get_argument('paths', None, True) )
+        # a set of cell versions, or a diff of two, is identified by their ids
+        elif (query_type == 'versions'):
+            state = sorted(set(json.loads(args['version_ids'])))
+        elif (query_type == 'version_diff'):
+            state = json.loads(args['version_ids'])
+
+        # a cell's history only grows, so its size and last row identify it
+        elif (query_type == 'cell_history'):
+            db_manager = self.get_db()
+            state = [args['paths'], args['cell_id'],
+                db_manager.get_cell_history_state(args['paths'], args['cell_id'])]
+
+        else:
+            return None
+
+        key = json.dumps([query_type, state])
+        return '"%s"' % sha1(key.encode()).hexdigest()
+
+    def finish_json(self, result):
+        """
+        Finish the request with a JSON response, compressed if it is large
+        and the client accepts it
+
+        result: (dict) data to send
+        """
+
+        body = json.dumps(result).encode()
+        self.set_header('Vary', 'Accept-Encoding')
+        accepted = self.request.headers.get('Accept-Encoding', '')
+        if len(body) >= COMPRESS_MIN_BYTES and 'gzip' in accepted:
+            body = gzip.compress(body)
+            self.set_header('Content-Encoding', 'gzip')
+        self.finish(body)
+
+    @gen.coroutine
+    def stream_snapshot(self, args):
+        """
+        Send the notebook at a time or position in its history as an .ipynb
+        shaped document, loading and writing its cells a batch at a time so
+        the whole notebook is never held in memory at once
+
+        args: (dict) arguments of the GET request
+        """
+
+        snapshot = yield self.find_snapshot(args)
+        if snapshot is None:
+            self.finish_json({'msg': "No such configuration"})
+            return
+
+        prefix, suffix = stream_envelope(notebook_header(snapshot))
+        self.set_header('Content-Type', 'application/json')
+        self.write(prefix)
+        version_ids = snapshot['version_order']
+        for i in range(0, len(version_ids), STREAM_BATCH):
+            cells = yield self.snapshot_cells(snapshot,
+                                                version_ids[i:i + STREAM_BATCH])
+            if len(cells) > 0:
+                self.write((',' if i > 0 else '')
+                            + ','.join(json.dumps(c) for c in cells))
+            yield self.flush()
+        self.finish(suffix)
+
+    @run_on_executor
+    def find_snapshot(self, args):
+        """
+        Return the configuration a snapshot request asks for, see
+        DbManager.find_snapshot
+
+        args: (dict) arguments of the GET request
+        """
+
+        self.db_manager = self.get_db()
+        at = int(args['at']) if args['at'] else None
+        index = int(args['index']) if args['index'] else None
+        return self.db_manager.find_snapshot(args['paths'], at, index)
+
+    @run_on_executor
+    def snapshot_cells(self, snapshot, version_ids):
+        """
+        Return list of some of the cell versions of a snapshot, in order
+
+        snapshot: (dict) configuration found by find_snapshot
+        version_ids: (list) unique cell version identifiers to load
+        """
+
+        return self.db_manager.get_snapshot_cells(snapshot, version_ids)
+
+    @run_on_executor
+    def query_history(self, query_type, args):
+        """
+        Run a query against the notebook history database on the executor,
+        timing it and, if asked, adding a profile of it to the result
+
+        query_type: (str) kind of data requested
+        args: (dict) arguments of the GET request
+        """
+
+        label = query_type if query_type in QUERY_TYPES else 'other'
+        with QUERY_SECONDS.time(type=label), profile(args['profile']) as profiler:
+            result = self.run_query(query_type, args)
+        if profiler is not None:
+            result['profile'] = profiler.collapsed()
+        return result
+
+    def run_query(self, query_type, args):
+        """
+        Run a query against the notebook history database
+
+        query_type: (str) kind of data requested
+        args: (dict) arguments of the GET request
+        """
+
+        # get db connection
+        self.db_manager = self.get_db()
 
         if (query_type == 'config'):
-            nb_configs = self.db_manager.get_nb_configs(path, start, end)
-            self.finish(json.dumps({'nb_configs': nb_configs}))
+            nb_configs = self.db_manager.get_nb_configs(args['paths'])
+            return {'nb_configs': nb_configs}
+
+        # or a page of them, newest first
+        elif (query_type == 'config_page'):
+            before = json.loads(args['before']) if args['before'] else None
+            limit = int(args['limit']) if args['limit'] else 100
+            return self.db_manager.get_nb_config_page(args['paths'], before,
+                                                        limit)
 
         # or data about individual cell versions
         elif (query_type == 'versions'):
-            version_ids = self.get_argument('version_ids', None, True)
-            version_ids = ast.literal_eval(version_ids)
-            cells = self.db_manager.get_versions(version_ids)
-            self.finish(json.dumps({'cells': cells}))
+            version_ids = json.loads(args['version_ids'])
+            cells = self.db_manager.get_versions(version_ids, args['paths'])
+            return {'cells': cells}
+
+        # or the line diff between the sources of two versions of a cell
+        elif (query_type == 'version_diff'):
+            from_id, to_id = json.loads(args['version_ids'])
+            diff = self.db_manager.get_version_diff(from_id, to_id, args['paths'])
+            return {'diff': diff}
 
         # or data about a cell's entrie history
         elif (query_type == 'cell_history'):
-            cell_id = self.get_argument('cell_id', None, True)
-            versions = self.db_manager.get_cell_history(path, start, end, cell_id)
-            self.finish(json.dumps({'versions': versions}))
+            versions = self.db_manager.get_cell_history(args['paths'],
+                                                        args['cell_id'])
+            return {'versions': versions}
+
+        # or summaries of the versions of many cells, without their content
+        elif (query_type == 'version_summary'):
+            cell_ids = json.loads(args['cell_ids'])
+            summaries = self.db_manager.get_version_summaries(args['paths'],
+                                                cell_ids, args['hashed_path'])
+            return {'summaries': summaries}
+
+        # or the progress of an export
+        elif (query_type == 'export_status'):
+            job = self.db_manager.get_export_job(args['job_id'])
+            if job is None:
+                return {'msg': "No such export"}
+            return {'export': job.to_dict()}
+
+        # or what applying the retention policy would reclaim
+        elif (query_type == 'retention_report'):
+            if self.retention_policy is None:
+                return {'msg': "No retention policy set"}
+            return {'report': self.db_manager.run_maintenance(
+                                self.retention_policy, True)}
+
+        # or the cell versions best matching a full-text search, in the
+        # notebook's paths if given, or in every notebook
+        elif (query_type == 'search'):
+            limit = int(args['limit']) if args['limit'] else 50
+            results = self.db_manager.search(args['query'] or '', args['paths'],
+                                    args['since'], args['until'], limit)
+            return {'results': results}
+
+        # or the whole notebook at a time, or at a position in its history
+        elif (query_type == 'snapshot'):
+            at = int(args['at']) if args['at'] else None
+            index = int(args['index']) if args['index'] else None
+            snapshot = self.db_manager.get_snapshot(args['paths'], at, index)
+            if snapshot is None:
+                return {'msg': "No such configuration"}
+            return snapshot
 
         # or data about a comment / bug
         elif (query_type == 'comment'):
             comments = self.db_manager.get_comments()
-            self.finish(json.dumps({'comments': comments}))
+            return {'comments': comments}
 
         else:
-            self.finish(json.dumps({'msg': "Did not understand the request"}))
+            return {'msg': "Did not understand the request"}
 
+    @gen.coroutine
     def post(self, path=''):
         """Save data about notebook actions
 
         path: (str) relative path to notebook requesting POST
         """
 
-        # get db connection
-        self.db_manager = self.get_db()
-
         # hash path for a short, encrypted and unique notebook identifier
         os_path = self.contents_manager._get_os_path(path)
         hashed_path = hash_path(os_path)
+        JanusHandler.os_paths[hashed_path] = os_path
 
         # save data sent in POST
         post_data = self.get_json_body()
+        result = yield self.record_post(post_data, hashed_path)
+        result['hashed_nb_path'] = hashed_path
+        self.finish(json.dumps(result))
+
+    def path_exists(self, hashed_path):
+        """
+        Return whether a notebook is still saved at a hashed path, or None if
+        no notebook was posted from it since the server started
+
+        hashed_path: (str) hashed path to the notebook
+        """
+
+        os_path = self.os_paths.get(hashed_path)
+        if os_path is None:
+            return None
+        return os.path.exists(os_path)
+
+    @run_on_executor
+    def record_post(self, post_data, hashed_path):
+        """
+        Save data sent in a POST request on the executor, timing it
+
+        post_data: (dict) data sent in the POST request
+        hashed_path: (str) hashed path to the notebook
+        """
+
+        label = post_data['type'] if post_data['type'] in POST_TYPES else 'other'
+        with POST_SECONDS.time(type=label):
+            return self.save_post(post_data, hashed_path)
+
+    def save_post(self, post_data, hashed_path):
+        """
+        Save data sent in a POST request
+
+        post_data: (dict) data sent in the POST request
+        hashed_path: (str) hashed path to the notebook
+        """
+
+        # get db connection
+        self.db_manager = self.get_db()
+
+        # tell clients sending only changed cells whether they need to resend
+        # the full notebook, or which configuration to send changes against,
+        # and the stable id of the notebook they are editing
         if post_data['type'] == "action":
-            self.db_manager.record_action(post_data, hashed_path)
+            nb_id = self.db_manager.register_notebook(post_data.get('nb_id'),
+                        hashed_path, post_data['time'], post_data.get('filepaths'),
+                        self.path_exists)
+            token = self.db_manager.record_action(post_data, hashed_path)
+            if token is None:
+                return {'resend': True, 'nb_id': nb_id}
+            return {'config_token': token, 'nb_id': nb_id}
+        # actions the client gathered over a short while, with the notebook
+        # as it was after the last of them, are recorded with one diff. A
+        # resent notebook comes with its time and no actions
+        elif post_data['type'] == "action_batch":
+            actions = post_data['actions']
+            if len(actions) == 0 and 'time' not in post_data:
+                return {}
+            t = post_data.get('time', actions[-1]['time'] if actions else None)
+            nb_id = self.db_manager.register_notebook(post_data.get('nb_id'),
+                        hashed_path, t, post_data.get('filepaths'),
+                        self.path_exists)
+            token = self.db_manager.record_action_batch(post_data, actions,
+                                                        hashed_path)
+            if token is None:
+                return {'resend': True, 'nb_id': nb_id}
+            return {'config_token': token, 'nb_id': nb_id}
         elif post_data['type'] == "log":
             self.db_manager.record_log(post_data, hashed_path)
         elif post_data['type'] == "comment":
             self.db_manager.record_comment(post_data, hashed_path)
         # TODO: any params we need?
+        # exports run in the background, clients poll for their progress
         elif post_data['type'] == "export_db":
-            self.db_manager.export_data_and_clean(hashed_path, False)
-        self.finish(json.dumps({'hashed_nb_path': hashed_path}))
+            job = self.db_manager.start_export(hashed_path, False)
+            return {'export': job.to_dict()}
+        elif post_data['type'] == "cancel_export":
+            job = self.db_manager.get_export_job(post_data['job_id'])
+            if job is not None:
+                job.cancel()
+                return {'export': job.to_dict()}
+        return {}
 
     def get_db(self):
         """
-        Ensure notebook history database is present
+        Ensure notebook history database is present, and return the manager
+        of its connection that is shared by all requests
         """
 
-        # if needed, create directory for database
-        janus_dir = find_storage_dir()
-        if not os.path.isdir(janus_dir):
-            create_dir(janus_dir)
+        return get_history_db()
+
+
+class JanusMetricsHandler(IPythonHandler):
+    """Exposes Janus metrics in the Prometheus text exposition format."""
+
+    @web.authenticated
+    def get(self):
+        """
+        Return the current value of every metric
+        """
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(REGISTRY.expose())
 
-        # set up connection with database
-        db_path = os.path.join(janus_dir, "nb_history.db")
-        if self.db_manager:
-            return self.db_manager
-        else:
-            return DbManager(db_path)
+
+def get_history_settings():
+    """
+    Return the directory history is stored in, created if needed, and the
+    Janus config, both looked up the first time they are needed only
+    """
+
+    global _history_settings
+    with _history_settings_lock:
+        if _history_settings is None:
+            janus_dir = find_storage_dir()
+            if not os.path.isdir(janus_dir):
+                create_dir(janus_dir)
+            _history_settings = (janus_dir, get_janus_config())
+        return _history_settings
+
+
+def get_history_db():
+    """
+    Ensure notebook history database is present, and return the manager of
+    its connection that is shared by all requests and maintenance tasks
+    """
+
+    # set up connection with database
+    janus_dir, config = get_history_settings()
+    settings = {
+        'max_concurrent_diffs': config.get('max_concurrent_diffs', 1),
+        'version_cache_bytes': config.get('version_cache_bytes', 64 * 1024 * 1024),
+        'export_workers': config.get('export_workers', 2),
+        'journal': config.get('journal', True),
+        'search_outputs': config.get('search_outputs', False)
+    }
+
+    # either one database for each notebook, or one for all of them
+    if config.get('sharding'):
+        return get_sharded_db_manager(janus_dir,
+                    max_open_shards=config.get('max_open_shards', 16), **settings)
+    db_path = os.path.join(janus_dir, "nb_history.db")
+    return get_db_manager(db_path, **settings)
+
+
+def start_maintenance(nb_app, policy):
+    """
+    Apply the retention policy to the notebook history database now and then,
+    on the executor so the IOLoop is not blocked
+
+    nb_app: (obj) Jupyter Notebook Application
+    policy: (obj) janus_retention.RetentionPolicy set by the user
+    """
+
+    def run_maintenance():
+        try:
+            report = get_history_db().run_maintenance(policy)
+            nb_app.log.info('Janus history maintenance: %s', report)
+        except Exception:
+            nb_app.log.exception('Janus history maintenance failed')
+
+    def schedule_maintenance():
+        JanusHandler.executor.submit(run_maintenance)
+
+    interval = policy.interval_hours * 60 * 60 * 1000
+    PeriodicCallback(schedule_maintenance, interval).start()
 
 
 def _jupyter_server_extension_paths():
@@ -141,8 +570,26 @@ def load_jupyter_server_extension(nb_app):
     """
 
     nb_app.log.info('Janus Server extension loaded')
+
+    # size of the thread pool handling database queries and notebook diffs
+    config = get_history_settings()[1]
+    JanusHandler.executor = ThreadPoolExecutor(
+                                max_workers=config.get('executor_workers', 4))
+    JanusHandler.allow_profiling = bool(config.get('allow_profiling', False))
+
+    # thin old history if the user has set a retention policy
+    policy = get_retention_policy(config)
+    JanusHandler.retention_policy = policy
+    if policy is not None:
+        start_maintenance(nb_app, policy)
+
     web_app = nb_app.web_app
     host_pattern = '.*$'
     route_pattern = url_path_join(web_app.settings['base_url'],
                                     r"/api/janus%s" % path_regex)
-    web_app.add_handlers(host_pattern, [(route_pattern, JanusHandler)])
+    metrics_pattern = url_path_join(web_app.settings['base_url'],
+                                    r"/api/janus/metrics")
+
+    # the metrics route comes first, since the history route matches any path
+    web_app.add_handlers(host_pattern, [(metrics_pattern, JanusMetricsHandler),
+                                        (route_pattern, JanusHandler)])
@@ -0,0 +1,100 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Keep recently used cell versions decoded in memory
+
+Cell versions never change once recorded, so a decoded version can be kept
+until we run out of room for it. The versions of cells in open notebooks are
+read over and over as users look through their history, and decoding them
+(unpickling, and decompressing outputs) is the bulk of the cost of reading them.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+class VersionCache(object):
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        """
+        Least recently used cache of decoded cell versions, holding at most
+        max_bytes of versions measured by the size of their JSON
+
+        max_bytes: (int) most bytes of versions to keep, 0 disables the cache
+        """
+
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # version_id -> (decoded version, size), least recently used first
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, version_id):
+        """
+        Return decoded cell version, or None if it is not cached. Versions are
+        shared between callers, so must not be modified
+
+        version_id: (str) unique cell version identifier
+        """
+
+        with self.lock:
+            entry = self.versions.get(version_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.versions.move_to_end(version_id)
+            self.hits += 1
+            return entry[0]
+
+
+    def put(self, version_id, version):
+        """
+        Cache a decoded cell version, evicting the least recently used versions
+        until it fits
+
+        version_id: (str) unique cell version identifier
+        version: (obj) JSON representation of the cell version
+        """
+
+        size = len(json.dumps(version))
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if version_id in self.versions:
+                self.versions.move_to_end(version_id)
+                return
+            self.versions[version_id] = (version, size)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                evicted_id, evicted = self.versions.popitem(last=False)
+                self.num_bytes -= evicted[1]
+
+
+    def clear(self):
+        """
+        Forget every cached version
+        """
+
+        with self.lock:
+            self.versions.clear()
+            self.num_bytes = 0
+
+
+    def stats(self):
+        """
+        Return dict of cache size and hit / miss counts
+        """
+
+        with self.lock:
+            return {
+                'versions': len(self.versions),
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
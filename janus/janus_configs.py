@@ -0,0 +1,106 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Encode the cell and version orders of notebook configurations compactly
+
+Consecutive configurations of a notebook usually differ by a single version
+id, so most configurations are stored as a small delta against the previous
+configuration of the same notebook. Every KEYFRAME_INTERVAL configurations we
+store a full keyframe instead, which bounds how many deltas we have to apply
+to rebuild any configuration.
+"""
+
+import json
+
+# store a full configuration at least this often
+KEYFRAME_INTERVAL = 50
+
+def encode_keyframe(order):
+    """
+    Return text storing a full cell or version order
+
+    order: (list) unique cell or cell version identifiers
+    """
+
+    return json.dumps(order, separators=(',', ':'))
+
+
+def encode_delta(previous, order):
+    """
+    Return text storing how an order differs from the previous one, as the
+    single splice [start, number of ids removed, ids inserted] that turns
+    the previous order into the new one
+
+    previous: (list) order in the previous configuration
+    order: (list) order in the new configuration
+    """
+
+    # trim the ids both orders start and end with
+    start = 0
+    max_start = min(len(previous), len(order))
+    while start < max_start and previous[start] == order[start]:
+        start += 1
+    end = 0
+    max_end = max_start - start
+    while end < max_end and previous[-1 - end] == order[-1 - end]:
+        end += 1
+
+    removed = len(previous) - start - end
+    inserted = order[start:len(order) - end]
+    return json.dumps([start, removed, inserted], separators=(',', ':'))
+
+
+def apply_delta(previous, delta):
+    """
+    Return order rebuilt from the previous order and a delta
+
+    previous: (list) order in the previous configuration
+    delta: (str) delta created by encode_delta
+    """
+
+    start, removed, inserted = json.loads(delta)
+    return previous[:start] + inserted + previous[start + removed:]
+
+
+def encode_config(previous, cell_order, version_order):
+    """
+    Return encoded (cell_order, version_order, keyframe) to store in the
+    nb_configs table
+
+    previous: (tuple) decoded (cell_order, version_order) of the previous
+        configuration of the notebook, or None to store a keyframe
+    cell_order: (list) unique cell identifiers
+    version_order: (list) unique cell version identifiers
+    """
+
+    if previous is None:
+        return (encode_keyframe(cell_order), encode_keyframe(version_order), 1)
+    else:
+        return (encode_delta(previous[0], cell_order),
+                encode_delta(previous[1], version_order), 0)
+
+
+def decode_configs(rows):
+    """
+    Return list of decoded (time, nb_name, cell_order, version_order)
+
+    rows: (list) consecutive (time, nb_name, cell_order, version_order,
+        keyframe) rows of a single notebook, starting with a keyframe
+    """
+
+    configs = []
+    cell_order = None
+    version_order = None
+    for r in rows:
+        if r[4]:
+            cell_order = json.loads(r[2])
+            version_order = json.loads(r[3])
+        elif cell_order is None:
+            raise ValueError('notebook configurations must start with a keyframe')
+        else:
+            cell_order = apply_delta(cell_order, r[2])
+            version_order = apply_delta(version_order, r[3])
+        configs.append((r[0], r[1], cell_order, version_order))
+
+    return configs
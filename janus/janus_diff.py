@@ -5,18 +5,19 @@ folding cells and keeping track of all changes
 Get diff between current and previous notebook versions
 """
 
-import ast
 import os
+import re
 import uuid
-import pickle
+import json
+from hashlib import sha1
 
-# TODO implement smarter cell comparison that ignores trivial difference of
-# matplotlib figures having a different memory location
+from janus.janus_metrics import FINGERPRINT_SECONDS
 
 def check_for_nb_diff(t, hashed_path, cells, db):
     """
     Check for differences between current and previous version of the notebook
     Save any new cells or notebook configurations to the nb_history database
+    Return token identifying the resulting notebook configuration
 
     t: (str) time of action that prompted check for a notebook diff
     hashed_path: (str) hashed path to notebook file, used to query db
@@ -37,7 +38,7 @@ def check_for_nb_diff(t, hashed_path, cells, db):
             cell_id = c['metadata']['janus']['id']
             version_id = uuid.uuid4().hex[0:8]
             cell_data = c
-            db.record_cell(t, cell_id, version_id, cell_data)
+            db.record_cell(t, cell_id, version_id, cell_data, hashed_path)
 
             # keep track of the cell order
             new_cell_order.append(cell_id)
@@ -45,90 +46,276 @@ def check_for_nb_diff(t, hashed_path, cells, db):
 
         # create new db entry for this notebook confiburation
         db.record_nb_config(t, hashed_path, new_cell_order, new_version_order)
-        return
+        return config_token(new_cell_order, new_version_order)
 
     # get the cell order and cells of the last notebook configuration
-    last_cell_order = ast.literal_eval(last_nb_config[2])
-    last_version_order = ast.literal_eval(last_nb_config[3])
-    last_cells = [db.get_last_cell_version(cell_id) for cell_id in last_cell_order]
+    last_cell_order = last_nb_config[2]
+    last_version_order = last_nb_config[3]
+    last_cells = db.get_last_cell_versions(last_cell_order)
 
     # for each cell in the current notebook
     for c in cells:
         cell_id = c['metadata']['janus']['id']
-        version_id = uuid.uuid4().hex[0:8]
-        cell_data = c
-        match_found = False
 
         # check if this cell had the same content in the last notebook config
-        previous_versions = []
-        if len(last_cells) > 0:
-            previous_versions = [pv for pv in last_cells if pv[1] == cell_id]
-        if len(previous_versions) > 0:
-            previous_version = previous_versions[0]
-            previous_content = pickle.loads(previous_version[3])
-
-            # if the same cell content, use the old cell's version_id
-            if not cells_different(previous_content, c):
-                version_id = previous_version[2]
-                new_cell_order.append(cell_id)
-                new_version_order.append(version_id)
-                match_found = True
-                continue
-
-        # check if a cell with the same content was in *older* nb configurations
-        older_versions = db.get_all_cell_versions(cell_id)
-        for older_version in older_versions:
-            if not cells_different(pickle.loads(older_version[3]), c):
-                version_id = older_version[2]
-                new_cell_order.append(cell_id)
-                new_version_order.append(version_id)
-                match_found = True
-                break
-
-        # i no old versions matched, create a new entry
-        if not match_found:
-            db.record_cell(t, cell_id, version_id, cell_data)
-            new_cell_order.append(cell_id)
-            new_version_order.append(version_id)
+        previous_version = last_cells.get(cell_id)
+
+        new_cell_order.append(cell_id)
+        new_version_order.append(match_cell_version(t, c, previous_version, db,
+                                                    hashed_path))
 
     # save a new nb config if different from the last one
     if ( new_version_order != last_version_order ):
         db.record_nb_config(t, hashed_path, new_cell_order, new_version_order)
+    return config_token(new_cell_order, new_version_order)
+
+
+def check_for_nb_delta(t, hashed_path, cell_order, changed_cells, base, db):
+    """
+    Check for differences when the client only sent the cells that changed
+    since its last request. Cells it did not send keep the version they had
+    in the last notebook configuration. Return token identifying the resulting
+    notebook configuration, or None if the client needs to send the full
+    notebook because our last configuration is not the one it started from
+
+    t: (str) time of action that prompted check for a notebook diff
+    hashed_path: (str) hashed path to notebook file, used to query db
+    cell_order: (list) unique cell identifiers in the current notebook
+    changed_cells: (dict) JSON of changed cells with cell_id as keys
+    base: (str) token of the configuration the client last heard back about
+    db: (object) DBManager object managing connection to notebook history db
+    """
+
+    # make sure we are working from the same notebook state as the client
+    last_nb_config = db.get_last_nb_config(hashed_path)
+    if (not last_nb_config):
+        return None
+    last_cell_order = last_nb_config[2]
+    last_version_order = last_nb_config[3]
+    if config_token(last_cell_order, last_version_order) != base:
+        return None
+
+    # every cell the client did not send must be in the last configuration
+    last_versions = dict(zip(last_cell_order, last_version_order))
+    for cell_id in cell_order:
+        if cell_id not in changed_cells and cell_id not in last_versions:
+            return None
+
+    # rebuild the full notebook configuration
+    last_cells = db.get_last_cell_versions([cell_id for cell_id in changed_cells
+                                            if cell_id in last_versions])
+    new_version_order = []
+    for cell_id in cell_order:
+        if cell_id in changed_cells:
+            previous_version = last_cells.get(cell_id)
+            version_id = match_cell_version(t, changed_cells[cell_id],
+                                            previous_version, db, hashed_path)
+        else:
+            version_id = last_versions[cell_id]
+        new_version_order.append(version_id)
+
+    # save a new nb config if different from the last one
+    if ( new_version_order != last_version_order ):
+        db.record_nb_config(t, hashed_path, cell_order, new_version_order)
+    return config_token(cell_order, new_version_order)
+
+
+def match_cell_version(t, c, previous_version, db, hashed_path = None):
+    """
+    Return version_id of a saved version with the same content as the cell,
+    saving the cell as a new version if there is none
+
+    t: (str) time of action that prompted check for a notebook diff
+    c: (obj) JSON representation of the cell
+    previous_version: (tuple) last saved version of the cell, or None
+    db: (object) DBManager object managing connection to notebook history db
+    hashed_path: (str) hashed path to notebook file the cell is in
+    """
+
+    cell_id = c['metadata']['janus']['id']
+    fingerprint = cell_fingerprint(c)
+
+    # if the same content as the last version, use the old cell's version_id
+    if previous_version and previous_version[4] == fingerprint:
+        return previous_version[2]
+
+    # check if a cell with the same content was in *older* nb configurations
+    older_version_id = db.get_cell_version_by_fingerprint(cell_id, fingerprint)
+    if older_version_id:
+        return older_version_id
+
+    # if no old versions matched, create a new entry
+    version_id = uuid.uuid4().hex[0:8]
+    db.record_cell(t, cell_id, version_id, c, hashed_path)
+    return version_id
+
+
+def config_token(cell_order, version_order):
+    """
+    Return short token identifying a notebook configuration, so clients can
+    tell us which configuration they last heard back about
+
+    cell_order: (list) unique cell identifiers
+    version_order: (list) unique cell version identifiers
+    """
+
+    h = sha1(json.dumps([list(cell_order), list(version_order)]).encode())
+    return h.hexdigest()[0:16]
+
+
+# functions normalizing a copy of an output before it is fingerprinted, so
+# outputs that only differ in volatile details count as the same version
+NORMALIZERS = []
+
+# volatile text in outputs that changes each time the same code runs, with
+# a substring the text must contain for the pattern to match, which is much
+# cheaper to look for than running the pattern
+VOLATILE_PATTERNS = [
+    # object reprs, e.g. <matplotlib.figure.Figure at 0x7f3c2e1b4a90>
+    (' at 0x', re.compile(r' at 0x[0-9a-fA-F]+'), ' at 0x'),
+    # dates and times, e.g. 2018-03-02 14:21:09.123456
+    (':', re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?'), '<datetime>'),
+    (':', re.compile(r'\b\d{1,2}:\d{2}:\d{2}(\.\d+)?\b'), '<time>'),
+    # output of the %time and %timeit magics
+    (' time', re.compile(r'(CPU times|Wall time):[^\n]*'), r'\1: <elapsed>'),
+    (' per loop', re.compile(r'[\d.]+ \S?s ± [\d.]+ \S?s per loop[^\n]*'),
+        '<elapsed> per loop')
+]
+
+def register_normalizer(normalizer):
+    """
+    Add a function normalizing outputs before they are fingerprinted. Versions
+    already recorded keep their fingerprints, so a new normalizer only takes
+    effect for cells recorded after it is added
+
+    normalizer: (func) takes a copy of an output and returns it normalized
+    """
+
+    NORMALIZERS.append(normalizer)
+    return normalizer
+
+
+def normalize_text(text):
+    """
+    Return text with volatile parts replaced by placeholders
+
+    text: (str or list) text, or list of lines as in nbformat
+    """
+
+    if isinstance(text, list):
+        text = ''.join(text)
+    if not isinstance(text, str):
+        return text
+    for marker, pattern, replacement in VOLATILE_PATTERNS:
+        if marker in text:
+            text = pattern.sub(replacement, text)
+    return text
+
+
+@register_normalizer
+def strip_execution_count(output):
+    """
+    Drop the execution count of execute_result outputs, which changes every
+    time the cell runs
+
+    output: (dict) copy of the output to normalize
+    """
+
+    output.pop('execution_count', None)
+    return output
+
+
+@register_normalizer
+def strip_volatile_text(output):
+    """
+    Replace object addresses, timestamps and timings in text outputs
+
+    output: (dict) copy of the output to normalize
+    """
+
+    if 'text' in output:
+        output['text'] = normalize_text(output['text'])
+    if 'evalue' in output:
+        output['evalue'] = normalize_text(output['evalue'])
+    if isinstance(output.get('data'), dict):
+        data = dict(output['data'])
+        for mime_type in ('text/plain', 'text/html'):
+            if mime_type in data:
+                data[mime_type] = normalize_text(data[mime_type])
+        output['data'] = data
+    return output
+
+
+def output_fingerprint(output):
+    """
+    Return hash of the normalized parts of an output that make it different
+    from another output
+
+    output: (dict) JSON representation of a cell output
+    """
+
+    output = dict(output)
+    for normalizer in NORMALIZERS:
+        output = normalizer(output)
+
+    output_type = output['output_type']
+    if output_type in ['display_data', 'execute_result']:
+        content = [output_type, output['data']]
+    elif output_type == 'stream':
+        content = [output_type, output['text']]
+    elif output_type == 'error':
+        content = [output_type, output['evalue']]
+    else:
+        content = [output_type]
+
+    # sort keys so the same content always produces the same hash
+    canonical = json.dumps(content, sort_keys=True)
+    return sha1(canonical.encode()).hexdigest()
+
+
+@FINGERPRINT_SECONDS.timed
+def cell_fingerprint(cell):
+    """
+    Return a canonical hash of the cell type, source and normalized outputs
+
+    Cells with the same fingerprint are considered the same version, so we can
+    look up matching versions in the database without unpickling them
+
+    cell: (obj) JSON representation of the cell
+    """
+
+    source = cell['source']
+    if isinstance(source, list):
+        source = ''.join(source)
+    content = [cell['cell_type'], sha1(source.encode()).hexdigest()]
+    if cell['cell_type'] == 'code':
+        content.append([output_fingerprint(o) for o in cell['outputs']])
+    return sha1(json.dumps(content).encode()).hexdigest()
+
+
+def cell_has_content(cell):
+    """
+    Return 1 if the cell has any source or outputs, 0 if it is empty
+
+    cell: (obj) JSON representation of the cell
+    """
+
+    if cell.get('source') or cell.get('outputs'):
+        return 1
+    return 0
+
 
 def cells_different(cell_a, cell_b, compare_outputs = True):
     """
-    Return true/false if two cells are the same
+    Return true/false if two cells are different, ignoring volatile details
+    of their outputs, see cell_fingerprint
 
     cell_a: (obj) JSON representation of first cell
     cell_b: (obj) JSON representation of second cell
     compare_outputs: (bool) whether to compare cell outputs, or just inputs
     """
 
-    # check if cell type or source is different
-    if (cell_a["cell_type"] != cell_b["cell_type"]
-        or cell_a["source"] != cell_b["source"]):
-        return True
-
-    # otherwise compare outputs if it is a code cell
-    elif compare_outputs and cell_b["cell_type"] == "code":
-        # get the outputs
-        cell_a_outs = cell_a['outputs']
-        cell_b_outs = cell_b['outputs']
-        # if different number of outputs, the cell has changed
-        if len(cell_a_outs) != len(cell_b_outs):
-            return True
-        # compare the outputs one by one
-        for j in range(len(cell_b_outs)):
-            # check that the output type matches
-            if cell_b_outs[j]['output_type'] != cell_a_outs[j]['output_type']:
-                return True
-            # and that the relevant data matches
-            elif((cell_a_outs[j]['output_type'] in ["display_data","execute_result"]
-                and cell_a_outs[j]['data'] != cell_b_outs[j]['data'])
-                or (cell_a_outs[j]['output_type'] == "stream"
-                and cell_a_outs[j]['text'] != cell_b_outs[j]['text'])
-                or (cell_a_outs[j]['output_type'] == "error"
-                and cell_a_outs[j]['evalue'] != cell_b_outs[j]['evalue'])):
-                return True
-
-    return False
+    if not compare_outputs:
+        return (cell_a["cell_type"] != cell_b["cell_type"]
+                or cell_a["source"] != cell_b["source"])
+    return cell_fingerprint(cell_a) != cell_fingerprint(cell_b)
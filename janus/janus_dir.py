@@ -7,6 +7,7 @@ Manage directories where notebook history data is stored
 
 import os
 import json
+import uuid
 from hashlib import sha1
 
 # TODO check if directory assignment works on Windows machines
@@ -34,15 +35,11 @@ def create_dir(dir_path):
         pass
 
 
-def find_storage_dir():
+def get_janus_config():
     """
-    return where to store notebook history data, default or user specified
+    return Janus settings the user has set in their notebook config file
     """
 
-    # get default storage directory
-    storage_dir = default_storage_dir()
-
-    # determine if user has overridden default directory in config file
     user_dir = os.path.expanduser('~')
     config_path = os.path.join(user_dir, '.jupyter', 'nbconfig', 'notebook.json')
     filename = os.path.expanduser(config_path)
@@ -50,11 +47,27 @@ def find_storage_dir():
         with open(filename) as data_file:
             data = json.load(data_file)
             try:
-                if data["Janus"]["data_directory"]:
-                    storage_dir = data["Janus"]["data_directory"]
+                if isinstance(data["Janus"], dict):
+                    return data["Janus"]
             except:
                 pass
 
+    return {}
+
+
+def find_storage_dir():
+    """
+    return where to store notebook history data, default or user specified
+    """
+
+    # get default storage directory
+    storage_dir = default_storage_dir()
+
+    # determine if user has overridden default directory in config file
+    config = get_janus_config()
+    if config.get("data_directory"):
+        storage_dir = config["data_directory"]
+
     # create storage directory if it does not already exist
     if not os.path.exists(storage_dir):
         create_dir(storage_dir)
@@ -72,3 +85,11 @@ def hash_path(path):
     # only need first 8 charachters of hash to be uniquely identified
     h = sha1(path.encode())
     return h.hexdigest()[0:8]
+
+
+def new_notebook_id():
+    """
+    get new stable notebook identifier, kept by the notebook across renames
+    """
+
+    return uuid.uuid4().hex[0:16]
@@ -0,0 +1,172 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Summarize cell versions for analysis without keeping their private content
+
+Exports only look at versions recorded since the last export, read them in
+chunks, and summarize each chunk in a separate process, so the cost of an
+export depends on how much was recorded since the last one rather than on
+the size of the whole history.
+"""
+
+import ast
+import pickle
+import re
+import json
+import threading
+import time
+import uuid
+
+# number of cell versions read and summarized at a time
+EXPORT_CHUNK_SIZE = 500
+
+def count_functions(source):
+    """
+    Return number of functions defined in a code cell's source, or 0 if the
+    source cannot be parsed
+
+    source: (str) source of the code cell
+    """
+
+    # ignore IPython magics and shell commands, which are not python
+    lines = [l for l in source.splitlines() if not l.lstrip().startswith(('%', '!'))]
+    try:
+        tree = ast.parse('\n'.join(lines))
+    except (SyntaxError, ValueError):
+        return 0
+
+    return sum(1 for node in ast.walk(tree)
+               if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)))
+
+
+def summarize_cell(time, cell_id, version_id, cell, output_count):
+    """
+    Return row of the cleaned_cells table summarizing a cell version
+
+    time: (int) time the cell version was recorded
+    cell_id: (str) unique cell identifier
+    version_id: (str) unique cell version identifier
+    cell: (obj) JSON representation of the cell version
+    output_count: (int) number of outputs of the cell version
+    """
+
+    data_dict = {"meta_data": [], "line_count": 0, "function_count":0,
+        "cell_count":0, "lines_of_code":0, "markdown_word_count":0,
+        "output_count":0, "types":{"markdown":0,"code":0}}
+
+    data_dict["meta_data"].append(cell["metadata"])  # metadata obj
+    data_dict["cell_count"] += 1  # how many individual cells
+    cell_type = cell["cell_type"]
+    data_dict["types"][cell_type] = data_dict["types"].get(cell_type, 0) + 1
+    if cell_type == "code":
+        data_dict["lines_of_code"] += len(cell["source"].splitlines(True))  # LOC for code cells
+        data_dict["function_count"] += count_functions(cell["source"])
+        data_dict["output_count"] += output_count  # count for **amount** of output
+    elif cell_type == "markdown":
+        data_dict["markdown_word_count"] += len(re.findall(r"(\S+)", cell["source"]))
+    data_dict["line_count"] += len(cell["source"].splitlines(True))  # count for all cells
+
+    # TODO How to tell the different types of output? (current counted)
+    return (str(time), str(cell_id), str(version_id), "CLEARED",
+        str(data_dict["meta_data"]), str(data_dict["line_count"]),
+        str(data_dict["function_count"]), str(data_dict["cell_count"]),
+        str(data_dict["lines_of_code"]), str(data_dict["markdown_word_count"]),
+        str(data_dict["output_count"]), str(data_dict["types"]))
+
+
+def summarize_rows(rows):
+    """
+    Return rows of the cleaned_cells table summarizing rows of the cells
+    table, run in a worker process
+
+    rows: (list) (time, cell_id, version_id, cell_data, output_refs, source)
+        rows of the cells table, with the rebuilt source of versions whose
+        source is stored as a delta
+    """
+
+    summaries = []
+    for time, cell_id, version_id, cell_data, output_refs, source in rows:
+        cell = pickle.loads(cell_data)
+        if source is not None:
+            cell["source"] = source
+
+        # outputs stored separately are counted by their hashes, so we never
+        # have to load them
+        if output_refs is not None:
+            output_count = len(json.loads(output_refs))
+        else:
+            output_count = len(cell.get("outputs", []))
+
+        summaries.append(summarize_cell(time, cell_id, version_id, cell,
+                                        output_count))
+
+    return summaries
+
+
+class ExportJob(object):
+    def __init__(self, nb_name, drop_all = False):
+        """
+        Export running in the background, whose progress can be checked and
+        which can be cancelled between chunks
+
+        nb_name: (str) hashed path to the notebook requesting the export
+        drop_all: (bool) if the analysis table is refreshed with every version
+        """
+
+        self.id = uuid.uuid4().hex[0:8]
+        self.nb_name = nb_name
+        self.drop_all = drop_all
+        self.status = 'running'
+        self.error = None
+        self.rows_done = 0
+        self.rows_total = 0
+        self.started = time.time()
+        self.finished = None
+        self.cancel_requested = threading.Event()
+
+
+    def cancel(self):
+        """
+        Ask the export to stop after the chunk it is working on
+        """
+
+        self.cancel_requested.set()
+
+
+    def is_running(self):
+        """
+        Return whether the export has not stopped yet
+        """
+
+        return self.status == 'running'
+
+
+    def finish(self, status, error = None):
+        """
+        Record that the export stopped
+
+        status: (str) 'done', 'cancelled' or 'failed'
+        error: (str) why the export failed
+        """
+
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+
+
+    def to_dict(self):
+        """
+        Return dict of the export's progress to send to the client
+        """
+
+        elapsed = (self.finished or time.time()) - self.started
+        rate = self.rows_done / elapsed if elapsed > 0 else 0
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'rows_per_second': round(rate, 1)
+        }
@@ -0,0 +1,171 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Append-only journal of records waiting to be committed to the database
+
+Every record queued by a DbManager is first appended to its journal, and the
+journal is synced to disk before the request that queued it is answered.
+Requests arriving together share one sync. Each record has a sequence number,
+and the database stores the last one it has committed in the same transaction
+as the records, so after a crash records the database is missing are replayed
+from the journal, and records it already has are not applied again.
+"""
+
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from janus.janus_metrics import JOURNAL_SYNC_SECONDS
+
+# each record is framed by its length, a checksum, and its sequence number
+FRAME_HEADER = struct.Struct('<IIQ')
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        Open (or create) a journal file, dropping any partly written record
+        left at its end by a crash
+
+        path: (str) path to the journal file
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+
+        # read what is already there, and cut off any torn record
+        self.pending, valid_bytes = read_journal(path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        if os.fstat(self.fd).st_size > valid_bytes:
+            os.ftruncate(self.fd, valid_bytes)
+
+        # sequence number of the last record appended, and the last synced
+        self.last_seq = self.pending[-1][0] if self.pending else 0
+        self.synced_seq = self.last_seq
+        self.syncing = False
+
+
+    def start_after(self, seq):
+        """
+        Make sure new records are numbered after a sequence number, e.g. the
+        last one the database committed before the journal was truncated
+
+        seq: (int) sequence number
+        """
+
+        with self.lock:
+            self.last_seq = max(self.last_seq, seq)
+            self.synced_seq = max(self.synced_seq, seq)
+
+
+    def unapplied(self, applied_seq):
+        """
+        Return list of (seq, queue name, record) found in the journal when it
+        was opened that come after the last one the database committed
+
+        applied_seq: (int) sequence number of the last record committed
+        """
+
+        return [entry for entry in self.pending if entry[0] > applied_seq]
+
+
+    def append(self, queue_name, record):
+        """
+        Append a record to the journal, without waiting for it to reach the
+        disk. Return its sequence number
+
+        queue_name: (str) name of the queue the record is in
+        record: (tuple) values of the new database row
+        """
+
+        payload = pickle.dumps((queue_name, record), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.last_seq += 1
+            header = FRAME_HEADER.pack(len(payload), zlib.crc32(payload),
+                                        self.last_seq)
+            os.write(self.fd, header + payload)
+            return self.last_seq
+
+
+    def sync(self, seq = None):
+        """
+        Block until a record, by default the last one appended, is on disk.
+        The first caller to arrive syncs every record appended so far, while
+        callers arriving during the sync wait and then sync the rest at once
+
+        seq: (int) sequence number of the record
+        """
+
+        with self.synced:
+            if seq is None:
+                seq = self.last_seq
+            while self.synced_seq < seq:
+                if self.syncing:
+                    self.synced.wait()
+                    continue
+
+                # sync everything appended so far, letting others append
+                self.syncing = True
+                target = self.last_seq
+                self.lock.release()
+                try:
+                    start = time.perf_counter()
+                    os.fsync(self.fd)
+                    JOURNAL_SYNC_SECONDS.observe(time.perf_counter() - start)
+                finally:
+                    self.lock.acquire()
+                    self.syncing = False
+                    self.synced.notify_all()
+                self.synced_seq = max(self.synced_seq, target)
+
+
+    def truncate(self):
+        """
+        Empty the journal once the database has committed every record in it
+        """
+
+        with self.lock:
+            os.ftruncate(self.fd, 0)
+            self.pending = []
+
+
+    def close(self):
+        """
+        Close the journal file
+        """
+
+        with self.lock:
+            os.close(self.fd)
+
+
+def read_journal(path):
+    """
+    Return (list of (seq, queue name, record), bytes of whole records) of the
+    records in a journal, stopping at the first torn or corrupt one
+
+    path: (str) path to the journal file
+    """
+
+    entries = []
+    valid_bytes = 0
+    if not os.path.exists(path):
+        return entries, valid_bytes
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    while valid_bytes + FRAME_HEADER.size <= len(data):
+        length, crc, seq = FRAME_HEADER.unpack_from(data, valid_bytes)
+        start = valid_bytes + FRAME_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        queue_name, record = pickle.loads(payload)
+        entries.append((seq, queue_name, record))
+        valid_bytes = start + length
+
+    return entries, valid_bytes
@@ -0,0 +1,345 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Count and time what Janus spends its time on, and profile single requests
+
+Recording a measurement only adds to a few numbers in memory. Metrics that
+are costly to measure, like database sizes, are only read by collectors when
+someone asks for them, so metrics cost next to nothing until they are scraped
+from /api/janus/metrics in the Prometheus text exposition format.
+"""
+
+import collections
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# upper bounds of histogram buckets, in seconds or rows
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+class Counter(object):
+    def __init__(self, name, doc):
+        """
+        Total that only goes up, with a separate total for each set of labels
+
+        name: (str) metric name
+        doc: (str) help text of the metric
+        """
+
+        self.name = name
+        self.doc = doc
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+
+    def inc(self, amount = 1, **labels):
+        """
+        Add to the total
+
+        amount: (float) amount to add
+        labels: (dict) labels of the total to add to
+        """
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] += amount
+
+
+    def expose(self):
+        """
+        Return lines of the metric in the text exposition format
+        """
+
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s counter' % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(key),
+                                            format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, doc, buckets = TIME_BUCKETS):
+        """
+        Distribution of observed values, counted in cumulative buckets, with
+        a separate distribution for each set of labels
+
+        name: (str) metric name
+        doc: (str) help text of the metric
+        buckets: (tuple) increasing upper bounds of the buckets
+        """
+
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, **labels):
+        """
+        Count a value in the bucket it falls in
+
+        value: (float) observed value
+        labels: (dict) labels of the distribution to add to
+        """
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts, then the sum and count of all values
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds taken by the body of a with statement
+
+        labels: (dict) labels of the distribution to add to
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def timed(self, fn):
+        """
+        Decorate a function to observe the seconds each call takes
+        """
+
+        @wraps(fn)
+        def timed_fn(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - start)
+
+        return timed_fn
+
+
+    def expose(self):
+        """
+        Return lines of the metric in the text exposition format
+        """
+
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (self.name,
+                        format_labels(key + (('le', format_value(bound)),)),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (self.name,
+                    format_labels(key + (('le', '+Inf'),)), counts[-1]))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(key),
+                                                format_value(counts[-2])))
+                lines.append('%s_count%s %d' % (self.name, format_labels(key),
+                                                counts[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        """
+        Every metric Janus records, and collectors measuring gauges on demand
+        """
+
+        self.metrics = []
+        self.collectors = []
+
+
+    def counter(self, name, doc):
+        """
+        Return new Counter exposed by this registry
+
+        name: (str) metric name
+        doc: (str) help text of the metric
+        """
+
+        metric = Counter(name, doc)
+        self.metrics.append(metric)
+        return metric
+
+
+    def histogram(self, name, doc, buckets = TIME_BUCKETS):
+        """
+        Return new Histogram exposed by this registry
+
+        name: (str) metric name
+        doc: (str) help text of the metric
+        buckets: (tuple) increasing upper bounds of the buckets
+        """
+
+        metric = Histogram(name, doc, buckets)
+        self.metrics.append(metric)
+        return metric
+
+
+    def add_collector(self, collector):
+        """
+        Add function measuring gauges when the metrics are scraped. It returns
+        a list of (name, help text, list of (labels dict, value))
+
+        collector: (func) function taking no arguments
+        """
+
+        self.collectors.append(collector)
+
+
+    def expose(self):
+        """
+        Return every metric in the text exposition format
+        """
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for collector in self.collectors:
+            for name, doc, samples in collector():
+                lines.append('# HELP %s %s' % (name, doc))
+                lines.append('# TYPE %s gauge' % name)
+                for labels, value in samples:
+                    lines.append('%s%s %s' % (name,
+                        format_labels(tuple(sorted(labels.items()))),
+                        format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(key):
+    """
+    Return labels in the text exposition format, e.g. {type="config"}
+
+    key: (tuple) sorted (label, value) pairs
+    """
+
+    if len(key) == 0:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')) for k, v in key]
+    return '{%s}' % ','.join('%s="%s"' % kv for kv in escaped)
+
+
+def format_value(value):
+    """
+    Return number in the text exposition format
+
+    value: (float) value to format
+    """
+
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# metrics shared by all of Janus
+REGISTRY = Registry()
+
+QUERY_SECONDS = REGISTRY.histogram('janus_query_seconds',
+    'Time taken to answer history queries, by query type')
+POST_SECONDS = REGISTRY.histogram('janus_post_seconds',
+    'Time taken to record posted data, by post type')
+DIFF_SECONDS = REGISTRY.histogram('janus_diff_seconds',
+    'Time taken to check notebooks for new cell versions and configurations')
+FINGERPRINT_SECONDS = REGISTRY.histogram('janus_fingerprint_seconds',
+    'Time taken to fingerprint a cell')
+PICKLE_LOADS = REGISTRY.counter('janus_pickle_loads_total',
+    'Cell versions unpickled')
+COMMIT_SECONDS = REGISTRY.histogram('janus_commit_seconds',
+    'Time taken to commit queued history')
+COMMIT_ROWS = REGISTRY.histogram('janus_commit_rows',
+    'Rows written by each commit of queued history', ROW_BUCKETS)
+JOURNAL_SYNC_SECONDS = REGISTRY.histogram('janus_journal_sync_seconds',
+    'Time taken to sync the ingest journal to disk')
+
+
+class SamplingProfiler(object):
+    def __init__(self, thread_id, interval = 0.005):
+        """
+        Profile a thread by sampling its stack from another thread, so the
+        profiled code runs at close to its normal speed
+
+        thread_id: (int) identifier of the thread to profile
+        interval: (float) seconds between samples
+        """
+
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample,
+                                        name='janus-profiler')
+        self.sampler.daemon = True
+
+
+    def sample(self):
+        """
+        Count the stack of the profiled thread every interval until stopped
+        """
+
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                    code.co_filename.rsplit('/', 1)[-1], frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+    def __enter__(self):
+        self.sampler.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.sampler.join()
+
+
+    def collapsed(self):
+        """
+        Return sampled stacks in collapsed format, one "frame;frame count"
+        line per stack, most sampled first, as flame graph tools read them
+        """
+
+        return ['%s %d' % (stack, count)
+                for stack, count in self.stacks.most_common()]
+
+
+@contextmanager
+def profile(enabled):
+    """
+    Profile the body of a with statement if enabled, yielding the
+    SamplingProfiler or None
+
+    enabled: (bool) whether to profile
+    """
+
+    if not enabled:
+        yield None
+        return
+    with SamplingProfiler(threading.get_ident()) as profiler:
+        yield profiler
@@ -0,0 +1,469 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Create and upgrade the schema of the notebook history database in place
+"""
+
+import ast
+import json
+import pickle
+import sqlite3
+
+from janus.janus_diff import cell_fingerprint, cell_has_content
+from janus.janus_outputs import split_outputs, join_outputs, decompress_output
+from janus.janus_configs import encode_config, KEYFRAME_INTERVAL
+
+# The schema version of a database is stored in its user_version pragma. Each
+# migration below upgrades the schema by one version, and should be safe to
+# re-run in case it was interrupted part way through on an older database.
+
+def create_tables(c):
+    """
+    Create action, cell, nb_config, log and comment tables
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS actions (time integer,
+        nb_name text, name text, selected_cell integer, selected_cells text)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS cells (time integer,
+        cell_id text, version_id text, cell_data text)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS nb_configs (time integer,
+        nb_name text, cell_order text, version_order text)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS janus_log (time integer,
+        nb_name text, name text, id text, ids text)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS comments (time integer,
+        comment text, nb_name text)''')
+
+    # TODO actual data blob will be removed, currently string is inserted (in case table insertion changes)
+    c.execute('''CREATE TABLE IF NOT EXISTS cleaned_cells (time integer,
+        cell_id text, version_id text, cell_data text, meta_data text,
+        line_count integer, function_count integer, cell_count integer,
+        lines_of_code integer, words_of_markdown integer, output_count integer, types text)''')
+
+
+def add_cell_fingerprints(c):
+    """
+    Add fingerprint column to the cells table. Old versions are fingerprinted
+    once, by normalize_cell_fingerprints, as their outputs are needed
+
+    c: (obj) cursor of the database connection
+    """
+
+    # add the column if this database predates cell fingerprints
+    columns = [col[1] for col in c.execute('PRAGMA table_info(cells)')]
+    if 'fingerprint' not in columns:
+        c.execute('ALTER TABLE cells ADD COLUMN fingerprint text')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS cells_fingerprint
+        ON cells (cell_id, fingerprint)''')
+
+
+def add_query_indexes(c):
+    """
+    Index the columns we search cells and notebook configurations by
+
+    c: (obj) cursor of the database connection
+    """
+
+    # cell histories and the last version of a cell
+    c.execute('''CREATE INDEX IF NOT EXISTS cells_cell_time
+        ON cells (cell_id, time)''')
+
+    # particular cell versions
+    c.execute('''CREATE INDEX IF NOT EXISTS cells_version
+        ON cells (version_id)''')
+
+    # notebook configurations within a time range, and the last configuration
+    c.execute('''CREATE INDEX IF NOT EXISTS nb_configs_nb_time
+        ON nb_configs (nb_name, time)''')
+
+
+def enable_wal(c):
+    """
+    Use a write-ahead log so reads are not blocked while we commit new data
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('PRAGMA journal_mode = WAL')
+
+
+def add_output_store(c):
+    """
+    Move cell outputs into a table of compressed outputs keyed by their hash,
+    so versions with the same outputs share a single copy
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS outputs (hash text PRIMARY KEY,
+        data blob)''')
+
+    # cells with output_refs hold hashes of their outputs, older cells with
+    # no output_refs still hold their outputs inline
+    columns = [col[1] for col in c.execute('PRAGMA table_info(cells)')]
+    if 'output_refs' not in columns:
+        c.execute('ALTER TABLE cells ADD COLUMN output_refs text')
+
+    # move outputs of old versions in chunks so we don't load the whole table
+    last_rowid = 0
+    while True:
+        c.execute('''SELECT rowid, cell_data FROM cells
+            WHERE rowid > ? AND output_refs IS NULL ORDER BY rowid LIMIT 500''',
+            (last_rowid,))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+        for r in rows:
+            cell_data, refs, blobs = split_outputs(pickle.loads(r[1]))
+            if refs is None:
+                continue
+            c.executemany('INSERT OR IGNORE INTO outputs (hash, data) VALUES (?,?)',
+                            blobs.items())
+            c.execute('''UPDATE cells SET cell_data = ?, output_refs = ?
+                WHERE rowid = ?''', (pickle.dumps(cell_data), json.dumps(refs), r[0]))
+        last_rowid = rows[-1][0]
+
+
+def encode_nb_configs(c):
+    """
+    Re-encode notebook configurations stored as python lists into keyframes
+    and deltas, see janus_configs
+
+    c: (obj) cursor of the database connection
+    """
+
+    columns = [col[1] for col in c.execute('PRAGMA table_info(nb_configs)')]
+    if 'keyframe' not in columns:
+        c.execute('ALTER TABLE nb_configs ADD COLUMN keyframe integer')
+
+    # re-encode each notebook's configurations in order
+    c.execute('SELECT DISTINCT nb_name FROM nb_configs WHERE keyframe IS NULL')
+    nb_names = [r[0] for r in c.fetchall()]
+    read_cursor = c.connection.cursor()
+    for nb_name in nb_names:
+        read_cursor.execute('''SELECT rowid, cell_order, version_order
+            FROM nb_configs WHERE nb_name = ? ORDER BY rowid''', (nb_name,))
+        previous = None
+        since_keyframe = 0
+        updates = []
+        for r in read_cursor:
+            cell_order = ast.literal_eval(r[1])
+            version_order = ast.literal_eval(r[2])
+            if since_keyframe >= KEYFRAME_INTERVAL - 1:
+                previous = None
+            encoded = encode_config(previous, cell_order, version_order)
+            since_keyframe = 0 if encoded[2] else since_keyframe + 1
+            updates.append(encoded + (r[0],))
+            previous = (cell_order, version_order)
+        c.executemany('''UPDATE nb_configs SET cell_order = ?, version_order = ?,
+            keyframe = ? WHERE rowid = ?''', updates)
+
+    # find the keyframe a configuration is encoded against
+    c.execute('''CREATE INDEX IF NOT EXISTS nb_configs_keyframes
+        ON nb_configs (nb_name, keyframe)''')
+
+
+def add_version_summaries(c):
+    """
+    Record whether each cell version has any source or outputs, so version
+    markers can be listed without loading every version's content
+
+    c: (obj) cursor of the database connection
+    """
+
+    columns = [col[1] for col in c.execute('PRAGMA table_info(cells)')]
+    if 'has_content' not in columns:
+        c.execute('ALTER TABLE cells ADD COLUMN has_content integer')
+
+    # fill in old versions in chunks so we don't load the whole table,
+    # walking it in rowid order so each chunk starts where the last ended
+    last_rowid = 0
+    while True:
+        c.execute('''SELECT rowid, cell_data, output_refs FROM cells WHERE rowid > ?
+            AND has_content IS NULL ORDER BY rowid LIMIT 1000''', (last_rowid,))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+        last_rowid = rows[-1][0]
+        updates = []
+        for r in rows:
+            cell_data = pickle.loads(r[1])
+            if r[2] is not None:
+                cell_data['outputs'] = json.loads(r[2])
+            updates.append((cell_has_content(cell_data), r[0]))
+        c.executemany('UPDATE cells SET has_content = ? WHERE rowid = ?', updates)
+
+    # list a cell's versions from the index alone, without reading cell data
+    c.execute('''CREATE INDEX IF NOT EXISTS cells_summary
+        ON cells (cell_id, time, version_id, has_content)''')
+
+
+def add_export_state(c):
+    """
+    Remember the last cell version copied into the cleaned_cells table, so
+    exports only summarize versions recorded since the previous export
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS export_state (name text PRIMARY KEY,
+        last_rowid integer)''')
+
+    # earlier exports copied every version each time, so keep one copy of
+    # each and carry on from the last version already exported
+    c.execute('''DELETE FROM cleaned_cells WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM cleaned_cells GROUP BY version_id)''')
+    c.execute('''INSERT OR IGNORE INTO export_state (name, last_rowid)
+        SELECT 'cleaned_cells', IFNULL(MAX(rowid), 0) FROM cells
+        WHERE version_id IN (SELECT version_id FROM cleaned_cells)''')
+
+
+def enable_incremental_vacuum(c):
+    """
+    Let space freed by deleting old history be returned to the file system a
+    few pages at a time, see janus_retention. New databases are created this
+    way, see migrate. An existing database only switches once it is vacuumed,
+    which rewrites the whole file, so is left to the vacuum command of
+    janus_retention rather than run as the server starts, so there is
+    nothing to change here
+
+    c: (obj) cursor of the database connection
+    """
+
+    pass
+
+
+def normalize_cell_fingerprints(c):
+    """
+    Fingerprint old versions so they ignore volatile output details, and new
+    runs of unchanged cells match them. Versions fingerprinted before
+    fingerprints were normalized are fingerprinted again
+
+    c: (obj) cursor of the database connection
+    """
+
+    # walk the table in rowid order, in chunks so we don't load all of it
+    last_rowid = 0
+    while True:
+        c.execute('''SELECT rowid, cell_data, output_refs FROM cells
+            WHERE rowid > ? ORDER BY rowid LIMIT 1000''', (last_rowid,))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+
+        refs = {r[0]: json.loads(r[2]) for r in rows if r[2] is not None}
+        hashes = list(set(h for row_refs in refs.values() for h in row_refs))
+        outputs = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            c.execute('SELECT hash, data FROM outputs WHERE hash IN (%s)'
+                        % ','.join('?' * len(chunk)), chunk)
+            for h, data in c.fetchall():
+                outputs[h] = decompress_output(data)
+
+        updates = []
+        for r in rows:
+            cell_data = join_outputs(pickle.loads(r[1]), refs.get(r[0]), outputs)
+            updates.append((cell_fingerprint(cell_data), r[0]))
+        c.executemany('UPDATE cells SET fingerprint = ? WHERE rowid = ?', updates)
+        last_rowid = rows[-1][0]
+
+
+def add_journal_state(c):
+    """
+    Remember the sequence number of the last journaled record committed, so
+    records are replayed from the journal exactly once, see janus_journal
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS journal_state (name text PRIMARY KEY,
+        last_seq integer)''')
+
+
+def add_source_deltas(c):
+    """
+    Let the source of a cell version be stored as a delta against an earlier
+    version of the cell, see janus_sources. Versions already recorded keep
+    their full source
+
+    c: (obj) cursor of the database connection
+    """
+
+    columns = [col[1] for col in c.execute('PRAGMA table_info(cells)')]
+    if 'source_base' not in columns:
+        c.execute('ALTER TABLE cells ADD COLUMN source_base text')
+    if 'source_delta' not in columns:
+        c.execute('ALTER TABLE cells ADD COLUMN source_delta text')
+
+
+def add_search_index(c):
+    """
+    Create the full-text index of cell versions, and remember which versions
+    were recorded before it so they can be indexed in the background, see
+    janus_search. SQLite builds without FTS5 go without search
+
+    c: (obj) cursor of the database connection
+    """
+
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS cells_search USING fts5(
+            source, outputs, nb_name UNINDEXED, cell_id UNINDEXED, version_id UNINDEXED,
+            time UNINDEXED)''')
+    except sqlite3.OperationalError:
+        return
+
+    c.execute('''INSERT OR IGNORE INTO export_state (name, last_rowid)
+        VALUES ('search_index', 0)''')
+    c.execute('''INSERT OR IGNORE INTO export_state (name, last_rowid)
+        SELECT 'search_index_end', IFNULL(MAX(rowid), 0) FROM cells''')
+
+
+def add_checkpoints(c):
+    """
+    Create the table of materialized keyframe configurations snapshots are
+    rebuilt from, see janus_snapshots. Checkpoints are made as keyframes are
+    recorded, and for older keyframes from a background thread, so none are
+    made here
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS nb_checkpoints (
+        config_rowid integer PRIMARY KEY, nb_name text, cells blob)''')
+
+
+def add_notebook_registry(c):
+    """
+    Create the registry of the paths each notebook has been saved under, so
+    history is found by a notebook's stable id however often it was renamed.
+    Each path with history is registered under an id of its own, the hashed
+    path, until clients merge the paths they remember into one notebook
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS notebook_paths (nb_id text,
+        nb_name text, start_time integer, end_time integer)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS notebook_paths_id
+        ON notebook_paths (nb_id, start_time)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS notebook_paths_name
+        ON notebook_paths (nb_name, end_time)''')
+    c.execute('''INSERT INTO notebook_paths (nb_id, nb_name, start_time,
+        end_time) SELECT nb_name, nb_name,
+        MIN(CAST(time AS integer)), NULL FROM nb_configs
+        WHERE nb_name NOT IN (SELECT nb_name FROM notebook_paths)
+        GROUP BY nb_name''')
+
+
+def add_search_state(c):
+    """
+    Keep how far the versions recorded before the search index existed have
+    been indexed in a table of its own, rather than with the progress of
+    exports
+
+    c: (obj) cursor of the database connection
+    """
+
+    c.execute('''CREATE TABLE IF NOT EXISTS search_state (indexed_rowid integer,
+        end_rowid integer)''')
+    if c.execute("SELECT name FROM sqlite_master WHERE name = 'cells_search'").fetchone():
+        c.execute('''INSERT INTO search_state (indexed_rowid, end_rowid)
+            SELECT IFNULL((SELECT last_rowid FROM export_state
+                WHERE name = 'search_index'), 0),
+            IFNULL((SELECT last_rowid FROM export_state
+                WHERE name = 'search_index_end'), 0)
+            WHERE NOT EXISTS (SELECT * FROM search_state)''')
+    c.execute('''DELETE FROM export_state
+        WHERE name IN ('search_index', 'search_index_end')''')
+
+
+def add_config_notebook_ids(c):
+    """
+    Record the stable id of the notebook each configuration belongs to, so a
+    notebook's history is found with one lookup of the (nb_id, time) index
+    however often it was renamed. Each registered path also keeps the id its
+    history is recorded under, which for a copy is the id of the notebook it
+    was copied from until the copy was made
+
+    c: (obj) cursor of the database connection
+    """
+
+    columns = [col[1] for col in c.execute('PRAGMA table_info(notebook_paths)')]
+    if 'config_id' not in columns:
+        c.execute('ALTER TABLE notebook_paths ADD COLUMN config_id text')
+    c.execute('UPDATE notebook_paths SET config_id = nb_id WHERE config_id IS NULL')
+
+    # tag configurations with the id registered for their path at the time
+    columns = [col[1] for col in c.execute('PRAGMA table_info(nb_configs)')]
+    if 'nb_id' not in columns:
+        c.execute('ALTER TABLE nb_configs ADD COLUMN nb_id text')
+    c.execute('''UPDATE nb_configs SET nb_id = (SELECT config_id FROM notebook_paths
+        WHERE notebook_paths.nb_name = nb_configs.nb_name
+        AND start_time <= nb_configs.time
+        AND (end_time IS NULL OR end_time >= nb_configs.time)
+        ORDER BY start_time DESC LIMIT 1) WHERE nb_id IS NULL''')
+    c.execute('''CREATE INDEX IF NOT EXISTS nb_configs_id
+        ON nb_configs (nb_id, time)''')
+
+
+# migrations in the order they are applied, the schema version of a database
+# is the number of migrations that have been applied to it
+MIGRATIONS = [
+    create_tables,
+    add_cell_fingerprints,
+    add_query_indexes,
+    enable_wal,
+    add_output_store,
+    encode_nb_configs,
+    add_version_summaries,
+    add_export_state,
+    enable_incremental_vacuum,
+    normalize_cell_fingerprints,
+    add_journal_state,
+    add_source_deltas,
+    add_search_index,
+    add_checkpoints,
+    add_notebook_registry,
+    add_search_state,
+    add_config_notebook_ids
+]
+
+
+def get_schema_version(conn):
+    """
+    Return the schema version of the database
+
+    conn: (obj) connection to the notebook history database
+    """
+
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Apply any migrations the database has not seen yet
+
+    conn: (obj) connection to the notebook history database
+    """
+
+    version = get_schema_version(conn)
+    c = conn.cursor()
+
+    # incremental vacuum can only be turned on before the first table is
+    # created, or by vacuuming the whole database later
+    if version == 0 and c.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0:
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    for migration in MIGRATIONS[version:]:
+        conn.commit()
+        migration(c)
+        version += 1
+        c.execute('PRAGMA user_version = %d' % version)
+        conn.commit()
@@ -0,0 +1,80 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Store cell outputs separately from cell versions, so many versions of a cell
+can share one compressed copy of the same (often large) output
+"""
+
+import json
+import zlib
+from hashlib import sha1
+
+def output_hash(output):
+    """
+    Return hash of an output's content, used as its key in the outputs table
+
+    output: (dict) JSON representation of a cell output
+    """
+
+    canonical = json.dumps(output, sort_keys=True)
+    return sha1(canonical.encode()).hexdigest()
+
+
+def compress_output(output):
+    """
+    Return compressed bytes of an output to store in the outputs table
+
+    output: (dict) JSON representation of a cell output
+    """
+
+    return zlib.compress(json.dumps(output).encode())
+
+
+def decompress_output(data):
+    """
+    Return output from compressed bytes stored in the outputs table
+
+    data: (bytes) compressed output, see compress_output
+    """
+
+    return json.loads(zlib.decompress(data).decode())
+
+
+def split_outputs(cell_data):
+    """
+    Split outputs from a cell. Return a copy of the cell without outputs, the
+    list of output hashes, and a dict of compressed outputs with hashes as keys.
+    Cells without outputs (e.g. markdown) are returned as-is with no hashes
+
+    cell_data: (obj) JSON representation of a cell
+    """
+
+    if 'outputs' not in cell_data:
+        return cell_data, None, {}
+
+    cell_copy = dict(cell_data)
+    outputs = cell_copy.pop('outputs')
+    refs = []
+    blobs = {}
+    for output in outputs:
+        h = output_hash(output)
+        refs.append(h)
+        if h not in blobs:
+            blobs[h] = compress_output(output)
+
+    return cell_copy, refs, blobs
+
+
+def join_outputs(cell_data, refs, outputs):
+    """
+    Put outputs back into a cell split with split_outputs
+
+    cell_data: (obj) JSON representation of a cell without outputs
+    refs: (list) hashes of the cell's outputs, or None if it has none stored
+    outputs: (dict) decompressed outputs with hashes as keys
+    """
+
+    if refs is not None:
+        cell_data['outputs'] = [outputs[h] for h in refs]
+    return cell_data
@@ -0,0 +1,405 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Thin out old notebook history so the database does not grow without bound
+
+Recent notebook configurations are all kept. Older ones are thinned to the
+last configuration of each hour, and the oldest to the last of each day.
+Cell versions and outputs no remaining configuration uses are then deleted.
+Retention is off unless the user sets a "retention" section in their Janus
+config, e.g. {"keep_all_days": 30, "hourly_days": 180}.
+
+Space freed in databases created before incremental vacuum was turned on is
+only returned to the file system once the database is rebuilt, with
+python -m janus.janus_retention nb_history.db --vacuum
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from janus.janus_configs import (encode_config, apply_delta,
+    KEYFRAME_INTERVAL)
+
+HOUR = 60 * 60 * 1000
+DAY = 24 * HOUR
+
+# number of notebook configurations read and rewritten at a time
+RETENTION_CHUNK_SIZE = 1000
+
+class RetentionPolicy(object):
+    def __init__(self, keep_all_days = 30, hourly_days = 180, log_days = None,
+                    interval_hours = 24, vacuum_pages = 1000, dry_run = False):
+        """
+        How long to keep each kind of notebook history
+
+        keep_all_days: (int) keep every configuration this many days
+        hourly_days: (int) then keep hourly snapshots until this many days
+            old, and daily snapshots after that
+        log_days: (int) days to keep actions and log entries, or None to keep
+            them forever
+        interval_hours: (int) hours between maintenance runs
+        vacuum_pages: (int) free pages to return to the file system at a time
+        dry_run: (bool) only report what maintenance runs would reclaim
+        """
+
+        self.keep_all_days = keep_all_days
+        self.hourly_days = max(hourly_days, keep_all_days)
+        self.log_days = log_days
+        self.interval_hours = interval_hours
+        self.vacuum_pages = vacuum_pages
+        self.dry_run = dry_run
+
+
+    def snapshot_bucket(self, t, now):
+        """
+        Return the hour or day a configuration is thinned to, or None if it is
+        recent enough to keep
+
+        t: (int) time of the configuration
+        now: (int) current time
+        """
+
+        age = now - int(t)
+        if age < self.keep_all_days * DAY:
+            return None
+        elif age < self.hourly_days * DAY:
+            return ('hour', int(t) // HOUR)
+        else:
+            return ('day', int(t) // DAY)
+
+
+def get_retention_policy(config):
+    """
+    Return RetentionPolicy the user set in their Janus config, or None if they
+    have not turned retention on
+
+    config: (dict) Janus settings, see janus_dir.get_janus_config
+    """
+
+    settings = config.get('retention')
+    if not isinstance(settings, dict):
+        return None
+    return RetentionPolicy(**settings)
+
+
+def thin_nb_configs(c, nb_name, policy, now, write = True):
+    """
+    Delete configurations of a notebook that are not the last of their
+    snapshot, and re-encode the remaining ones against each other. Return
+    (rowids of configurations deleted, version ids of remaining ones)
+
+    c: (obj) cursor of the database connection
+    nb_name: (str) hashed path to the notebook
+    policy: (obj) RetentionPolicy to apply
+    now: (int) current time
+    write: (bool) change the table, or only work out what would be deleted
+    """
+
+    deleted = []
+    live_versions = set()
+    updates = []
+    deletes = []
+
+    # state of the configuration we are deciding on, and of the last one kept
+    pending = None
+    kept = None
+    since_keyframe = 0
+    cell_order = None
+    version_order = None
+
+    last_rowid = 0
+    while True:
+        c.execute('''SELECT rowid, time, cell_order, version_order, keyframe
+            FROM nb_configs WHERE nb_name = ? AND rowid > ?
+            ORDER BY rowid LIMIT ?''', (nb_name, last_rowid, RETENTION_CHUNK_SIZE))
+        rows = c.fetchall()
+
+        for r in rows + ([None] if len(rows) < RETENTION_CHUNK_SIZE else []):
+
+            # decode the next configuration
+            if r is not None:
+                if r[4]:
+                    cell_order = json.loads(r[2])
+                    version_order = json.loads(r[3])
+                else:
+                    cell_order = apply_delta(cell_order, r[2])
+                    version_order = apply_delta(version_order, r[3])
+                current = (r[0], r[1], cell_order, version_order,
+                            policy.snapshot_bucket(r[1], now))
+            else:
+                current = None
+
+            # a configuration is kept unless the next one is in its snapshot
+            if pending is not None:
+                bucket = pending[4]
+                if (bucket is not None and current is not None
+                        and current[4] == bucket):
+                    deletes.append((pending[0],))
+                    deleted.append(pending[0])
+                else:
+                    if since_keyframe >= KEYFRAME_INTERVAL - 1:
+                        kept = None
+                    encoded = encode_config(kept, pending[2], pending[3])
+                    since_keyframe = 0 if encoded[2] else since_keyframe + 1
+                    updates.append(encoded + (pending[0],))
+                    kept = (pending[2], pending[3])
+                    live_versions.update(pending[3])
+            pending = current
+
+        if write:
+            c.executemany('DELETE FROM nb_configs WHERE rowid = ?', deletes)
+            c.executemany('''UPDATE nb_configs SET cell_order = ?, version_order = ?,
+                keyframe = ? WHERE rowid = ?''', updates)
+        del deletes[:]
+        del updates[:]
+
+        if len(rows) < RETENTION_CHUNK_SIZE:
+            break
+        last_rowid = rows[-1][0]
+
+    return deleted, live_versions
+
+
+def mark_live_versions(c, live_versions, cutoff):
+    """
+    Fill the temporary live_versions table with the version ids of every
+    remaining configuration, and of every version the sources of kept
+    versions are stored against
+
+    c: (obj) cursor of the database connection
+    live_versions: (set) version ids of every remaining configuration
+    cutoff: (int) time versions are kept from whether used or not
+    """
+
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS live_versions (version_id text PRIMARY KEY)')
+    c.execute('DELETE FROM live_versions')
+    c.executemany('INSERT OR IGNORE INTO live_versions (version_id) VALUES (?)',
+                    [(v,) for v in live_versions])
+
+    c.execute('''INSERT OR IGNORE INTO live_versions (version_id)
+        WITH RECURSIVE bases(version_id) AS (
+            SELECT source_base FROM cells WHERE source_base IS NOT NULL
+                AND (time >= ? OR version_id IN (SELECT version_id FROM live_versions))
+            UNION
+            SELECT cells.source_base FROM cells JOIN bases
+                ON cells.version_id = bases.version_id
+                WHERE cells.source_base IS NOT NULL)
+        SELECT version_id FROM bases''', (cutoff,))
+
+
+def collect_garbage(c, live_versions, policy, now):
+    """
+    Delete cell versions older than the retention window that no remaining
+    configuration uses (or has its source stored against), outputs no cell
+    version uses, and old actions and log entries. Return dict of the number
+    of rows deleted from each table
+
+    c: (obj) cursor of the database connection
+    live_versions: (set) version ids of every remaining configuration
+    policy: (obj) RetentionPolicy to apply
+    now: (int) current time
+    """
+
+    report = {}
+    cutoff = now - policy.keep_all_days * DAY
+    mark_live_versions(c, live_versions, cutoff)
+
+    # along with their search index entries, which share their rowids
+    if c.execute('''SELECT name FROM sqlite_master
+            WHERE name = 'cells_search' ''').fetchone():
+        c.execute('''DELETE FROM cells_search WHERE rowid IN (
+            SELECT rowid FROM cells WHERE time < ? AND version_id NOT IN (
+            SELECT version_id FROM live_versions))''', (cutoff,))
+
+    c.execute('''DELETE FROM cells WHERE time < ? AND version_id NOT IN (
+        SELECT version_id FROM live_versions)''', (cutoff,))
+    report['cells'] = c.rowcount
+
+    # checkpoints of keyframes that were thinned away or are now deltas
+    c.execute('''DELETE FROM nb_checkpoints WHERE config_rowid NOT IN (
+        SELECT rowid FROM nb_configs WHERE keyframe = 1)''')
+    report['nb_checkpoints'] = c.rowcount
+
+    c.execute('''DELETE FROM outputs WHERE hash NOT IN (
+        SELECT json_each.value FROM cells, json_each(cells.output_refs)
+        WHERE cells.output_refs IS NOT NULL)''')
+    report['outputs'] = c.rowcount
+
+    if policy.log_days is not None:
+        log_cutoff = now - policy.log_days * DAY
+        c.execute('DELETE FROM actions WHERE CAST(time AS integer) < ?', (log_cutoff,))
+        report['actions'] = c.rowcount
+        c.execute('DELETE FROM janus_log WHERE CAST(time AS integer) < ?', (log_cutoff,))
+        report['janus_log'] = c.rowcount
+
+    c.execute('DROP TABLE live_versions')
+    return report
+
+
+def count_garbage(c, thinned, live_versions, policy, now):
+    """
+    Return dict of the number of rows collect_garbage would delete from each
+    table, and an estimate of the bytes of history they hold, without
+    changing the database
+
+    c: (obj) cursor of the database connection
+    thinned: (list) rowids of configurations thin_nb_configs would delete
+    live_versions: (set) version ids of every remaining configuration
+    policy: (obj) RetentionPolicy to apply
+    now: (int) current time
+    """
+
+    cutoff = now - policy.keep_all_days * DAY
+    mark_live_versions(c, live_versions, cutoff)
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS thinned_configs (config_rowid integer PRIMARY KEY)')
+    c.execute('DELETE FROM thinned_configs')
+    c.executemany('INSERT INTO thinned_configs (config_rowid) VALUES (?)',
+                    [(rowid,) for rowid in thinned])
+
+    report = {'nb_configs': len(thinned)}
+    num_bytes = c.execute('''SELECT IFNULL(SUM(LENGTH(cell_order) +
+        LENGTH(version_order)), 0) FROM nb_configs WHERE rowid IN (
+        SELECT config_rowid FROM thinned_configs)''').fetchone()[0]
+
+    counts = c.execute('''SELECT COUNT(*), IFNULL(SUM(LENGTH(cell_data) +
+        IFNULL(LENGTH(source_delta), 0)), 0) FROM cells WHERE time < ?
+        AND version_id NOT IN (SELECT version_id FROM live_versions)''',
+        (cutoff,)).fetchone()
+    report['cells'] = counts[0]
+    num_bytes += counts[1]
+
+    counts = c.execute('''SELECT COUNT(*), IFNULL(SUM(LENGTH(cells)), 0)
+        FROM nb_checkpoints WHERE config_rowid IN (
+        SELECT config_rowid FROM thinned_configs)''').fetchone()
+    report['nb_checkpoints'] = counts[0]
+    num_bytes += counts[1]
+
+    # outputs only the deleted versions use
+    counts = c.execute('''SELECT COUNT(*), IFNULL(SUM(LENGTH(data)), 0)
+        FROM outputs WHERE hash NOT IN (
+        SELECT json_each.value FROM cells, json_each(cells.output_refs)
+        WHERE cells.output_refs IS NOT NULL AND (time >= ? OR version_id IN (
+            SELECT version_id FROM live_versions)))''', (cutoff,)).fetchone()
+    report['outputs'] = counts[0]
+    num_bytes += counts[1]
+
+    if policy.log_days is not None:
+        log_cutoff = now - policy.log_days * DAY
+        for table in ('actions', 'janus_log'):
+            report[table] = c.execute('''SELECT COUNT(*) FROM %s
+                WHERE CAST(time AS integer) < ?''' % table, (log_cutoff,)).fetchone()[0]
+
+    c.execute('DROP TABLE live_versions')
+    c.execute('DROP TABLE thinned_configs')
+    report['bytes_reclaimed'] = num_bytes
+    return report
+
+
+def retention_report(conn, policy, now, queued_versions = ()):
+    """
+    Return dict reporting what applying a retention policy would delete and
+    about how many bytes it would reclaim, reading the database in a single
+    transaction that is never written to
+
+    conn: (obj) connection to the notebook history database, which may be
+        read only
+    policy: (obj) RetentionPolicy to apply
+    now: (int) current time
+    queued_versions: (set) version ids of configurations not committed yet,
+        which keep the versions they use
+    """
+
+    c = conn.cursor()
+    c.execute('BEGIN')
+    try:
+        c.execute('SELECT DISTINCT nb_name FROM nb_configs')
+        nb_names = [r[0] for r in c.fetchall()]
+        thinned = []
+        live_versions = set(queued_versions)
+        for nb_name in nb_names:
+            deleted, live = thin_nb_configs(c, nb_name, policy, now, False)
+            thinned.extend(deleted)
+            live_versions.update(live)
+        report = count_garbage(c, thinned, live_versions, policy, now)
+    finally:
+        conn.rollback()
+    report['dry_run'] = True
+    return report
+
+
+def config_versions(rows):
+    """
+    Return set of every version id encoded configurations add, whether in a
+    keyframe or a delta
+
+    rows: (list) (time, nb_name, cell_order, version_order, keyframe) rows
+        of the nb_configs table
+    """
+
+    versions = set()
+    for r in rows:
+        if r[4]:
+            versions.update(json.loads(r[3]))
+        else:
+            versions.update(json.loads(r[3])[2])
+    return versions
+
+
+def free_bytes(c):
+    """
+    Return bytes of free pages in the database file
+
+    c: (obj) cursor of the database connection
+    """
+
+    free_pages = c.execute('PRAGMA freelist_count').fetchone()[0]
+    page_size = c.execute('PRAGMA page_size').fetchone()[0]
+    return free_pages * page_size
+
+
+def current_time():
+    """
+    Return current time in milliseconds, as notebook times are recorded
+    """
+
+    return int(time.time() * 1000)
+
+
+def vacuum_database(db_path):
+    """
+    Rebuild a database file, returning every free page to the file system,
+    and let later maintenance runs free pages a few at a time. Return bytes
+    the file shrank by. Nothing else can use the database while it is
+    rebuilt, which takes a while for a large one, so stop the notebook
+    server first
+
+    db_path: (str) full path to the notebook history database
+    """
+
+    start_size = os.path.getsize(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return start_size - os.path.getsize(db_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Maintain a Janus notebook history database')
+    parser.add_argument('db_path', help='path to nb_history.db, or a shard')
+    parser.add_argument('--vacuum', action='store_true',
+        help='rebuild the database to free space, with the notebook server stopped')
+    args = parser.parse_args()
+
+    if args.vacuum:
+        print('%d bytes freed' % vacuum_database(args.db_path))
+    else:
+        parser.print_help()
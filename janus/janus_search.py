@@ -0,0 +1,76 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Search the source and text outputs of every cell version
+
+Each cell version gets a row in the cells_search full-text index (an SQLite
+FTS5 table sharing rowids with the cells table) when it is committed, with
+the hashed path of the notebook it was recorded in. Searches match words in
+sources and outputs, then filter matches by notebook and time. Versions
+recorded before the index existed are indexed in the background, see
+DbManager.index_history. Text outputs are only indexed if the user sets
+"search_outputs" in their Janus config.
+"""
+
+# most characters of a version's text outputs to index
+MAX_OUTPUT_CHARS = 10000
+
+# words of context around matches in search result snippets
+SNIPPET_TOKENS = 12
+
+def searchable_text(cell, index_outputs = False):
+    """
+    Return (source, text of outputs) of a cell to put in the search index
+
+    cell: (obj) JSON representation of the cell
+    index_outputs: (bool) whether to include text outputs, or leave them out
+    """
+
+    source = cell.get('source', '')
+    if isinstance(source, list):
+        source = ''.join(source)
+    if not index_outputs:
+        return source, ''
+
+    texts = []
+    for output in cell.get('outputs', []):
+        if 'text' in output:
+            texts.append(output['text'])
+        elif 'evalue' in output:
+            texts.append(output['evalue'])
+        elif 'text/plain' in output.get('data', {}):
+            texts.append(output['data']['text/plain'])
+    texts = [''.join(t) if isinstance(t, list) else str(t) for t in texts]
+    return source, '\n'.join(texts)[:MAX_OUTPUT_CHARS]
+
+
+def quote_term(term):
+    """
+    Return a word of a search as an FTS5 string, so punctuation in it is
+    searched for rather than read as query syntax
+
+    term: (str) word to quote
+    """
+
+    return '"%s"' % term.replace('"', '""')
+
+
+def match_expression(query):
+    """
+    Return FTS5 MATCH expression finding versions containing every word of a
+    search, or None if the search has no words
+
+    query: (str) words to search for, a trailing * matches any word starting
+        with the rest
+    """
+
+    terms = []
+    for word in query.split():
+        if word.endswith('*') and len(word) > 1:
+            terms.append(quote_term(word.rstrip('*')) + '*')
+        elif word.strip('*'):
+            terms.append(quote_term(word))
+    if len(terms) == 0:
+        return None
+    return '{source outputs} : (%s)' % ' AND '.join(terms)
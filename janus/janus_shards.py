@@ -0,0 +1,780 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Store each notebook's history in its own database file
+
+On servers shared by many users, one database for every notebook means
+concurrent writers wait on each other and one large notebook slows down
+queries for everyone. With sharding turned on ("sharding": true in the Janus
+config) each hashed notebook path gets its own shard file, opened when first
+used, with at most max_open_shards open at once. Comments stay in the main
+database. Run `python -m janus.janus_shards <path to nb_history.db>` to split
+an existing database into shards.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from janus.janus_sqlite import (DbManager, get_db_manager, INSERT_ACTION,
+    INSERT_CELL, INSERT_NB_CONFIG, INSERT_LOG, INSERT_OUTPUT)
+from janus.janus_migrations import migrate
+from janus.janus_configs import decode_configs
+from janus.janus_snapshots import notebook_header
+from janus.janus_retention import retention_report, current_time
+
+# shared sharded managers, one for each storage directory
+_sharded_managers = {}
+_sharded_managers_lock = threading.Lock()
+
+def get_sharded_db_manager(storage_dir, **settings):
+    """
+    Return the ShardedDbManager shared by every request storing history in a
+    particular directory
+
+    storage_dir: (str) directory holding the main database and shards
+    settings: (dict) ShardedDbManager settings, used when it is first created
+    """
+
+    with _sharded_managers_lock:
+        if storage_dir not in _sharded_managers:
+            _sharded_managers[storage_dir] = ShardedDbManager(storage_dir, **settings)
+        return _sharded_managers[storage_dir]
+
+
+def shard_dir(storage_dir):
+    """
+    Return directory holding the shard of each notebook
+
+    storage_dir: (str) directory holding the main database
+    """
+
+    return os.path.join(storage_dir, 'shards')
+
+
+def shard_path(storage_dir, nb_name):
+    """
+    Return path to the shard storing a notebook's history
+
+    storage_dir: (str) directory holding the main database
+    nb_name: (str) hashed path to the notebook
+    """
+
+    # hashed paths come from clients, so make sure they are only a hash
+    if not is_shard_name(nb_name):
+        raise ValueError('not a hashed notebook path: %r' % (nb_name,))
+    return os.path.join(shard_dir(storage_dir), nb_name + '.db')
+
+
+def is_shard_name(nb_name):
+    """
+    Return whether a string is a hashed notebook path, see janus_dir.hash_path
+
+    nb_name: (str) hashed path to the notebook
+    """
+
+    return isinstance(nb_name, str) and re.match(r'^[0-9a-f]+$', nb_name) is not None
+
+
+class ShardedDbManager(object):
+    def __init__(self, storage_dir, max_open_shards = 16,
+                    version_cache_bytes = 64 * 1024 * 1024, **settings):
+        """
+        Routes history of each notebook to its own DbManager, with the same
+        query surface as a single DbManager
+
+        storage_dir: (str) directory holding the main database and shards
+        max_open_shards: (int) most shards to keep open when they are idle
+        version_cache_bytes: (int) bytes of decoded versions to cache, split
+            evenly between open shards
+        settings: (dict) other DbManager settings used for every shard
+        """
+
+        self.storage_dir = storage_dir
+        self.max_open_shards = max_open_shards
+        self.settings = dict(settings)
+        self.settings['version_cache_bytes'] = version_cache_bytes // max_open_shards
+
+        # comments are about Janus rather than any one notebook
+        self.main = get_db_manager(os.path.join(storage_dir, 'nb_history.db'),
+                                    **self.settings)
+
+        # open shards, least recently used first, and how many requests are
+        # using each of them
+        self.shards = OrderedDict()
+        self.users = {}
+        self.lock = threading.Lock()
+
+        # lock of each shard being opened, so it is only opened once
+        self.opening = {}
+
+        # which shard is running each export
+        self.export_shards = {}
+
+        if not os.path.isdir(shard_dir(storage_dir)):
+            os.makedirs(shard_dir(storage_dir))
+        atexit.register(self.close)
+
+
+    @contextmanager
+    def shard(self, nb_name):
+        """
+        Context manager giving the DbManager of a notebook's shard, which is
+        not closed while in use
+
+        nb_name: (str) hashed path to the notebook
+        """
+
+        db = self.open_shard(nb_name)
+        evicted = []
+        with self.lock:
+
+            # close the least recently used idle shards over the limit
+            for name in list(self.shards):
+                if len(self.shards) - len(evicted) <= self.max_open_shards:
+                    break
+                if self.users.get(name, 0) == 0 and not self.is_exporting(name):
+                    evicted.append(self.shards.pop(name))
+
+        try:
+            for old_db in evicted:
+                old_db.close()
+                atexit.unregister(old_db.close)
+            yield db
+        finally:
+            with self.lock:
+                self.users[nb_name] -= 1
+                if self.users[nb_name] == 0:
+                    del self.users[nb_name]
+
+
+    def open_shard(self, nb_name):
+        """
+        Return the DbManager of a notebook's shard, counting the caller as
+        using it. A shard that is not open is opened without holding the lock,
+        as migrating it and replaying its journal can take a while, and by
+        one thread at a time
+
+        nb_name: (str) hashed path to the notebook
+        """
+
+        with self.lock:
+            if nb_name in self.shards:
+                return self.use_shard(nb_name)
+            opening = self.opening.setdefault(nb_name, threading.Lock())
+
+        with opening:
+            with self.lock:
+                if nb_name in self.shards:
+                    return self.use_shard(nb_name)
+            try:
+                db = DbManager(shard_path(self.storage_dir, nb_name), **self.settings)
+                with self.lock:
+                    self.shards[nb_name] = db
+                    return self.use_shard(nb_name)
+            finally:
+                with self.lock:
+                    self.opening.pop(nb_name, None)
+
+
+    def use_shard(self, nb_name):
+        """
+        Return the DbManager of an open shard, counting the caller as using
+        it, must be called while holding the lock
+
+        nb_name: (str) hashed path to the notebook
+        """
+
+        self.shards.move_to_end(nb_name)
+        self.users[nb_name] = self.users.get(nb_name, 0) + 1
+        return self.shards[nb_name]
+
+
+    def is_exporting(self, nb_name):
+        """
+        Return whether a shard is running an export, so must stay open
+
+        nb_name: (str) hashed path to the notebook
+        """
+
+        db = self.shards.get(nb_name)
+        return (db is not None and db.export_job is not None
+                and db.export_job.is_running())
+
+
+    def shard_names(self):
+        """
+        Return hashed paths of every notebook with a shard
+        """
+
+        names = [f[:-3] for f in os.listdir(shard_dir(self.storage_dir))
+                    if f.endswith('.db')]
+        return sorted(names)
+
+
+    def has_shard(self, nb_name):
+        """
+        Return whether a notebook has a shard, so reading its history does not
+        create one
+
+        nb_name: (str) hashed path to the notebook
+        """
+
+        if not is_shard_name(nb_name):
+            return False
+        with self.lock:
+            if nb_name in self.shards:
+                return True
+        return os.path.exists(shard_path(self.storage_dir, nb_name))
+
+
+    def group_paths(self, paths):
+        """
+        Return dict of paths with the shard storing them as keys, leaving out
+        paths with no shard, which have no history to read
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        """
+
+        # shards do not hold the notebook registry, so their history is found
+        # by path, each shard holding a single one
+        groups = OrderedDict()
+        for p in paths:
+            if p[0] in groups or self.has_shard(p[0]):
+                groups.setdefault(p[0], []).append(list(p[:3]))
+        return groups
+
+
+    def record_action(self, action_data, hashed_path):
+        """
+        Save action to the notebook's shard, see DbManager.record_action
+        """
+
+        with self.shard(hashed_path) as db:
+            return db.record_action(action_data, hashed_path)
+
+
+    def record_action_batch(self, state_data, actions, hashed_path):
+        """
+        Save several actions to the notebook's shard, see
+        DbManager.record_action_batch
+        """
+
+        with self.shard(hashed_path) as db:
+            return db.record_action_batch(state_data, actions, hashed_path)
+
+
+    def record_log(self, log_data, nb_name):
+        """
+        Save log entry to the notebook's shard
+        """
+
+        with self.shard(nb_name) as db:
+            db.record_log(log_data, nb_name)
+
+
+    def record_comment(self, comment_data, nb_name):
+        """
+        Save comment to the main database
+        """
+
+        self.main.record_comment(comment_data, nb_name)
+
+
+    def get_comments(self):
+        """
+        Return a list of all comments
+        """
+
+        return self.main.get_comments()
+
+
+    def register_notebook(self, nb_id, nb_name, t, filepaths = None,
+                            path_exists = None):
+        """
+        Return the stable id of the notebook saved at a path, keeping the
+        registry of every notebook's paths in the main database, see
+        DbManager.register_notebook
+        """
+
+        return self.main.register_notebook(nb_id, nb_name, t, filepaths,
+                                            path_exists)
+
+
+    def get_notebook_paths(self, nb_id):
+        """
+        Return list of [hashed_path, start_time, end_time, config_id] of every
+        path a notebook has been saved under, see DbManager.get_notebook_paths
+        """
+
+        return self.main.get_notebook_paths(nb_id)
+
+
+    def get_nb_configs(self, paths):
+        """
+        Return time-sorted list of all prior nb configurations under any of
+        the notebook's paths, from each path's shard
+        """
+
+        configs = []
+        for nb_name, nb_paths in self.group_paths(paths).items():
+            with self.shard(nb_name) as db:
+                configs += db.get_nb_configs(nb_paths)
+        configs.sort(key=lambda x: int(x[0]))
+        return configs
+
+
+    def get_nb_config_page(self, paths, before=None, limit=100):
+        """
+        Return dict with a time-sorted page of the newest nb configurations
+        older than a cursor, see DbManager.get_nb_config_page. Configurations
+        are ordered by (time, shard, rowid), and cursors are [time, shard,
+        rowid] of the oldest configuration already seen
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        before: (list) cursor returned with the previous page, or None for the
+            newest page
+        limit: (int) maximum number of configurations in the page
+        """
+
+        rows = []
+        total = 0
+        for nb_name, nb_paths in self.group_paths(paths).items():
+
+            # translate the cursor into one for this shard
+            shard_before = None
+            if before is not None:
+                if nb_name < before[1]:
+                    shard_before = [before[0], float('inf')]
+                elif nb_name == before[1]:
+                    shard_before = [before[0], before[2]]
+                else:
+                    shard_before = [before[0], 0]
+
+            with self.shard(nb_name) as db:
+                page, shard_total = db.get_nb_config_rows(nb_paths, shard_before,
+                                                            limit)
+            rows += [(c[1], nb_name, c[0], c[1:]) for c in page]
+            total += shard_total
+
+        rows.sort(key=lambda r: r[:3])
+        rows = rows[-limit:] if limit > 0 else []
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = list(rows[0][:3])
+
+        return {
+            'nb_configs': [r[3] for r in rows],
+            'before': next_cursor,
+            'total': total
+        }
+
+
+    def get_cell_history(self, paths, cell_id):
+        """
+        Return time-sorted list of all versions of this cell, from the shard
+        of each of the notebook's paths
+        """
+
+        versions = []
+        for nb_name, nb_paths in self.group_paths(paths).items():
+            with self.shard(nb_name) as db:
+                versions += db.get_cell_history(nb_paths, cell_id)
+        versions.sort(key=lambda v: int(v['time']))
+        return versions
+
+
+    def get_cell_history_state(self, paths, cell_id):
+        """
+        Return state of the cell's history in each shard, see
+        DbManager.get_cell_history_state
+        """
+
+        state = []
+        for nb_name, nb_paths in self.group_paths(paths).items():
+            with self.shard(nb_name) as db:
+                state.append([nb_name, db.get_cell_history_state(nb_paths, cell_id)])
+        return state
+
+
+    def get_version_summaries(self, paths, cell_ids, nb_name):
+        """
+        Return dict of time-sorted version summaries with cell_id as keys,
+        from the shard of each of the notebook's paths
+        """
+
+        summaries = {}
+        for shard_name, nb_paths in self.group_paths(paths).items():
+            with self.shard(shard_name) as db:
+                shard_summaries = db.get_version_summaries(nb_paths, cell_ids,
+                                                            nb_name)
+            for cell_id, versions in shard_summaries.items():
+                summaries.setdefault(cell_id, []).extend(versions)
+
+        # only the notebook's own shard knows which versions are current
+        last_config = None
+        if self.has_shard(nb_name):
+            with self.shard(nb_name) as db:
+                last_config = db.get_last_nb_config(nb_name)
+        current = set(last_config[3]) if last_config else set()
+        for versions in summaries.values():
+            versions.sort(key=lambda v: int(v['time']))
+            for v in versions:
+                v['is_current'] = v['version_id'] in current
+        return summaries
+
+
+    def get_versions(self, version_ids, paths=None):
+        """
+        Return dict of particular cell versions with version_id as keys,
+        looking in the shards of the notebook's paths, versions in no other
+        shard are left out rather than looked for in every shard
+
+        version_ids: (list) unique cell version identifiers
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        """
+
+        cells = {}
+        for nb_name in self.group_paths(paths or []):
+            missing = [v for v in version_ids if v not in cells]
+            if len(missing) == 0:
+                break
+            with self.shard(nb_name) as db:
+                cells.update(db.get_versions(missing))
+        return cells
+
+
+    def get_version_diff(self, from_id, to_id, paths=None):
+        """
+        Return dict with the line diff between two cell versions, looking in
+        the shards of the notebook's paths, or None if neither has them, see
+        DbManager.get_version_diff
+
+        from_id: (str) unique cell version identifier to diff from
+        to_id: (str) unique cell version identifier to diff to
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        """
+
+        for nb_name in self.group_paths(paths or []):
+            with self.shard(nb_name) as db:
+                diff = db.get_version_diff(from_id, to_id)
+            if diff is not None:
+                return diff
+        return None
+
+
+    def search(self, query, paths = None, since = None, until = None, limit = 50):
+        """
+        Return best matching list of dicts of committed cell versions
+        containing every word of a search, from the shards of the notebook's
+        paths, or every shard if paths is None, see DbManager.search
+        """
+
+        shard_names = list(self.group_paths(paths or [])) or self.shard_names()
+        results = []
+        for nb_name in shard_names:
+            with self.shard(nb_name) as db:
+                results.extend(db.search(query, paths, since, until, limit))
+
+        # lower bm25 ranks are better matches
+        results.sort(key=lambda r: r['score'])
+        return results[:limit]
+
+
+    def find_snapshot(self, paths, at = None, index = None):
+        """
+        Return the configuration shown at a time or position in the notebook's
+        history, counting configurations in the shards of all its paths, see
+        DbManager.find_snapshot
+        """
+
+        # a renamed notebook's paths cover separate stretches of time, so its
+        # shards hold consecutive parts of its history
+        groups = sorted(self.group_paths(paths).items(),
+                        key=lambda g: min(int(p[1]) for p in g[1]))
+        totals = []
+        for nb_name, group in groups:
+            with self.shard(nb_name) as db:
+                totals.append(db.count_nb_configs(group))
+
+        found = None
+        offset = 0
+        for (nb_name, group), total in zip(groups, totals):
+            if at is not None or index is None:
+                with self.shard(nb_name) as db:
+                    snapshot = db.find_snapshot(group, at)
+                if snapshot is not None and (found is None
+                        or int(snapshot['time']) >= int(found['time'])):
+                    found = dict(snapshot, index=snapshot['index'] + offset)
+            elif offset <= int(index) < offset + total:
+                with self.shard(nb_name) as db:
+                    found = db.find_snapshot(group, index=int(index) - offset)
+                if found is not None:
+                    found['index'] = int(index)
+            offset += total
+
+        if found is not None:
+            found['total'] = offset
+        return found
+
+
+    def get_snapshot_cells(self, snapshot, version_ids):
+        """
+        Return list of the cell versions of a snapshot from the shard it was
+        found in, see DbManager.get_snapshot_cells
+        """
+
+        with self.shard(snapshot['nb_name']) as db:
+            return db.get_snapshot_cells(snapshot, version_ids)
+
+
+    def get_snapshot(self, paths, at = None, index = None):
+        """
+        Return .ipynb shaped document of the notebook at a time or position in
+        its history, see DbManager.get_snapshot
+        """
+
+        snapshot = self.find_snapshot(paths, at, index)
+        if snapshot is None:
+            return None
+        document = notebook_header(snapshot)
+        document['cells'] = self.get_snapshot_cells(snapshot,
+                                                    snapshot['version_order'])
+        return document
+
+
+    def start_export(self, nb_name, drop_all = False):
+        """
+        Start exporting the notebook's shard in the background, see
+        DbManager.start_export
+        """
+
+        with self.shard(nb_name) as db:
+            job = db.start_export(nb_name, drop_all)
+        with self.lock:
+            self.export_shards[job.id] = nb_name
+        return job
+
+
+    def get_export_job(self, job_id):
+        """
+        Return ExportJob with a particular id, or None if there is no such job
+        """
+
+        with self.lock:
+            nb_name = self.export_shards.get(job_id)
+        if nb_name is None:
+            return None
+        with self.shard(nb_name) as db:
+            return db.get_export_job(job_id)
+
+
+    def run_maintenance(self, policy, dry_run = None):
+        """
+        Apply a retention policy to every shard, see DbManager.run_maintenance,
+        and return the sum of their reports
+
+        policy: (obj) janus_retention.RetentionPolicy to apply
+        dry_run: (bool) only report what would be reclaimed
+        """
+
+        if dry_run is None:
+            dry_run = policy.dry_run
+        if dry_run:
+            return self.retention_report(policy)
+
+        report = self.main.run_maintenance(policy, False)
+        for nb_name in self.shard_names():
+            with self.shard(nb_name) as db:
+                shard_report = db.run_maintenance(policy, False)
+            add_reports(report, shard_report)
+        return report
+
+
+    def retention_report(self, policy):
+        """
+        Return the sum of what applying a retention policy would delete from
+        every shard, see DbManager.retention_report. Shards that are not
+        open are read without opening them
+
+        policy: (obj) janus_retention.RetentionPolicy to apply
+        """
+
+        report = self.main.retention_report(policy)
+        now = current_time()
+        for nb_name in self.shard_names():
+            with self.lock:
+                db = self.shards.get(nb_name)
+            if db is not None and not db.closed:
+                shard_report = db.retention_report(policy)
+            else:
+                conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(
+                            shard_path(self.storage_dir, nb_name)), uri=True)
+                try:
+                    shard_report = retention_report(conn, policy, now)
+                finally:
+                    conn.close()
+            add_reports(report, shard_report)
+        return report
+
+
+    def flush(self):
+        """
+        Block until all data queued in open shards has been committed
+        """
+
+        with self.lock:
+            shards = list(self.shards.values())
+        for db in shards:
+            db.flush()
+        self.main.flush()
+
+
+    def close(self):
+        """
+        Close every open shard
+        """
+
+        with self.lock:
+            shards = list(self.shards.values())
+            self.shards.clear()
+        for db in shards:
+            db.close()
+
+
+def add_reports(report, shard_report):
+    """
+    Add the counts in a shard's maintenance report to a report of several
+
+    report: (dict) report to add to
+    shard_report: (dict) report of one shard
+    """
+
+    for key, value in shard_report.items():
+        if key != 'dry_run':
+            report[key] = report.get(key, 0) + value
+
+
+def split_database(db_path, storage_dir = None):
+    """
+    Copy the history of each notebook in a single database into its own
+    shard, skipping notebooks that already have one. Comments stay in the
+    original database, which is left otherwise unchanged, so it can be
+    removed by hand once the shards are checked.
+    Return dict of the number of configurations copied with nb_name as keys
+
+    db_path: (str) full path to the existing notebook history database
+    storage_dir: (str) directory to create shards in, defaults to the one
+        holding the database
+    """
+
+    if storage_dir is None:
+        storage_dir = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.isdir(shard_dir(storage_dir)):
+        os.makedirs(shard_dir(storage_dir))
+
+    # commit any records left in the journal by a crash before copying
+    DbManager(db_path).close()
+
+    source = sqlite3.connect(db_path)
+    migrate(source)
+    nb_names = [r[0] for r in source.execute('SELECT DISTINCT nb_name FROM nb_configs')]
+
+    copied = {}
+    for nb_name in nb_names:
+
+        # skip notebooks already split, so an interrupted split can be re-run
+        if os.path.exists(shard_path(storage_dir, nb_name)):
+            continue
+        shard = sqlite3.connect(shard_path(storage_dir, nb_name) + '.part')
+        migrate(shard)
+        c = shard.cursor()
+
+        # configurations are copied in order, so delta chains stay valid
+        rows = source.execute('''SELECT time, nb_name, cell_order, version_order,
+            keyframe FROM nb_configs WHERE nb_name = ? ORDER BY rowid''',
+            (nb_name,)).fetchall()
+        c.executemany(INSERT_NB_CONFIG, rows)
+
+        # with every cell version they use, and the outputs of those
+        version_ids = set()
+        for config in decode_configs(rows):
+            version_ids.update(config[3])
+        # along with the versions their sources are stored against
+        copied_versions = set()
+        version_ids = list(version_ids)
+        while len(version_ids) > 0:
+            chunk = version_ids[:500]
+            version_ids = version_ids[500:]
+            copied_versions.update(chunk)
+            placeholders = ','.join('?' * len(chunk))
+            cells = source.execute('''SELECT time, cell_id, version_id, cell_data,
+                fingerprint, output_refs, has_content, source_base, source_delta
+                FROM cells WHERE version_id IN (%s) ORDER BY rowid''' % placeholders,
+                tuple(chunk)).fetchall()
+            c.executemany(INSERT_CELL, cells)
+            bases = set(cell[7] for cell in cells if cell[7] is not None)
+            version_ids.extend(bases - copied_versions - set(version_ids))
+            hashes = set()
+            for cell in cells:
+                if cell[5] is not None:
+                    hashes.update(json.loads(cell[5]))
+            hashes = list(hashes)
+            for j in range(0, len(hashes), 500):
+                hash_chunk = hashes[j:j + 500]
+                placeholders = ','.join('?' * len(hash_chunk))
+                outputs = source.execute('''SELECT hash, data FROM outputs
+                    WHERE hash IN (%s)''' % placeholders, tuple(hash_chunk))
+                c.executemany(INSERT_OUTPUT, outputs)
+
+        # and the notebook's actions and log
+        c.executemany(INSERT_ACTION, source.execute('''SELECT time, nb_name,
+            name, selected_cell, selected_cells FROM actions WHERE nb_name = ?
+            ORDER BY rowid''', (nb_name,)))
+        c.executemany(INSERT_LOG, source.execute('''SELECT time, nb_name, name,
+            id, ids FROM janus_log WHERE nb_name = ? ORDER BY rowid''', (nb_name,)))
+
+        # index the copied versions for search once the shard is opened
+        c.execute('''UPDATE search_state SET end_rowid = (SELECT IFNULL(MAX(rowid), 0)
+            FROM cells)''')
+
+        # leave write-ahead logging while the shard is moved into place, so
+        # the whole shard is in its one file
+        shard.commit()
+        c.close()
+        shard.execute('PRAGMA journal_mode = DELETE')
+        shard.close()
+        os.rename(shard_path(storage_dir, nb_name) + '.part',
+                    shard_path(storage_dir, nb_name))
+        shard = sqlite3.connect(shard_path(storage_dir, nb_name))
+        shard.execute('PRAGMA journal_mode = WAL')
+        shard.close()
+        copied[nb_name] = len(rows)
+
+    source.close()
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Split a Janus notebook history database into one shard per notebook')
+    parser.add_argument('db_path', help='path to nb_history.db')
+    parser.add_argument('--storage-dir', default=None,
+        help='directory to create shards in, defaults to the one holding the database')
+    args = parser.parse_args()
+
+    copied = split_database(args.db_path, args.storage_dir)
+    for nb_name, num_configs in sorted(copied.items()):
+        print('%s: %d configurations' % (nb_name, num_configs))
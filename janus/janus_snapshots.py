@@ -0,0 +1,97 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Rebuild a whole notebook as it was at a point in its history
+
+A snapshot is a notebook configuration with the cell versions it used, sent
+as an .ipynb shaped document. Loading every version of a configuration from
+the cells table means unpickling each one and rebuilding its source, so each
+keyframe configuration (see janus_configs) gets a checkpoint when it is
+recorded, or from a background thread for keyframes recorded before
+checkpoints were: the cells of its versions with their sources rebuilt and
+outputs left as references to the outputs table, compressed into one row of
+the nb_checkpoints table. A snapshot then loads the checkpoint of its
+keyframe, and only the versions recorded since it.
+"""
+
+import json
+import zlib
+
+# format of the documents snapshots are sent as
+NBFORMAT = 4
+NBFORMAT_MINOR = 2
+
+# cells loaded and sent at a time when streaming a snapshot
+STREAM_BATCH = 50
+
+def encode_checkpoint(cells):
+    """
+    Return compressed bytes of the cell versions of a configuration to store
+    in the nb_checkpoints table
+
+    cells: (dict) [cell without outputs, output hashes or None] with
+        version_id as keys, see janus_outputs.split_outputs
+    """
+
+    return zlib.compress(json.dumps(cells, separators=(',', ':')).encode())
+
+
+def decode_checkpoint(data):
+    """
+    Return cell versions of a configuration stored with encode_checkpoint
+
+    data: (bytes) compressed cell versions
+    """
+
+    return json.loads(zlib.decompress(data).decode())
+
+
+def snapshot_cell(cell, version_id):
+    """
+    Return copy of a cell version to put in a snapshot, marked with its
+    version_id, leaving the (possibly cached) version itself unchanged
+
+    cell: (obj) JSON representation of the cell version
+    version_id: (str) unique cell version identifier
+    """
+
+    janus = dict(cell.get('metadata', {}).get('janus', {}), version_id=version_id)
+    metadata = dict(cell.get('metadata', {}), janus=janus)
+    return dict(cell, metadata=metadata)
+
+
+def notebook_header(snapshot):
+    """
+    Return .ipynb shaped document of a snapshot without its cells, with the
+    configuration it shows in the notebook's Janus metadata
+
+    snapshot: (dict) configuration found by DbManager.find_snapshot
+    """
+
+    return {
+        'metadata': {
+            'janus': {
+                'time': snapshot['time'],
+                'nb_name': snapshot['nb_name'],
+                'index': snapshot['index'],
+                'total': snapshot['total'],
+                'cell_order': snapshot['cell_order'],
+                'version_order': snapshot['version_order']
+            }
+        },
+        'nbformat': NBFORMAT,
+        'nbformat_minor': NBFORMAT_MINOR
+    }
+
+
+def stream_envelope(header):
+    """
+    Return (prefix, suffix) of the JSON text of a snapshot document, so its
+    cells can be written between them a batch at a time
+
+    header: (dict) document without its cells, see notebook_header
+    """
+
+    text = json.dumps(header)
+    return text[:-1] + ', "cells": [', ']}'
@@ -0,0 +1,108 @@
+"""
+Janus: Jupyter Notebook extension that helps users keep clean notebooks by
+folding cells and keeping track of all changes
+
+Store the source of cell versions as line deltas, and diff versions by line
+
+Most new versions of a cell change a line or two of the previous version, so
+their source is stored as the lines that changed since the cell's previous
+version. Every SNAPSHOT_INTERVAL versions of a cell we store its full source
+instead, which bounds how many deltas we have to apply to rebuild a version.
+"""
+
+import difflib
+import json
+
+# store a cell's full source at least this often
+SNAPSHOT_INTERVAL = 10
+
+def split_lines(source):
+    """
+    Return list of the lines of a cell's source, keeping line endings
+
+    source: (str or list) source, or list of lines as in nbformat
+    """
+
+    if isinstance(source, list):
+        source = ''.join(source)
+    return source.splitlines(True)
+
+
+def line_changes(a_lines, b_lines):
+    """
+    Return list of (a_start, a_end, b_start, b_end) of the runs of lines that
+    differ between two lists of lines
+
+    a_lines: (list) lines of the first source
+    b_lines: (list) lines of the second source
+    """
+
+    matcher = difflib.SequenceMatcher(None, a_lines, b_lines, autojunk=False)
+    return [(i1, i2, j1, j2) for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+def encode_source_delta(previous, source):
+    """
+    Return text storing how a source differs from the previous one, as a list
+    of [start, end, lines] splices replacing previous lines start to end
+
+    previous: (str) source of the previous version
+    source: (str) source of the new version
+    """
+
+    a_lines = split_lines(previous)
+    b_lines = split_lines(source)
+    splices = [[i1, i2, b_lines[j1:j2]]
+                for i1, i2, j1, j2 in line_changes(a_lines, b_lines)]
+    return json.dumps(splices, separators=(',', ':'))
+
+
+def apply_line_delta(previous_lines, delta):
+    """
+    Return lines of a source rebuilt from the lines of the previous source
+    and a delta, so chains of deltas can be applied without joining and
+    splitting the source at each step
+
+    previous_lines: (list) lines of the previous version, see split_lines
+    delta: (str) delta created by encode_source_delta
+    """
+
+    lines = []
+    position = 0
+    for start, end, inserted in json.loads(delta):
+        lines.extend(previous_lines[position:start])
+        lines.extend(inserted)
+        position = end
+    lines.extend(previous_lines[position:])
+    return lines
+
+
+def apply_source_delta(previous, delta):
+    """
+    Return source rebuilt from the previous source and a delta
+
+    previous: (str) source of the previous version
+    delta: (str) delta created by encode_source_delta
+    """
+
+    return ''.join(apply_line_delta(split_lines(previous), delta))
+
+
+def line_diff(a_source, b_source):
+    """
+    Return compact list of the hunks that turn one source into another, each
+    with the line ranges it covers and the lines removed and added
+
+    a_source: (str) source of the first version
+    b_source: (str) source of the second version
+    """
+
+    a_lines = split_lines(a_source)
+    b_lines = split_lines(b_source)
+    return [{
+        'a': [i1, i2],
+        'b': [j1, j2],
+        'removed': a_lines[i1:i2],
+        'added': b_lines[j1:j2]
+    } for i1, i2, j1, j2 in line_changes(a_lines, b_lines)]
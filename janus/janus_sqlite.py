@@ -5,22 +5,180 @@ folding cells and keeping track of all changes
 Handles interactions with the database storing notebook history data
 """
 
+import atexit
+import collections
+import logging
+import multiprocessing
+import os
 import pickle
 import sqlite3
 import json
-import re
-from threading import Timer
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
+
+from janus.janus_diff import (check_for_nb_diff, check_for_nb_delta,
+    cell_fingerprint, cell_has_content)
+from janus.janus_migrations import migrate
+from janus.janus_dir import new_notebook_id
+from janus.janus_configs import encode_config, decode_configs, KEYFRAME_INTERVAL
+from janus.janus_outputs import split_outputs, join_outputs, decompress_output
+from janus.janus_cache import VersionCache
+from janus.janus_journal import Journal
+from janus.janus_search import searchable_text, match_expression, SNIPPET_TOKENS
+from janus.janus_snapshots import (encode_checkpoint, decode_checkpoint,
+    snapshot_cell, notebook_header)
+from janus.janus_sources import (encode_source_delta, apply_line_delta,
+    split_lines, line_diff, SNAPSHOT_INTERVAL)
+from janus.janus_metrics import (REGISTRY, DIFF_SECONDS, PICKLE_LOADS,
+    COMMIT_SECONDS, COMMIT_ROWS)
+from janus.janus_export import summarize_rows, ExportJob, EXPORT_CHUNK_SIZE
+from janus.janus_retention import (thin_nb_configs, collect_garbage,
+    free_bytes, current_time, retention_report, config_versions)
+
+# shared managers, one for each database used by this server process
+_db_managers = {}
+_db_managers_lock = threading.Lock()
+
+# rows of each table in the order they are queued, see enqueue
+INSERT_ACTION = '''INSERT INTO actions (time, nb_name, name, selected_cell,
+    selected_cells) VALUES (?,?,?,?,?)'''
+INSERT_CELL = '''INSERT INTO cells (time, cell_id, version_id, cell_data,
+    fingerprint, output_refs, has_content, source_base, source_delta)
+    VALUES (?,?,?,?,?,?,?,?,?)'''
+# configurations take the id of the notebook registered at their path then
+INSERT_NB_CONFIG = '''INSERT INTO nb_configs (time, nb_name, cell_order,
+    version_order, keyframe, nb_id) VALUES (?1, ?2, ?3, ?4, ?5, (
+        SELECT config_id FROM notebook_paths WHERE nb_name = ?2
+        AND start_time <= ?1 AND (end_time IS NULL OR end_time >= ?1)
+        ORDER BY start_time DESC LIMIT 1))'''
+INSERT_LOG = '''INSERT INTO janus_log (time, nb_name, name, id, ids)
+    VALUES (?,?,?,?,?)'''
+INSERT_OUTPUT = 'INSERT OR IGNORE INTO outputs (hash, data) VALUES (?,?)'
+
+# checkpoint a keyframe configuration, found by its notebook and time since
+# it may not have a rowid yet when the checkpoint is queued
+INSERT_CHECKPOINT = '''INSERT OR REPLACE INTO nb_checkpoints (config_rowid, nb_name,
+    cells) SELECT MAX(rowid), ?, ? FROM nb_configs WHERE nb_name = ? AND time = ?
+    AND keyframe = 1 HAVING MAX(rowid) IS NOT NULL'''
+
+# index a committed cell version, found by its version_id, for search
+INSERT_SEARCH = '''INSERT INTO cells_search (rowid, source, outputs, nb_name,
+    cell_id, version_id, time) VALUES ((SELECT MAX(rowid) FROM cells
+    WHERE version_id = ?), ?, ?, ?, ?, ?, ?)'''
+
+# end of the time range of the path a notebook is saved under now
+OPEN_END = 2 ** 62
+
+# every open DbManager, including shards, for metrics collection
+_open_managers = weakref.WeakSet()
+
+def get_db_manager(db_path, **settings):
+    """
+    Return the DbManager shared by every request using a particular database
+
+    db_path: (str) full path to the notebook history database
+    settings: (dict) DbManager settings, used when the manager is first created
+    """
+
+    with _db_managers_lock:
+        if db_path not in _db_managers:
+            _db_managers[db_path] = DbManager(db_path, **settings)
+        return _db_managers[db_path]
+
+
+def in_ranges(nb_name, t, paths):
+    """
+    Return whether something recorded in a notebook at a time falls in one of
+    the time ranges of the notebook's paths
+
+    nb_name: (str) hashed path it was recorded under
+    t: (int) time it was recorded
+    paths: (list) of [hashed_path, start_time, end_time] for each path the
+        notebook has had
+    """
+
+    return any(p[0] == nb_name and int(p[1]) <= int(t) <= int(p[2]) for p in paths)
+
+
+def history_clause(paths):
+    """
+    Return (clause, params) of an SQL condition matching the configurations
+    recorded under any of a notebook's paths. Paths found from the notebook's
+    stable id carry the id their history is recorded under, so a notebook is
+    one lookup of the (nb_id, time) index however often it was renamed, while
+    paths sent by clients are each a lookup of the (nb_name, time) index
+
+    paths: (list) of [hashed_path, start_time, end_time] for each path the
+        notebook has had, with the id it was recorded under if known
+    """
+
+    clauses = []
+    params = ()
+    ids = collections.OrderedDict()
+    for p in paths:
+        if len(p) > 3 and p[3] is not None:
+            start, end = ids.get(p[3], (int(p[1]), int(p[2])))
+            ids[p[3]] = (min(start, int(p[1])), max(end, int(p[2])))
+        else:
+            clauses.append('(nb_name = ? AND time BETWEEN ? AND ?)')
+            params += (p[0], int(p[1]), int(p[2]))
+    for config_id, (start, end) in ids.items():
+        clauses.append('(nb_id = ? AND time BETWEEN ? AND ?)')
+        params += (config_id, start, end)
+    return ' OR '.join(clauses), params
 
-from janus.janus_diff import check_for_nb_diff
 
 class DbManager(object):
-    def __init__(self, db_path):
+    def __init__(self, db_path, commit_delay = 2.0, max_queued = 5000,
+                    max_concurrent_diffs = 1, version_cache_bytes = 64 * 1024 * 1024,
+                    export_workers = 2, journal = True, search_outputs = False):
 
         # path to the database
         self.db_path = db_path
 
-        # timer so we don't access the db too often
-        self.commitTimer = None
+        # limit how many diffs of the same notebook run at once
+        self.max_concurrent_diffs = max_concurrent_diffs
+        self.diff_limits = {}
+
+        # diffs reuse versions they matched before queuing the configuration
+        # using them, so garbage is not collected while any diff is running
+        self.diffs_running = 0
+        self.collecting = False
+
+        # wait for a pause in activity before committing queued data, unless
+        # so much data is queued that new records have to wait for a commit
+        self.commit_delay = commit_delay
+        self.max_queued = max_queued
+        self.last_queued = 0
+        self.flush_requested = False
+        self.closed = False
+
+        # decoded last configuration of each notebook, so we can encode new
+        # configurations against it without reading it back from the database
+        self.last_configs = {}
+
+        # (version_id, source, deltas since its snapshot) of the last version
+        # of each cell, so we can store new sources as deltas against it
+        self.last_sources = {}
+
+        # id of the notebook each path is registered to now, so actions on
+        # a notebook that has not moved do not touch the registry
+        self.notebook_ids = {}
+
+        # number of processes summarizing cell versions during exports
+        self.export_workers = export_workers
+        self.export_job = None
+        self.export_jobs = {}
+
+        # recently read cell versions, already decoded
+        self.version_cache = VersionCache(version_cache_bytes)
+
+        # whether text outputs are searchable along with sources
+        self.search_outputs = search_outputs
 
         # and queues for storing data to be committed
         self.action_queue = []
@@ -28,42 +186,63 @@ class DbManager(object):
         self.nb_queue = []
         self.log_queue = []
         self.comment_queue = []
+        self.output_queue = []
+        self.search_queue = []
+        self.checkpoint_queue = []
+        self.queues = {
+            'action': self.action_queue,
+            'cell': self.cell_queue,
+            'nb': self.nb_queue,
+            'log': self.log_queue,
+            'comment': self.comment_queue,
+            'output': self.output_queue,
+            'search': self.search_queue,
+            'checkpoint': self.checkpoint_queue
+        }
+
+        # one long-lived connection shared by all threads, the lock guards
+        # both the connection and the queues so reads see queued data
+        self.lock = threading.RLock()
+        self.queue_changed = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
 
         # create db tables if they don't already exist
         self.create_initial_tables()
+        self.search_enabled = len(self.execute_search('''SELECT name FROM
+            sqlite_master WHERE name = 'cells_search' ''')) > 0
+
+        # journal records before queueing them so they survive a crash, and
+        # apply any the database did not commit before the last one
+        self.journal = None
+        self.journal_seq = 0
+        if journal:
+            self.journal = Journal(db_path + '.ingest')
+            self.replay_journal()
+
+        # a single background thread commits queued data in groups
+        self.writer = threading.Thread(target=self.write_queues,
+                                        name='janus-db-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+        # and another indexes versions recorded before the search index, and
+        # checkpoints keyframes recorded before checkpoints
+        self.indexer = threading.Thread(target=self.index_old_history,
+                                        name='janus-indexer')
+        self.indexer.daemon = True
+        self.indexer.start()
+
+        atexit.register(self.close)
+        _open_managers.add(self)
 
 
     def create_initial_tables(self):
         """
-        Create action, cell, and nb_config tables for later use
+        Create or upgrade action, cell, and nb_config tables for later use
         """
 
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
-
-        self.c.execute('''CREATE TABLE IF NOT EXISTS actions (time integer,
-            nb_name text, name text, selected_cell integer, selected_cells text)''')
-
-        self.c.execute('''CREATE TABLE IF NOT EXISTS cells (time integer,
-            cell_id text, version_id text, cell_data text)''')
-
-        self.c.execute('''CREATE TABLE IF NOT EXISTS nb_configs (time integer,
-            nb_name text, cell_order text, version_order text)''')
-
-        self.c.execute('''CREATE TABLE IF NOT EXISTS janus_log (time integer,
-            nb_name text, name text, id text, ids text)''')
-
-        self.c.execute('''CREATE TABLE IF NOT EXISTS comments (time integer,
-            comment text, nb_name text)''')
-
-        # TODO actual data blob will be removed, currently string is inserted (in case table insertion changes)
-        self.c.execute('''CREATE TABLE IF NOT EXISTS cleaned_cells (time integer,
-            cell_id text, version_id text, cell_data text, meta_data text,
-            line_count integer, function_count integer, cell_count integer,
-            lines_of_code integer, words_of_markdown integer, output_count integer, types text)''')
-
-        self.conn.commit()
-        self.conn.close()
+        with self.lock:
+            migrate(self.conn)
 
 
     def record_nb_config(self, t, nb_name, cell_order, version_order):
@@ -76,13 +255,36 @@ class DbManager(object):
         version_order: (list) strings of unique cell version identifiers
         """
 
-        # save the data to the database queue
-        nb_data_tuple = (t, str(nb_name), str(cell_order), str(version_order))
-        self.nb_queue.append(nb_data_tuple)
-        self.update_timer()
+        with self.queue_changed:
+
+            # make room first, so no other configuration of this notebook is
+            # queued between the one we encode against and this one
+            self.wait_for_room()
+
+            # store a delta against the last configuration, or a keyframe
+            last_config = self.get_last_nb_config(nb_name)
+            previous = None
+            since_keyframe = 0
+            if last_config and self.last_configs[nb_name][3] < KEYFRAME_INTERVAL - 1:
+                previous = (last_config[2], last_config[3])
+                since_keyframe = self.last_configs[nb_name][3] + 1
+            encoded = encode_config(previous, cell_order, version_order)
+
+            # save the data to the database queue
+            nb_data_tuple = (t, str(nb_name)) + encoded
+            self.enqueue(self.nb_queue, nb_data_tuple)
+            self.last_configs[nb_name] = (t, list(cell_order), list(version_order),
+                                            since_keyframe)
 
+        # snapshots load the versions of keyframes from their checkpoints,
+        # which can be rebuilt from the versions, so are not journaled
+        if encoded[2]:
+            cells = self.build_checkpoint(version_order)
+            self.enqueue(self.checkpoint_queue, (t, str(nb_name),
+                            encode_checkpoint(cells)), journal=False)
 
-    def record_cell(self, t, cell_id, version_id, cell_data):
+
+    def record_cell(self, t, cell_id, version_id, cell_data, nb_name = None):
         """
         Record new cell version
 
@@ -90,41 +292,120 @@ class DbManager(object):
         cell_id: (str) unique cell identifier
         version_id: (str) unique cell version identifier
         cell_data: (obj) JSON representation of the new cell version
+        nb_name: (str) hashed path to the notebook the version is from
         """
 
         # save the data to the database queue
         cell_data['metadata']['janus']['versions'] = []
         cell_data['metadata']['janus']['named_versions'] = []
-        cell_data_tuple = (t, str(cell_id), str(version_id), pickle.dumps(cell_data))
-        self.cell_queue.append(cell_data_tuple)
-        self.update_timer()
+        fingerprint = cell_fingerprint(cell_data)
+        has_content = cell_has_content(cell_data)
+        search_text = searchable_text(cell_data, self.search_outputs)
+
+        # store outputs separately so versions can share them
+        cell_data, output_refs, outputs = split_outputs(cell_data)
+        if output_refs is not None:
+            output_refs = json.dumps(output_refs)
+
+        with self.queue_changed:
+
+            # make room first, so no other version of this cell is queued
+            # between the one we encode against and this one, and queue the
+            # outputs with it, so they are not committed without it
+            self.wait_for_room()
+            for h, data in outputs.items():
+                self.enqueue(self.output_queue, (h, data))
+
+            # store the source as a delta against the cell's last version,
+            # unless it is time for a snapshot or the delta saves too little
+            # to be worth rebuilding the source from
+            source = cell_data['source']
+            if isinstance(source, list):
+                source = ''.join(source)
+            source_base = None
+            source_delta = None
+            depth = 0
+            last_source = self.get_last_source(cell_id)
+            if last_source is not None and last_source[2] < SNAPSHOT_INTERVAL - 1:
+                delta = encode_source_delta(last_source[1], source)
+                if len(delta) < len(source) // 2:
+                    source_base = last_source[0]
+                    source_delta = delta
+                    depth = last_source[2] + 1
+            if source_base is not None:
+                cell_data = dict(cell_data)
+                del cell_data['source']
+
+            cell_data_tuple = (t, str(cell_id), str(version_id), pickle.dumps(cell_data),
+                                fingerprint, output_refs, has_content, source_base,
+                                source_delta)
+            self.enqueue(self.cell_queue, cell_data_tuple)
+            self.last_sources[cell_id] = (str(version_id), source, depth)
+
+            # and make it searchable once it is committed
+            if self.search_enabled:
+                self.enqueue(self.search_queue, (t, str(cell_id), str(version_id),
+                                                str(nb_name or '')) + search_text)
 
 
     def record_action(self, action_data, hashed_path):
         """
-        save action to database
+        save action to database, return token of the resulting notebook
+        configuration, or None if the client needs to resend the full notebook
 
-        action_data: (dict) data about action, including name and full notebook
+        action_data: (dict) data about action, including name and either the
+            full notebook, or a delta with only the cells that changed
         hashed_path: (str) hashed path to where notebook is saved on volume
         """
 
-        # save the data to the database queue
-        t = action_data['time']
-        name = action_data['name']
-        selected_index = action_data['index']
-        selected_indicies = action_data['indices']
-        cells = action_data['model']['cells']
-        action_data_tuple = (str(t), str(hashed_path), str(name), str(selected_index),
-                            str(selected_indicies))
-        self.action_queue.append(action_data_tuple)
+        return self.record_action_batch(action_data, [action_data], hashed_path)
+
+
+    def record_action_batch(self, state_data, actions, hashed_path):
+        """
+        save several actions to database, checking the notebook for changes
+        once, in its state after the last of them. Return token of the
+        resulting notebook configuration, or None if the client needs to
+        resend the full notebook. The actions are saved either way
+
+        state_data: (dict) either the full notebook 'model', or a 'delta' with
+            only the cells that changed, and the 'time' of that state if it
+            is not the time of the last action
+        actions: (list) of dicts with the time, name, index and indices of
+            each action, oldest first, may be empty when only the notebook
+            is resent
+        hashed_path: (str) hashed path to where notebook is saved on volume
+        """
 
-        # check for new cells or nb_configs as a result of this action
-        check_for_nb_diff(t, hashed_path, cells, self)
+        t = state_data.get('time', actions[-1]['time'] if actions else None)
 
-        # commit all queues if notebook is closing, otherwise update our timer
-        if name == 'notebook-closed':
-            self.commit_queues()
-        self.update_timer()
+        # check for new cells or nb_configs as a result of these actions
+        with self.diff_limit(hashed_path), self.diffing():
+            if 'delta' in state_data:
+                delta = state_data['delta']
+                with DIFF_SECONDS.time(kind='delta'):
+                    token = check_for_nb_delta(t, hashed_path, delta['cell_order'],
+                                            delta['cells'], delta['base'], self)
+            else:
+                cells = state_data['model']['cells']
+                with DIFF_SECONDS.time(kind='full'):
+                    token = check_for_nb_diff(t, hashed_path, cells, self)
+
+        # save the data to the database queue, even if the client has to
+        # resend the notebook, since only the notebook's state is resent
+        closing = False
+        for action in actions:
+            action_data_tuple = (str(action['time']), str(hashed_path),
+                                str(action['name']), str(action['index']),
+                                str(action['indices']))
+            self.enqueue(self.action_queue, action_data_tuple)
+            closing = closing or action['name'] == 'notebook-closed'
+        self.sync_journal()
+
+        # commit all queues if notebook is closing
+        if closing:
+            self.flush()
+        return token
 
 
     def record_log(self, log_data, nb_name):
@@ -142,8 +423,8 @@ class DbManager(object):
         sel_ids = log_data['ids']
         log_data_tuple = (str(t), str(nb_name), str(name), str(sel_id),
                             str(sel_ids))
-        self.log_queue.append(log_data_tuple)
-        self.update_timer()
+        self.enqueue(self.log_queue, log_data_tuple)
+        self.sync_journal()
 
 
     def record_comment(self, comment_data, nb_name):
@@ -156,99 +437,804 @@ class DbManager(object):
         nb_name = nb_name
 
         comment_data_tuple = (str(t), str(comment), str(nb_name))
-        self.comment_queue.append(comment_data_tuple)
-        self.update_timer()
+        self.enqueue(self.comment_queue, comment_data_tuple)
+        self.sync_journal()
 
 
-    def commit_queues(self):
+    def register_notebook(self, nb_id, nb_name, t, filepaths = None,
+                            path_exists = None):
+        """
+        Return the stable id of the notebook saved at a path, registering the
+        path under it from a time if it is not already. A notebook that moves
+        takes its id with it, while a notebook showing up at a new path while
+        its id is still saved at another, or at a path its id has moved on
+        from, is a copy, and gets an id of its own that keeps the history so far
+
+        nb_id: (str) id the client has for the notebook, or None if it has none
+        nb_name: (str) hashed path the notebook is saved at
+        t: (int) time of the action that prompted the check
+        filepaths: (list) of [hashed_path, start_time, end_time] the client
+            remembered before notebooks had ids, merged in when it has none
+        path_exists: (function) returning whether a notebook is still saved at
+            a hashed path, or None if it cannot tell
         """
-        commit any data in queues to the database We queue data until there is
-        a pause in activity (e.g. 2 seconds) to limit db open / close
+
+        with self.lock:
+            if nb_name not in self.notebook_ids:
+                rows = self.execute_search('''SELECT nb_id FROM notebook_paths
+                    WHERE nb_name = ? AND end_time IS NULL''', (nb_name,))
+                self.notebook_ids[nb_name] = rows[0][0] if rows else None
+            current = self.notebook_ids[nb_name]
+            if nb_id is not None and nb_id == current:
+                return nb_id
+            if nb_id is None and current is not None and not filepaths:
+                return current
+
+            t = int(t)
+            c = self.conn.cursor()
+            try:
+                if nb_id is None:
+
+                    # the notebook's first id, along with the paths it had,
+                    # whose history is now recorded under it rather than
+                    # under the ids the paths were registered with on their own
+                    nb_id = current or new_notebook_id()
+                    known = set(r[0] for r in self.execute_search('''SELECT
+                        nb_name FROM notebook_paths WHERE nb_id = ?''', (nb_id,)))
+                    merged = [(p[0], int(p[1]), int(p[2])) for p in filepaths or []
+                                if p[0] != nb_name and p[0] not in known]
+                    c.executemany('''DELETE FROM notebook_paths
+                        WHERE nb_id = nb_name AND nb_name = ?''',
+                        [(p[0],) for p in merged])
+                    c.executemany('''INSERT INTO notebook_paths (nb_id, nb_name,
+                        start_time, end_time, config_id) VALUES (?,?,?,?,?)''',
+                        [(nb_id,) + p + (nb_id,) for p in merged])
+                    c.executemany('''UPDATE nb_configs SET nb_id = ?
+                        WHERE nb_name = ? AND time BETWEEN ? AND ?''',
+                        [(nb_id,) + p for p in merged])
+                    for p in merged:
+                        self.notebook_ids.pop(p[0], None)
+                else:
+
+                    # another notebook was saved at this path until now
+                    if current is not None:
+                        c.execute('''UPDATE notebook_paths SET end_time = ?
+                            WHERE nb_name = ? AND end_time IS NULL''', (t, nb_name))
+
+                    # the notebook was copied if it is still saved where it
+                    # was, or, when we cannot tell, if it came back to a path
+                    # it moved on from while saved at another
+                    ranges = self.execute_search('''SELECT nb_name, start_time,
+                        end_time, config_id FROM notebook_paths WHERE nb_id = ?''',
+                        (nb_id,))
+                    saved = [path_exists(r[0]) if path_exists is not None else None
+                                for r in ranges if r[2] is None and r[0] != nb_name]
+                    if True in saved:
+                        copied = True
+                    elif None in saved:
+                        copied = any(r[0] == nb_name for r in ranges)
+                    else:
+                        copied = False
+
+                    if copied:
+                        parent = nb_id
+                        nb_id = new_notebook_id()
+                        c.executemany('''INSERT INTO notebook_paths (nb_id,
+                            nb_name, start_time, end_time, config_id)
+                            VALUES (?,?,?,?,?)''',
+                            [(nb_id, r[0], r[1], t if r[2] is None else r[2], r[3])
+                                for r in ranges])
+                        logging.getLogger(__name__).info(
+                            'Janus found a copy of notebook %s, now %s', parent, nb_id)
+                    else:
+                        c.execute('''UPDATE notebook_paths SET end_time = ?
+                            WHERE nb_id = ? AND end_time IS NULL''', (t, nb_id))
+
+                if current != nb_id:
+                    c.execute('''INSERT INTO notebook_paths (nb_id, nb_name,
+                        start_time, end_time, config_id) VALUES (?,?,?,NULL,?)''',
+                                (nb_id, nb_name, t, nb_id))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+
+            # paths whose ranges we closed are no longer registered to anyone
+            for name in [n for n, i in self.notebook_ids.items() if i == nb_id]:
+                del self.notebook_ids[name]
+            self.notebook_ids[nb_name] = nb_id
+            return nb_id
+
+
+    def get_notebook_paths(self, nb_id):
+        """
+        Return list of [hashed_path, start_time, end_time, config_id] of every
+        path a notebook has been saved under, as history queries take them,
+        with the id the notebook's history under each is recorded with
+
+        nb_id: (str) stable notebook identifier, see register_notebook
         """
 
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
+        rows = self.execute_search('''SELECT nb_name, start_time,
+            IFNULL(end_time, ?), config_id FROM notebook_paths WHERE nb_id = ?
+            ORDER BY start_time''', (OPEN_END, nb_id))
+        return [list(r) for r in rows]
+
+
+    @contextmanager
+    def diffing(self):
+        """
+        Keep garbage from being collected while a diff runs, waiting for any
+        collection already running to finish first
+        """
 
+        with self.queue_changed:
+            while self.collecting:
+                self.queue_changed.wait()
+            self.diffs_running += 1
         try:
-            self.c.executemany('INSERT INTO actions VALUES (?,?,?,?,?)', self.action_queue)
-            self.c.executemany('INSERT INTO cells VALUES (?,?,?,?)', self.cell_queue)
-            self.c.executemany('INSERT INTO nb_configs VALUES (?,?,?,?)', self.nb_queue)
-            self.c.executemany('INSERT INTO janus_log VALUES (?,?,?,?,?)', self.log_queue)
-            self.c.executemany('INSERT INTO comments VALUES (?,?,?)', self.comment_queue)
+            yield
+        finally:
+            with self.queue_changed:
+                self.diffs_running -= 1
+                self.queue_changed.notify_all()
 
-            self.conn.commit()
-            self.conn.close()
 
-            self.action_queue = []
-            self.cell_queue = []
-            self.nb_queue = []
+    def diff_limit(self, nb_name):
+        """
+        Return semaphore limiting concurrent diffs of a particular notebook
 
+        nb_name: (str) hashed path to the notebook
+        """
+
+        with self.lock:
+            if nb_name not in self.diff_limits:
+                self.diff_limits[nb_name] = threading.BoundedSemaphore(
+                                                    self.max_concurrent_diffs)
+            return self.diff_limits[nb_name]
+
+
+    def num_queued(self):
+        """
+        Return number of records waiting to be committed
+        """
+
+        return (len(self.action_queue) + len(self.cell_queue) + len(self.nb_queue)
+                + len(self.log_queue) + len(self.comment_queue)
+                + len(self.output_queue) + len(self.search_queue)
+                + len(self.checkpoint_queue))
+
+
+    def enqueue(self, queue, data_tuple, journal = True):
+        """
+        Add a record to one of the queues, waiting for a commit if they are full
+
+        queue: (list) queue the record belongs in
+        data_tuple: (tuple) values of the new database row
+        journal: (bool) journal the record, records that can be rebuilt from
+            others if lost need not be
+        """
+
+        with self.queue_changed:
+            self.wait_for_room()
+            if journal and self.journal is not None:
+                name = next(n for n, q in self.queues.items() if q is queue)
+                self.journal_seq = self.journal.append(name, data_tuple)
+            queue.append(data_tuple)
+            self.last_queued = time.time()
+            self.queue_changed.notify_all()
+
+
+    def sync_journal(self):
+        """
+        Block until every record queued so far is safely in the journal, so
+        it is not lost if we crash before committing it
+        """
+
+        if self.journal is not None:
+            self.journal.sync()
+
+
+    def replay_journal(self):
+        """
+        Commit the records in the journal that come after the last one the
+        database committed, then empty the journal
+        """
+
+        with self.lock:
+            rows = self.execute_search('''SELECT last_seq FROM journal_state
+                WHERE name = 'applied' ''')
+            applied_seq = rows[0][0] if rows else 0
+            self.journal.start_after(applied_seq)
+            self.journal_seq = applied_seq
+
+            for seq, queue_name, record in self.journal.unapplied(applied_seq):
+                self.journal_seq = seq
+                if queue_name == 'checkpoint':
+                    # checkpoints are no longer journaled, and are rebuilt
+                    continue
+                if queue_name == 'cell' and len(record) < 9:
+                    # journaled before cells had source delta columns
+                    record = tuple(record) + (None,) * (9 - len(record))
+                self.queues[queue_name].append(record)
+            if self.num_queued() > 0:
+                logging.getLogger(__name__).info(
+                    'Janus replaying %d uncommitted records', self.num_queued())
+                self.commit_queues()
+            self.journal.truncate()
+
+
+    def wait_for_room(self):
+        """
+        Apply backpressure until the writer has caught up, must be called
+        while holding the lock
+        """
+
+        while self.num_queued() >= self.max_queued and not self.closed:
+            self.queue_changed.notify_all()
+            self.queue_changed.wait()
+
+
+    def write_queues(self):
+        """
+        Commit queued data in groups from a single background thread. We queue
+        data until there is a pause in activity (e.g. 2 seconds), the queues
+        fill up, or someone asks for a flush
+        """
+
+        with self.queue_changed:
+            while True:
+
+                # wait for data to commit
+                num_queued = self.num_queued()
+                if num_queued == 0:
+                    if self.closed:
+                        return
+                    self.flush_requested = False
+                    self.queue_changed.notify_all()
+                    self.queue_changed.wait()
+                    continue
+
+                # and for a pause in activity
+                idle = time.time() - self.last_queued
+                if (idle < self.commit_delay and num_queued < self.max_queued
+                        and not self.flush_requested and not self.closed):
+                    self.queue_changed.wait(self.commit_delay - idle)
+                    continue
+
+                try:
+                    self.commit_queues()
+                except Exception:
+                    # keep the data queued and try again after another delay
+                    logging.getLogger(__name__).exception(
+                        'Janus could not commit notebook history')
+                    self.last_queued = time.time()
+                    if self.closed:
+                        return
+                self.queue_changed.notify_all()
+
+
+    def commit_queues(self):
+        """
+        commit any data in queues to the database in a single transaction, only
+        called by the writer thread while it holds the lock
+        """
+
+        num_rows = self.num_queued()
+        start = time.perf_counter()
+        c = self.conn.cursor()
+        try:
+            c.executemany(INSERT_ACTION, self.action_queue)
+            c.executemany(INSERT_OUTPUT, self.output_queue)
+            c.executemany(INSERT_CELL, self.cell_queue)
+            if len(self.search_queue) > 0:
+                c.executemany(INSERT_SEARCH, [(r[2], r[4], r[5], r[3], r[1], r[2], r[0])
+                                                for r in self.search_queue])
+            c.executemany(INSERT_NB_CONFIG, self.nb_queue)
+            c.executemany(INSERT_LOG, self.log_queue)
+            c.executemany('''INSERT INTO comments (time, comment, nb_name)
+                VALUES (?,?,?)''', self.comment_queue)
+            c.executemany(INSERT_CHECKPOINT, [(q[1], q[2], q[1], q[0])
+                                                for q in self.checkpoint_queue])
+            if self.journal is not None:
+                c.execute('''INSERT OR REPLACE INTO journal_state (name, last_seq)
+                    VALUES ('applied', ?)''', (self.journal_seq,))
+            self.conn.commit()
         except:
             self.conn.rollback()
             raise
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+        COMMIT_ROWS.observe(num_rows)
+
+        # only clear the queues once their data is readable from the database
+        del self.action_queue[:]
+        del self.cell_queue[:]
+        del self.nb_queue[:]
+        del self.log_queue[:]
+        del self.comment_queue[:]
+        del self.output_queue[:]
+        del self.search_queue[:]
+        del self.checkpoint_queue[:]
+
+        # the journal only holds records the database does not have yet
+        if self.journal is not None:
+            self.journal.truncate()
+
+
+    def flush(self):
+        """
+        Block until all data queued so far has been committed
+        """
+
+        with self.queue_changed:
+            self.flush_requested = True
+            self.queue_changed.notify_all()
+            while self.num_queued() > 0 and self.writer.is_alive():
+                self.queue_changed.wait()
 
 
-    def update_timer(self):
+    def close(self):
         """
-        Delay committing data until 2 seconds of idle activity
+        Commit any queued data, then stop the writer and close the connection
         """
 
-        if self.commitTimer:
-            if self.commitTimer.is_alive():
-                self.commitTimer.cancel()
-                self.commitTimer = None
-        # else:
-        self.commitTimer = Timer(2.0, self.commit_queues)
-        self.commitTimer.start()
+        with self.queue_changed:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue_changed.notify_all()
+        self.writer.join()
+        with self.lock:
+            self.conn.close()
+            if self.journal is not None:
+                self.journal.close()
 
 
-    def execute_search(self, search):
+    def execute_search(self, search, params=()):
         """
         execute a particular search against the database
 
         search: (str) SQL query
+        params: (tuple) values for any placeholders in the query
         """
 
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
-        self.c.execute(search)
-        rows = self.c.fetchall()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute(search, params)
+            rows = c.fetchall()
         return rows
 
 
+    def run_maintenance(self, policy, dry_run = None):
+        """
+        Thin old notebook configurations, delete history nothing uses any more
+        and return freed space to the file system. Return dict reporting what
+        was deleted and how many bytes were reclaimed
+
+        policy: (obj) janus_retention.RetentionPolicy to apply
+        dry_run: (bool) only report what would be reclaimed, defaults to the
+            policy's dry_run setting
+        """
+
+        if dry_run is None:
+            dry_run = policy.dry_run
+        if dry_run:
+            return self.retention_report(policy)
+        now = current_time()
+        report = {'nb_configs': 0, 'dry_run': False}
+        live_versions = set()
+
+        # each notebook is committed on its own so recording new history
+        # only waits for one notebook at a time
+        self.flush()
+        try:
+            with self.lock:
+                c = self.conn.cursor()
+                start_free = free_bytes(c)
+                c.execute('SELECT DISTINCT nb_name FROM nb_configs')
+                nb_names = [r[0] for r in c.fetchall()]
+                last_rowid = self.execute_search(
+                    'SELECT IFNULL(MAX(rowid), 0) FROM nb_configs')[0][0]
+
+            for nb_name in nb_names:
+                with self.queue_changed:
+                    self.flush()
+                    deleted, live = thin_nb_configs(c, nb_name, policy, now)
+                    report['nb_configs'] += len(deleted)
+                    live_versions.update(live)
+                    self.conn.commit()
+
+                    # the number of configurations since the last keyframe
+                    # has changed, so decode the last one again when needed
+                    self.last_configs.pop(nb_name, None)
+
+            with self.queue_changed:
+
+                # wait for running diffs to queue the configurations using
+                # the versions they matched, and hold new ones back
+                self.collecting = True
+                while self.diffs_running > 0:
+                    self.queue_changed.wait()
+                self.flush()
+
+                # keep versions of configurations recorded since we started
+                new_rows = self.execute_search('''SELECT nb_name, MIN(rowid),
+                    MAX(rowid) FROM nb_configs WHERE rowid > ? GROUP BY nb_name''',
+                    (last_rowid,))
+                for nb_name, first, last in new_rows:
+                    for config in self.rebuild_nb_configs(nb_name, first, last):
+                        live_versions.update(config[4])
+
+                report.update(collect_garbage(c, live_versions, policy, now))
+                report['bytes_reclaimed'] = free_bytes(c) - start_free
+
+                # the last version of a cell may have been deleted
+                self.last_sources.clear()
+                self.version_cache.clear()
+                self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            with self.queue_changed:
+                self.collecting = False
+                self.queue_changed.notify_all()
+
+        # configurations re-encoded as keyframes need checkpoints
+        self.make_checkpoints()
+        self.vacuum(policy.vacuum_pages)
+        return report
+
+
+    def retention_report(self, policy):
+        """
+        Return dict reporting what applying a retention policy would delete,
+        see janus_retention.retention_report. The database is read on a
+        connection of its own, so recording history does not wait for it
+
+        policy: (obj) janus_retention.RetentionPolicy to apply
+        """
+
+        # queued configurations keep the versions they use, copying the queue
+        # is atomic so does not need to wait for the lock
+        queued_versions = config_versions(list(self.nb_queue))
+
+        conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.db_path),
+                                uri=True)
+        try:
+            return retention_report(conn, policy, current_time(), queued_versions)
+        finally:
+            conn.close()
+
+
+    def vacuum(self, pages_per_step = 1000):
+        """
+        Return free pages to the file system a few at a time, so other
+        requests only wait for one step at a time
+
+        pages_per_step: (int) pages to free while holding the lock
+        """
+
+        # databases that were never fully vacuumed keep their free pages
+        with self.lock:
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return
+
+        while True:
+            with self.lock:
+                c = self.conn.cursor()
+                if c.execute('PRAGMA freelist_count').fetchone()[0] == 0:
+                    return
+                c.execute('PRAGMA incremental_vacuum(%d)' % int(pages_per_step))
+                c.fetchall()
+                self.conn.commit()
+
+
+    def search(self, query, paths = None, since = None, until = None, limit = 50):
+        """
+        Return best matching list of dicts of cell_id, version_id, time,
+        nb_name and a snippet of the committed cell versions containing every
+        word of a search, see janus_search
+
+        query: (str) words to search for
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had, or None to search every notebook
+        since: (int) only search versions recorded at or after this time
+        until: (int) only search versions recorded at or before this time
+        limit: (int) most results to return
+        """
+
+        paths = [p for p in paths or [] if p[0]]
+        expression = match_expression(query)
+        if expression is None or not self.search_enabled:
+            return []
+
+        # rank matches in the notebook and time range first, and only make
+        # snippets of the best ones
+        best = 'SELECT rowid FROM cells_search WHERE cells_search MATCH ?'
+        params = (expression,)
+        if len(paths) > 0:
+            best += ' AND (' + ' OR '.join(
+                ['(nb_name = ? AND time BETWEEN ? AND ?)'] * len(paths)) + ')'
+            for p in paths:
+                params += (p[0], int(p[1] or 0), int(p[2] or 2 ** 62))
+        if since is not None:
+            best += ' AND time >= ?'
+            params += (int(since),)
+        if until is not None:
+            best += ' AND time <= ?'
+            params += (int(until),)
+        best += ' ORDER BY rank LIMIT ?'
+        params += (int(limit),)
+
+        search = '''SELECT cell_id, version_id, time, nb_name,
+            snippet(cells_search, -1, '«', '»', '...', ?), rank
+            FROM cells_search WHERE cells_search MATCH ? AND rowid IN (%s)
+            ORDER BY rank''' % best
+        params = (SNIPPET_TOKENS, expression) + params
+
+        return [{
+            'cell_id': r[0],
+            'version_id': r[1],
+            'time': r[2],
+            'nb_name': r[3],
+            'snippet': r[4],
+            'score': r[5]
+        } for r in self.execute_search(search, params)]
+
+
+    def index_old_history(self):
+        """
+        Index and checkpoint history recorded before this version of Janus, from
+        a background thread
+        """
+
+        if self.search_enabled:
+            self.index_history()
+        self.make_checkpoints()
+
+
+    def index_history(self):
+        """
+        Add the versions recorded before the search index existed to it, a
+        chunk at a time from a background thread, resuming where we left off
+        """
+
+        try:
+            state = self.execute_search('''SELECT indexed_rowid, end_rowid
+                FROM search_state''')
+            if len(state) == 0:
+                return
+            last_rowid, end_rowid = state[0]
+            if last_rowid >= end_rowid:
+                return
+
+            # find which notebook each version was recorded in
+            nb_names = {}
+            for (nb_name,) in self.execute_search('SELECT DISTINCT nb_name FROM nb_configs'):
+                for config in self.rebuild_nb_configs(nb_name, 0, 2 ** 62):
+                    for version_id in config[4]:
+                        nb_names.setdefault(version_id, nb_name)
+
+            while last_rowid < end_rowid:
+                with self.lock:
+                    if self.closed:
+                        return
+                    rows = self.execute_search('''SELECT rowid, * FROM cells
+                        WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?''',
+                        (last_rowid, end_rowid, EXPORT_CHUNK_SIZE))
+                    if len(rows) == 0:
+                        last_rowid = end_rowid
+                    else:
+                        last_rowid = rows[-1][0]
+                        cells = [r[1:] for r in rows]
+                        if self.search_outputs:
+                            texts = [searchable_text(cell, True)
+                                for cell in self.load_cells(cells, use_cache=False)]
+                        else:
+                            sources = self.resolve_sources(cells)
+                            texts = [(sources[cell[2]][0], '') for cell in cells]
+
+                    c = self.conn.cursor()
+                    try:
+                        c.executemany('''INSERT OR REPLACE INTO cells_search (rowid,
+                            source, outputs, nb_name, cell_id, version_id, time)
+                            VALUES (?,?,?,?,?,?,?)''',
+                            [(r[0],) + text + (nb_names.get(r[3], ''), r[2], r[3], r[1])
+                                for r, text in zip(rows, texts)])
+                        c.execute('UPDATE search_state SET indexed_rowid = ?',
+                                    (last_rowid,))
+                        self.conn.commit()
+                    except:
+                        self.conn.rollback()
+                        raise
+        except Exception:
+            if not self.closed:
+                logging.getLogger(__name__).exception(
+                    'Janus could not index notebook history for search')
+
+
     def get_comments(self):
         """
         Return a list of all comments
         """
 
-        search = "SELECT * FROM comments"
-        rows = self.execute_search(search)
+        with self.lock:
+            search = "SELECT * FROM comments"
+            rows = self.execute_search(search)
+            rows.extend(self.comment_queue)
         return rows
 
 
-    def get_nb_configs(self, path, start, end):
+    def get_nb_configs(self, paths):
         """
-        Return list of all prior nb configurations (e.g. cell and cell versions)
+        Return time-sorted list of all prior nb configurations (e.g. cell and
+        cell versions) under any of the notebook's paths
 
-        paths: (list) with [hashed_path, start_time, end_time]
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
         """
 
-        matched_configs = []
+        if len(paths) == 0:
+            return []
+
+        # find the span of rowids each notebook path's configurations take,
+        # and decode each span from the last keyframe before it
+        clause, params = history_clause(paths)
+        configs = []
+        with self.lock:
+            spans = self.execute_search('''SELECT nb_name, MIN(rowid), MAX(rowid)
+                FROM nb_configs WHERE %s GROUP BY nb_name''' % clause, params)
+            for nb_name, first_rowid, last_rowid in spans:
+                configs += [c[1:] for c in self.rebuild_nb_configs(nb_name,
+                                                first_rowid, last_rowid)]
+            configs += [c[1:5] for c in self.queued_nb_configs(set(p[0] for p in paths))]
+
+        # leaving out configurations of other notebooks saved at the same path
+        matched_configs = [c for c in configs if in_ranges(c[1], c[0], paths)]
+        matched_configs.sort(key=lambda x: int(x[0]))
+        return matched_configs
 
-        # look for nb_configs in the queue
-        queued_configs = [q for q in self.nb_queue if q[1] == nb_name].reverse()
-        if(queued_configs):
-            for q in queued_configs:
-                matched_configs.append(q)
 
-        # look for older configs in the database
-        search = "SELECT * FROM nb_configs WHERE nb_name = \'" + path + "\' AND time BETWEEN " + str(start) + " and " + str(end)
-        rows = self.execute_search(search)
-        for row in rows:
-            matched_configs.append(row)
+    def get_nb_config_page(self, paths, before=None, limit=100):
+        """
+        Return dict with a time-sorted page of the newest nb configurations
+        older than a cursor, the cursor of the next (older) page, and the
+        total number of configurations under any of the notebook's paths
+
+        Pages are found with the (nb_name, time) index and decoded from their
+        nearest keyframe, so a page costs the same however long the history is
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        before: (list) [time, rowid] cursor returned with the previous page,
+            or None for the newest page
+        limit: (int) maximum number of configurations in the page
+        """
 
-        matched_configs.sort(key=lambda x: x[0])
-        return matched_configs
+        page, total = self.get_nb_config_rows(paths, before, limit)
+        next_cursor = None
+        if len(page) == limit:
+            next_cursor = [page[0][1], page[0][0]]
+
+        return {
+            'nb_configs': [c[1:] for c in page],
+            'before': next_cursor,
+            'total': total
+        }
+
+
+    def get_nb_config_rows(self, paths, before=None, limit=100):
+        """
+        Return (page, total) where page is a time-sorted list of decoded
+        (rowid, time, nb_name, cell_order, version_order) of the newest nb
+        configurations older than a cursor, see get_nb_config_page
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        before: (list) [time, rowid] of the oldest configuration already seen,
+            or None for the newest page
+        limit: (int) maximum number of configurations in the page
+        """
+
+        if len(paths) == 0:
+            return [], 0
+
+        # queued configurations are ordered by the rowids they will have, so
+        # older pages are not affected by configurations queued since
+        if before is None:
+            before = [float('inf'), 0]
+
+        with self.lock:
+
+            # take the newest committed and queued rows
+            clause, params = history_clause(paths)
+            rows = self.execute_search('''SELECT time, rowid, nb_name FROM nb_configs
+                WHERE (%s) AND (time, rowid) < (?, ?)
+                ORDER BY time DESC, rowid DESC LIMIT ?''' % clause,
+                params + (before[0], before[1], limit))
+            total = self.count_nb_configs(paths)
+            queued = [c[:5] for c in self.queued_nb_configs(set(p[0] for p in paths))
+                        if in_ranges(c[2], c[1], paths)]
+            queued = [c for c in queued if (int(c[1]), c[0]) < tuple(before)]
+            rows += [(c[1], c[0], c[2]) for c in queued]
+            rows.sort(key=lambda r: (int(r[0]), r[1]), reverse=True)
+            rows = rows[:limit]
+
+            # decode the page one notebook path at a time, queued
+            # configurations are decoded already
+            rowids = set(r[1] for r in rows)
+            page = [c for c in queued if c[0] in rowids]
+            queued_rowids = set(c[0] for c in queued)
+            committed = [r for r in rows if r[1] not in queued_rowids]
+            for path in set(r[2] for r in committed):
+                path_rowids = [r[1] for r in committed if r[2] == path]
+                for config in self.rebuild_nb_configs(path, min(path_rowids),
+                                                        max(path_rowids)):
+                    if config[0] in rowids:
+                        page.append(config)
+
+        page.sort(key=lambda c: (int(c[1]), c[0]))
+        return page, total
+
+
+    def rebuild_nb_configs(self, nb_name, first_rowid, last_rowid):
+        """
+        Return list of decoded (rowid, time, nb_name, cell_order, version_order)
+        of a notebook's configurations stored between two rowids
+
+        nb_name: (str) hashed path to the notebook
+        first_rowid: (int) rowid of the first configuration to rebuild
+        last_rowid: (int) rowid of the last configuration to rebuild
+        """
+
+        with self.lock:
+            search = '''SELECT rowid, time, nb_name, cell_order, version_order,
+                keyframe FROM nb_configs WHERE nb_name = ? AND rowid >= (
+                    SELECT IFNULL(MAX(rowid), 0) FROM nb_configs
+                    WHERE nb_name = ? AND keyframe = 1 AND rowid <= ?)
+                AND rowid <= ? ORDER BY rowid'''
+            rows = self.execute_search(search, (nb_name, nb_name, first_rowid,
+                                                last_rowid))
+
+        configs = decode_configs([r[1:] for r in rows])
+        return [(r[0],) + c for r, c in zip(rows, configs) if r[0] >= first_rowid]
+
+
+    def queued_nb_configs(self, nb_names):
+        """
+        Return list of decoded (rowid, time, nb_name, cell_order, version_order,
+        keyframe) of the queued configurations of some notebooks, in the order
+        they were queued, with the rowids they will be committed with. Must be
+        called while holding the lock, so they are not committed meanwhile
+
+        nb_names: (set) hashed paths to the notebooks
+        """
+
+        queued = [(i, q) for i, q in enumerate(self.nb_queue) if q[1] in nb_names]
+        if len(queued) == 0:
+            return []
+        max_rowid = self.execute_search(
+            'SELECT IFNULL(MAX(rowid), 0) FROM nb_configs')[0][0]
+
+        # decode each notebook's queued configurations, starting from its last
+        # committed keyframe if the first is a delta
+        configs = []
+        for nb_name in set(q[1] for i, q in queued):
+            rows = [(i, q) for i, q in queued if q[1] == nb_name]
+            chain = []
+            if not rows[0][1][4]:
+                chain = self.execute_search('''SELECT time, nb_name, cell_order,
+                    version_order, keyframe FROM nb_configs WHERE nb_name = ?
+                    AND rowid >= (SELECT IFNULL(MAX(rowid), 0) FROM nb_configs
+                        WHERE nb_name = ? AND keyframe = 1) ORDER BY rowid''',
+                    (nb_name, nb_name))
+            decoded = decode_configs(chain + [q for i, q in rows])[len(chain):]
+            for (i, q), config in zip(rows, decoded):
+                configs.append((max_rowid + 1 + i,) + config + (q[4],))
+
+        configs.sort(key=lambda c: c[0])
+        return configs
 
 
     def get_last_nb_config(self, nb_name):
@@ -258,19 +1244,24 @@ class DbManager(object):
         nb_name: (str) hashed path to the notebook
         """
 
-        # Look for last nb_config in the queue
-        if len(self.nb_queue) > 0:
-            return self.nb_queue[-1]
+        with self.lock:
 
-        # Look for last nb_config in the database
-        else:
-            search = "SELECT * FROM nb_configs WHERE nb_name = \'" + nb_name + "\' ORDER BY time DESC LIMIT 1"
-            rows = self.execute_search(search)
+            # decode the last configuration from its keyframe if we have not
+            # seen this notebook yet, queued configurations are always cached
+            if nb_name not in self.last_configs:
+                search = '''SELECT time, nb_name, cell_order, version_order,
+                    keyframe FROM nb_configs WHERE nb_name = ? AND rowid >= (
+                        SELECT IFNULL(MAX(rowid), 0) FROM nb_configs
+                        WHERE nb_name = ? AND keyframe = 1) ORDER BY rowid'''
+                rows = self.execute_search(search, (nb_name, nb_name))
+                if len(rows) == 0:
+                    return []
+                last = decode_configs(rows)[-1]
+                self.last_configs[nb_name] = (last[0], last[2], last[3],
+                                                len(rows) - 1)
 
-            if len(rows) > 0:
-                return rows[0]
-            else:
-                return []
+            t, cell_order, version_order, since_keyframe = self.last_configs[nb_name]
+            return (t, nb_name, cell_order, version_order)
 
 
     def get_last_cell_version(self, cell_id):
@@ -280,157 +1271,871 @@ class DbManager(object):
         cell_id: (str) unique cell identifier to look for
         """
 
-        # look for last cell version in the queue
-        matched_in_queue = [q for q in self.cell_queue if q[1] == cell_id]
-        if len(matched_in_queue) > 0:
-            return matched_in_queue[-1]
+        with self.lock:
+
+            # look for last cell version in the queue
+            for q in reversed(self.cell_queue):
+                if q[1] == cell_id:
+                    return q
 
-        # otherwise look for cell version in the database
+            # otherwise look for cell version in the database
+            search = '''SELECT * FROM cells WHERE cell_id = ?
+                ORDER BY time DESC, rowid DESC LIMIT 1'''
+            rows = self.execute_search(search, (cell_id,))
+
+        if len(rows) > 0:
+            return rows[0]
         else:
-            search = "SELECT * FROM cells WHERE cell_id = \'" + cell_id + "\'"
-            rows = self.execute_search(search)
-            if len(rows) > 0:
-                return rows[-1]
-            else:
-                return (0,"","","")
+            return (0,"","","","",None,0,None,None)
+
+
+    def get_last_cell_versions(self, cell_ids):
+        """
+        Return dict of the last version of each of some cells with cell_id as
+        keys, looked up in the database with one query, cells with no
+        versions are left out
+
+        cell_ids: (list) unique cell identifiers to look for
+        """
+
+        with self.lock:
+
+            # the newest row of each cell, found from the (cell_id, time) index
+            search = '''SELECT * FROM cells WHERE rowid IN (
+                SELECT (SELECT rowid FROM cells WHERE cell_id = ids.value
+                    ORDER BY time DESC, rowid DESC LIMIT 1)
+                FROM json_each(?) AS ids)'''
+            rows = self.execute_search(search, (json.dumps(list(cell_ids)),))
+            last_versions = {r[1]: r for r in rows}
+
+            # unless a newer one is queued
+            wanted = set(cell_ids)
+            for q in self.cell_queue:
+                if q[1] in wanted:
+                    last_versions[q[1]] = q
+
+        return last_versions
+
+
+    def get_last_source(self, cell_id):
+        """
+        Return (version_id, source, deltas since its snapshot) of the last
+        version of a cell, or None if it has no versions
+
+        cell_id: (str) unique cell identifier
+        """
+
+        with self.lock:
+            if cell_id not in self.last_sources:
+                last = self.get_last_cell_version(cell_id)
+                if last[2] == "":
+                    return None
+                self.last_sources[cell_id] = (last[2],) + self.resolve_sources([last])[last[2]]
+            return self.last_sources[cell_id]
+
+
+    def resolve_sources(self, rows):
+        """
+        Return dict of (source, deltas applied) of cell versions with
+        version_id as keys, applying the deltas of versions stored as deltas
+        to the versions they are stored against
+
+        rows: (list) rows of the cells table
+        """
+
+        # find every version the rows' sources are stored against
+        known = {r[2]: r for r in rows}
+        wanted = set(r[7] for r in rows if r[7] is not None and r[7] not in known)
+        while len(wanted) > 0:
+            with self.lock:
+                for q in self.cell_queue:
+                    if q[2] in wanted:
+                        known[q[2]] = q
+                missing = [v for v in wanted if v not in known]
+                if len(missing) > 0:
+
+                    # follow the chains down to their snapshots in one query
+                    placeholders = ','.join(['(?)'] * len(missing))
+                    search = '''WITH RECURSIVE chain(version_id) AS (
+                            VALUES %s
+                            UNION
+                            SELECT cells.source_base FROM cells JOIN chain
+                                ON cells.version_id = chain.version_id
+                                WHERE cells.source_base IS NOT NULL)
+                        SELECT * FROM cells WHERE version_id IN chain''' % placeholders
+                    for r in self.execute_search(search, tuple(missing)):
+                        known[r[2]] = r
+            wanted = set(r[7] for r in known.values()
+                            if r[7] is not None and r[7] not in known)
+            if any(v not in known for v in missing):
+                raise ValueError('cell source delta chain is broken')
+
+        # then rebuild each source from its snapshot up, as lists of lines
+        sources = {}
+        for r in rows:
+            chain = []
+            version_id = r[2]
+            while version_id not in sources and known[version_id][7] is not None:
+                chain.append(known[version_id])
+                version_id = known[version_id][7]
+            if version_id not in sources:
+                PICKLE_LOADS.inc()
+                source = pickle.loads(known[version_id][3])['source']
+                sources[version_id] = (split_lines(source), 0)
+            for link in reversed(chain):
+                lines, depth = sources[link[7]]
+                sources[link[2]] = (apply_line_delta(lines, link[8]), depth + 1)
+
+        return {r[2]: (''.join(sources[r[2]][0]), sources[r[2]][1]) for r in rows}
+
+
+    def get_version_diff(self, from_id, to_id, paths=None):
+        """
+        Return dict with the line diff between the sources of two cell
+        versions and whether their outputs differ, or None if either is missing
+
+        from_id: (str) unique cell version identifier to diff from
+        to_id: (str) unique cell version identifier to diff to
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had, only needed to find sharded versions
+        """
+
+        with self.lock:
+            rows = [q for q in self.cell_queue if q[2] in (from_id, to_id)]
+            rows += self.execute_search('''SELECT * FROM cells
+                WHERE version_id IN (?, ?)''', (from_id, to_id))
+        rows = {r[2]: r for r in rows}
+        if from_id not in rows or to_id not in rows:
+            return None
+
+        sources = self.resolve_sources([rows[from_id], rows[to_id]])
+        return {
+            'from': from_id,
+            'to': to_id,
+            'hunks': line_diff(sources[from_id][0], sources[to_id][0]),
+            'outputs_changed': rows[from_id][5] != rows[to_id][5]
+        }
 
 
     def get_all_cell_versions(self, cell_id):
         """
-        Return list of all prior versions of cell
+        Return list of all prior versions of cell, newest first
 
         cell_id: (str) unique cell identifier
         """
 
-        # look for versions of a particular cell in the queue
-        matched_versions = [q for q in self.cell_queue if q[2] == cell_id].reverse()
-        if not matched_versions:
-            matched_versions = []
+        with self.lock:
+
+            # look for versions of a particular cell in the queue
+            matched_versions = [q for q in self.cell_queue if q[1] == cell_id]
+            matched_versions.reverse()
 
-        # look for versions of the cell in the database
-        search = "SELECT * FROM cells WHERE cell_id = \'" + cell_id + "\' ORDER BY time DESC"
-        rows = self.execute_search(search)
-        for row in rows:
-            matched_versions.append(row)
+            # look for versions of the cell in the database
+            search = '''SELECT * FROM cells WHERE cell_id = ?
+                ORDER BY time DESC'''
+            rows = self.execute_search(search, (cell_id,))
 
+        matched_versions.extend(rows)
         return matched_versions
 
 
-    def get_cell_history(self, path, start, end, cell_id):
+    def get_cell_version_by_fingerprint(self, cell_id, fingerprint):
         """
-        Return list of all versions of this cell
+        Return version_id of a prior version of a cell with the same content
 
-        path:
-        start:
-        end:
-        cell_id:
+        cell_id: (str) unique cell identifier
+        fingerprint: (str) content hash of the cell, see cell_fingerprint
         """
 
-        matched_versions = []
+        with self.lock:
+
+            # look for a matching version in the queue
+            for q in reversed(self.cell_queue):
+                if q[1] == cell_id and q[4] == fingerprint:
+                    return q[2]
+
+            # otherwise use the fingerprint index in the database
+            search = '''SELECT version_id FROM cells
+                WHERE cell_id = ? AND fingerprint = ? LIMIT 1'''
+            rows = self.execute_search(search, (cell_id, fingerprint))
+
+        if len(rows) > 0:
+            return rows[0][0]
+        else:
+            return None
+
+
+    def get_cell_history(self, paths, cell_id):
+        """
+        Return time-sorted list of all versions of this cell
 
-        # look for nb_configs in the queue
-        queued_versions = [q for q in self.cell_queue if q[1] == cell_id].reverse()
-        if(queued_versions):
-            for q in queued_versions:
-                matched_versions.append(q)
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        cell_id: (str) unique cell identifier
+        """
 
-        # look for older configs in the database
-        search = "SELECT * FROM cells WHERE cell_id = \'" + cell_id + "\' AND time BETWEEN " + str(start) + " and " + str(end)
-        rows = self.execute_search(search)
-        for row in rows:
-            matched_versions.append(row)
+        ranges = [(int(p[1]), int(p[2])) for p in paths]
+        if len(ranges) == 0:
+            return []
 
-        matched_versions.sort(key=lambda x: x[0])
+        with self.lock:
+
+            # look for older versions in the database
+            search = '''SELECT * FROM cells WHERE cell_id = ? AND ('''
+            search += ' OR '.join(['time BETWEEN ? AND ?'] * len(ranges)) + ')'
+            params = (cell_id,) + sum(ranges, ())
+            matched_versions = self.execute_search(search, params)
+
+            # and any newer ones in the queue
+            for q in self.cell_queue:
+                t = int(q[0])
+                if q[1] == cell_id and any(s <= t <= e for s, e in ranges):
+                    matched_versions.append(q)
+
+        matched_versions.sort(key=lambda x: int(x[0]))
+        contents = self.load_cells(matched_versions)
         version_arr = []
-        for m in matched_versions:
+        for m, content in zip(matched_versions, contents):
             v_dict = {
                 "name":"",
                 "cell_id": cell_id,
                 "version_id": m[2],
-                "content": pickle.loads(m[3])
+                "time": m[0],
+                "content": content
             }
             version_arr.append(v_dict)
 
         return version_arr
 
 
-    def get_versions(self, version_ids):
+    def get_cell_history_state(self, paths, cell_id):
+        """
+        Return (count, last rowid, queued version ids) of the versions
+        get_cell_history would return, which changes whenever its result does,
+        without loading any versions
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        cell_id: (str) unique cell identifier
+        """
+
+        ranges = [(int(p[1]), int(p[2])) for p in paths]
+        if len(ranges) == 0:
+            return (0, None, [])
+
+        with self.lock:
+            search = '''SELECT COUNT(*), MAX(rowid) FROM cells WHERE cell_id = ? AND ('''
+            search += ' OR '.join(['time BETWEEN ? AND ?'] * len(ranges)) + ')'
+            params = (cell_id,) + sum(ranges, ())
+            count, last_rowid = self.execute_search(search, params)[0]
+
+            queued = []
+            for q in self.cell_queue:
+                t = int(q[0])
+                if q[1] == cell_id and any(s <= t <= e for s, e in ranges):
+                    queued.append(q[2])
+
+        return (count, last_rowid, queued)
+
+
+    def get_version_summaries(self, paths, cell_ids, nb_name):
+        """
+        Return dict of time-sorted version summaries with cell_id as keys.
+        Summaries hold what we need to show version markers but not the
+        content of each version, which can be fetched with get_versions
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        cell_ids: (list) unique identifiers of the cells in the notebook
+        nb_name: (str) hashed path to the notebook, whose last configuration
+            tells us which version of each cell is current
         """
-        Return dict of particular cell versions with cell_id as keys
+
+        ranges = [(int(p[1]), int(p[2])) for p in paths]
+        if len(ranges) == 0 or len(cell_ids) == 0:
+            return {}
+
+        with self.lock:
+
+            # look for versions in the database, a chunk of cells at a time
+            # to stay under sqlite's limit on the number of query parameters
+            matched_versions = []
+            time_clause = ' OR '.join(['time BETWEEN ? AND ?'] * len(ranges))
+            cell_ids = list(cell_ids)
+            for i in range(0, len(cell_ids), 500):
+                chunk = cell_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                search = '''SELECT time, cell_id, version_id, has_content FROM cells
+                    WHERE cell_id IN (%s) AND (%s)''' % (placeholders, time_clause)
+                params = tuple(chunk) + sum(ranges, ())
+                matched_versions += self.execute_search(search, params)
+
+            # and any newer ones in the queue
+            wanted = set(cell_ids)
+            for q in self.cell_queue:
+                t = int(q[0])
+                if q[1] in wanted and any(s <= t <= e for s, e in ranges):
+                    matched_versions.append((q[0], q[1], q[2], q[6]))
+
+            last_config = self.get_last_nb_config(nb_name)
+
+        current = set(last_config[3]) if last_config else set()
+        matched_versions.sort(key=lambda x: int(x[0]))
+        summaries = {}
+        for m in matched_versions:
+            summaries.setdefault(m[1], []).append({
+                "name": "",
+                "cell_id": m[1],
+                "version_id": m[2],
+                "time": m[0],
+                "has_content": bool(m[3]),
+                "is_current": m[2] in current
+            })
+
+        return summaries
+
+
+    def get_versions(self, version_ids, paths=None):
+        """
+        Return dict of particular cell versions with version_id as keys
 
         version_ids: (list) unique cell version identifiers
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had, only needed to find sharded versions
         """
 
-        # look for particular versions in the queue
-        matched_in_queue = [q for q in self.cell_queue if q[2] == version_id]
-        if not matched_in_queue:
-            matched_in_queue = []
+        with self.lock:
 
-        # look for particular versions in the database
-        if len(version_ids) > 1:
-            version_ids = str(tuple(version_ids))
-            search = "SELECT * FROM cells WHERE version_id in " + version_ids
-        else:
-            search = "SELECT * FROM cells WHERE version_id = \'" + version_ids[0] + "\'"
-        rows = self.execute_search(search)
-        for row in rows:
-            matched_in_queue.append(row)
+            # look for particular versions in the database, a chunk at a time
+            # to stay under sqlite's limit on the number of query parameters
+            matched_versions = []
+            for i in range(0, len(version_ids), 500):
+                chunk = tuple(version_ids[i:i + 500])
+                placeholders = ','.join('?' * len(chunk))
+                search = 'SELECT * FROM cells WHERE version_id IN (%s)' % placeholders
+                matched_versions += self.execute_search(search, chunk)
+
+            # and in the queue
+            wanted = set(version_ids)
+            for q in self.cell_queue:
+                if q[2] in wanted:
+                    matched_versions.append(q)
 
         cell_dict = {}
-        for m in matched_in_queue:
-            cell_dict[m[2]] = pickle.loads(m[3])
+        for m, content in zip(matched_versions, self.load_cells(matched_versions)):
+            cell_dict[m[2]] = content
 
         return cell_dict
 
 
-    def export_data_and_clean(self, nb_name, drop_all = False):
+    def count_nb_configs(self, paths):
+        """
+        Return number of configurations under any of the notebook's paths
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        """
+
+        if len(paths) == 0:
+            return 0
+        clause, params = history_clause(paths)
+        with self.lock:
+            total = self.execute_search('''SELECT COUNT(*) FROM nb_configs
+                WHERE %s''' % clause, params)[0][0]
+            total += sum(1 for q in self.nb_queue if in_ranges(q[1], q[0], paths))
+        return total
+
+
+    def find_snapshot(self, paths, at = None, index = None):
+        """
+        Return dict with the rowid, time, nb_name, cell_order and version_order
+        of the configuration shown at a time or position in the notebook's
+        history, committed or queued, its index and the total number of
+        configurations, and the rowid and time of the keyframe it is decoded
+        from, or None if there is none
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        at: (int) time to show the notebook at, the newest configuration
+            recorded at or before it is used
+        index: (int) position of the configuration, oldest first, used if at
+            is None, if both are None the newest configuration is used
+        """
+
+        if len(paths) == 0 or (at is None and index is not None and int(index) < 0):
+            return None
+
+        ranges, params = history_clause(paths)
+        with self.lock:
+            search = 'SELECT rowid, time, nb_name FROM nb_configs WHERE (%s)' % ranges
+            count = '''SELECT COUNT(*) FROM nb_configs
+                WHERE (%s) AND (time, rowid) < (?, ?)''' % ranges
+
+            # queued configurations sort after committed ones with the same
+            # time, as the rowids they will be committed with are higher
+            queued = [q for q in self.queued_nb_configs(set(p[0] for p in paths))
+                        if in_ranges(q[2], q[1], paths)]
+            queued.sort(key=lambda q: (int(q[1]), q[0]))
+
+            found = None
+            if at is not None or index is None:
+                if at is not None:
+                    rows = self.execute_search(search + ''' AND time <= ?
+                        ORDER BY time DESC, rowid DESC LIMIT 1''', params + (int(at),))
+                    queued_before = [q for q in queued if int(q[1]) <= int(at)]
+                else:
+                    rows = self.execute_search(search + '''
+                        ORDER BY time DESC, rowid DESC LIMIT 1''', params)
+                    queued_before = queued
+                if len(queued_before) > 0 and (len(rows) == 0 or
+                        (int(rows[0][1]), rows[0][0]) < (int(queued_before[-1][1]),
+                                                        queued_before[-1][0])):
+                    found = queued_before[-1]
+                elif len(rows) > 0:
+                    found = rows[0]
+                if found is None:
+                    return None
+                index = self.execute_search(count, params + (int(found[1]), found[0]))[0][0]
+                index += sum(1 for q in queued if (int(q[1]), q[0]) < (int(found[1]), found[0]))
+
+            else:
+                # each queued configuration comes after the committed ones
+                # before it and the queued ones before it
+                index = int(index)
+                skipped = 0
+                for i, q in enumerate(queued):
+                    position = self.execute_search(count,
+                        params + (int(q[1]), q[0]))[0][0] + i
+                    if position == index:
+                        found = q
+                        break
+                    if position < index:
+                        skipped += 1
+                if found is None:
+                    rows = self.execute_search(search + '''
+                        ORDER BY time, rowid LIMIT 1 OFFSET ?''',
+                        params + (index - skipped,))
+                    if len(rows) == 0:
+                        return None
+                    found = rows[0]
+
+            rowid, t, nb_name = found[:3]
+            total = self.count_nb_configs(paths)
+
+            # a queued configuration is decoded already, and its keyframe is
+            # the last one queued before it or the last committed one
+            committed_keyframe = self.execute_search('''SELECT rowid, time
+                FROM nb_configs WHERE nb_name = ? AND keyframe = 1 AND rowid <= ?
+                ORDER BY rowid DESC LIMIT 1''', (nb_name, rowid))
+            keyframe, keyframe_time = (committed_keyframe or [(0, 0)])[0]
+            if len(found) > 3:
+                cell_order, version_order = found[3], found[4]
+                for q in self.queued_nb_configs(set([nb_name])):
+                    if q[0] <= rowid and q[5]:
+                        keyframe, keyframe_time = q[0], q[1]
+            else:
+                config = self.rebuild_nb_configs(nb_name, rowid, rowid)[0]
+                cell_order, version_order = config[3], config[4]
+
+        return {
+            'rowid': rowid,
+            'time': t,
+            'nb_name': nb_name,
+            'cell_order': cell_order,
+            'version_order': version_order,
+            'index': int(index),
+            'total': total,
+            'keyframe': keyframe,
+            'keyframe_time': keyframe_time
+        }
+
+
+    def build_checkpoint(self, version_ids):
         """
-        copy cells table into analysis table that will scrub private nb data but keep
-        relevant data like metadata, loc, counts, etc. for analysis
+        Return dict of [cell without outputs, output hashes] of cell versions
+        with version_id as keys, to store as the checkpoint of a keyframe
+        configuration, see janus_snapshots
+
+        version_ids: (list) unique cell version identifiers in the keyframe
+        """
+
+        with self.lock:
+            cell_rows = []
+            for i in range(0, len(version_ids), 500):
+                chunk = tuple(version_ids[i:i + 500])
+                placeholders = ','.join('?' * len(chunk))
+                cell_rows += self.execute_search('''SELECT * FROM cells
+                    WHERE version_id IN (%s)''' % placeholders, chunk)
+            wanted = set(version_ids)
+            cell_rows += [q for q in self.cell_queue if q[2] in wanted]
+
+        # rebuild the sources of the versions once, keeping outputs apart
+        sources = self.resolve_sources([r for r in cell_rows if r[7] is not None])
+        PICKLE_LOADS.inc(len(cell_rows))
+        cells = {}
+        for r in cell_rows:
+            cell = pickle.loads(r[3])
+            if r[2] in sources:
+                cell['source'] = sources[r[2]][0]
+            cells[r[2]] = [cell, json.loads(r[5]) if r[5] is not None else None]
+        return cells
+
+
+    def get_checkpoint(self, nb_name, keyframe, keyframe_time):
+        """
+        Return dict of [cell without outputs, output hashes] of the versions
+        of a keyframe configuration with version_id as keys, committed or
+        queued, or an empty dict if it has no checkpoint
+
+        nb_name: (str) hashed path to the notebook
+        keyframe: (int) rowid of the keyframe configuration
+        keyframe_time: (int) time of the keyframe configuration, which finds
+            its checkpoint while that is queued
+        """
+
+        with self.lock:
+            rows = self.execute_search('''SELECT cells FROM nb_checkpoints
+                WHERE config_rowid = ? AND nb_name = ?''', (keyframe, nb_name))
+            rows += [q[2:] for q in self.checkpoint_queue
+                        if q[1] == nb_name and int(q[0]) == int(keyframe_time)]
+        if len(rows) == 0:
+            return {}
+        return decode_checkpoint(rows[-1][0])
+
+
+    def make_checkpoints(self):
+        """
+        Checkpoint keyframe configurations that do not have one, which were
+        recorded before checkpoints were, or re-encoded by maintenance, one at
+        a time from a background thread
+        """
+
+        try:
+            keyframes = self.execute_search('''SELECT rowid, nb_name FROM nb_configs
+                WHERE keyframe = 1 AND rowid NOT IN (
+                    SELECT config_rowid FROM nb_checkpoints) ORDER BY rowid''')
+            for rowid, nb_name in keyframes:
+                if self.closed:
+                    return
+                configs = self.rebuild_nb_configs(nb_name, rowid, rowid)
+                if len(configs) == 0:
+                    continue
+                cells = encode_checkpoint(self.build_checkpoint(configs[0][4]))
+                with self.lock:
+                    if self.closed:
+                        return
+                    c = self.conn.cursor()
+                    try:
+                        c.execute('''INSERT OR REPLACE INTO nb_checkpoints
+                            (config_rowid, nb_name, cells) SELECT rowid, nb_name, ?
+                            FROM nb_configs WHERE rowid = ? AND keyframe = 1''',
+                            (cells, rowid))
+                        self.conn.commit()
+                    except:
+                        self.conn.rollback()
+                        raise
+        except Exception:
+            if not self.closed:
+                logging.getLogger(__name__).exception(
+                    'Janus could not checkpoint notebook history')
+
+
+    def get_snapshot_cells(self, snapshot, version_ids):
+        """
+        Return list of the cell versions of a snapshot, in order, loading the
+        ones its keyframe's checkpoint has from it
+
+        snapshot: (dict) configuration found by find_snapshot
+        version_ids: (list) unique cell version identifiers in the snapshot
+        """
+
+        checkpoint = self.get_checkpoint(snapshot['nb_name'], snapshot['keyframe'],
+                                            snapshot['keyframe_time'])
+        hashes = set()
+        for v in version_ids:
+            if v in checkpoint and checkpoint[v][1] is not None:
+                hashes.update(checkpoint[v][1])
+        outputs = self.get_outputs(hashes)
+        versions = self.get_versions([v for v in version_ids if v not in checkpoint])
+
+        cells = []
+        for v in version_ids:
+            if v in checkpoint:
+                cells.append(snapshot_cell(join_outputs(checkpoint[v][0],
+                                            checkpoint[v][1], outputs), v))
+            elif v in versions:
+                cells.append(snapshot_cell(versions[v], v))
+        return cells
+
+
+    def get_snapshot(self, paths, at = None, index = None):
+        """
+        Return .ipynb shaped document of the notebook at a time or position in
+        its history, see find_snapshot, or None if there is no such
+        configuration
+
+        paths: (list) of [hashed_path, start_time, end_time] for each path the
+            notebook has had
+        at: (int) time to show the notebook at
+        index: (int) position of the configuration, oldest first
+        """
+
+        snapshot = self.find_snapshot(paths, at, index)
+        if snapshot is None:
+            return None
+        document = notebook_header(snapshot)
+        document['cells'] = self.get_snapshot_cells(snapshot,
+                                                    snapshot['version_order'])
+        return document
+
+
+    def get_outputs(self, hashes):
+        """
+        Return dict of decompressed outputs with their hashes as keys
+
+        hashes: (list) hashes of the outputs, see janus_outputs.output_hash
+        """
+
+        outputs = {}
+        wanted = set(hashes)
+        with self.lock:
+
+            # look for outputs in the queue
+            for q in self.output_queue:
+                if q[0] in wanted:
+                    outputs[q[0]] = decompress_output(q[1])
+            wanted.difference_update(outputs)
+
+            # and in the database, a chunk at a time to stay under sqlite's
+            # limit on the number of query parameters
+            wanted = list(wanted)
+            for i in range(0, len(wanted), 500):
+                chunk = wanted[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                search = 'SELECT * FROM outputs WHERE hash IN (%s)' % placeholders
+                for row in self.execute_search(search, tuple(chunk)):
+                    outputs[row[0]] = decompress_output(row[1])
+
+        return outputs
+
+
+    def load_cells(self, rows, use_cache = True):
+        """
+        Return list of cell versions rebuilt from rows of the cells table.
+        Versions may be shared through the version cache, so must not be
+        modified
+
+        rows: (list) rows of the cells table
+        use_cache: (bool) whether to look for and keep versions in the cache,
+            which one-off scans of many versions should not fill
+        """
+
+        cells = [None] * len(rows)
+        if use_cache:
+            for i, r in enumerate(rows):
+                cells[i] = self.version_cache.get(r[2])
+        missing = [i for i, cell in enumerate(cells) if cell is None]
+
+        # get the outputs of all the rows we have to decode at once
+        refs = {}
+        hashes = set()
+        for i in missing:
+            if rows[i][5] is not None:
+                refs[i] = json.loads(rows[i][5])
+                hashes.update(refs[i])
+        outputs = self.get_outputs(hashes)
+
+        # and the sources of rows stored as deltas
+        sources = self.resolve_sources([rows[i] for i in missing
+                                        if rows[i][7] is not None])
+
+        PICKLE_LOADS.inc(len(missing))
+        for i in missing:
+            cells[i] = join_outputs(pickle.loads(rows[i][3]), refs.get(i), outputs)
+            if rows[i][2] in sources:
+                cells[i]['source'] = sources[rows[i][2]][0]
+            if use_cache:
+                self.version_cache.put(rows[i][2], cells[i])
+
+        return cells
+
+
+    def start_export(self, nb_name, drop_all = False):
+        """
+        Start exporting in a background thread and return its ExportJob, or
+        the job already exporting this database, since only one can run at once
+
+        nb_name: (str) hashed path to the notebook requesting the export
         drop_all: if the analysis table is dropped and refreshed with cells table
         """
-        search = '''SELECT time, cell_id, version_id, cell_data FROM cells WHERE 1'''
-        insert = '''INSERT INTO cleaned_cells VALUES (?,?,?,?,?,?,?,?,?,?,?,?)'''
-        tuplst = []
-        self.conn = sqlite3.connect(self.db_path)
-        self.c = self.conn.cursor()
+
+        with self.lock:
+            if self.export_job is not None and self.export_job.is_running():
+                return self.export_job
+
+            job = ExportJob(nb_name, drop_all)
+            self.export_job = job
+            self.export_jobs[job.id] = job
+
+        thread = threading.Thread(target=self.run_export, args=(job,),
+                                    name='janus-export-' + job.id)
+        thread.daemon = True
+        thread.start()
+        return job
+
+
+    def run_export(self, job):
+        """
+        Run an export job, recording how it stopped
+
+        job: (obj) ExportJob to run
+        """
+
         try:
-            self.c.execute(search)
-            rows = self.c.fetchall()
-            for r in rows:
-                time = r[0]
-                cell_id = r[1]
-                version_id = r[2]
-                cucumber = pickle.loads(r[3])
-                data_dict = {"meta_data": [], "line_count": 0, "function_count":0,
-                    "cell_count":0, "lines_of_code":0, "markdown_word_count":0, "output_count":0, "types":{"markdown":0,"code":0}}
-                # for d in cucumber:
-                #     for c in d:
-                data_dict["meta_data"].append(cucumber["metadata"])  # metadata obj
-                data_dict["cell_count"] += 1  # how many individual cells
-                data_dict["types"][cucumber["cell_type"]] += 1  # how many markdown and code cells
-                if cucumber["cell_type"] == "code":
-                    data_dict["lines_of_code"] += len(cucumber["source"].splitlines(True))  # LOC for code cells
-                    data_dict["output_count"] += len(cucumber["outputs"])  # count for **amount** of output
-                elif cucumber["cell_type"] == "markdown":
-                    data_dict["markdown_word_count"] += len(re.findall("(\S+)", cucumber["source"]))
-                data_dict["line_count"] += len(cucumber["source"].splitlines(True))  # count for all cells
-
-                        # TODO count functions for all code cells? (AST analysis needed)
-                        # TODO How to tell the different types of output? (current counted)
-                        # TODO REMOVE DATA COLUMN?? (currently purged)!!
-                        # TODO what is content tag? and what does the code strings inside represent?
-                row_tupe = (str(time), str(cell_id), str(version_id), "CLEARED", str(data_dict["meta_data"]),
-                    str(data_dict["line_count"]), str(data_dict["function_count"]), str(data_dict["cell_count"]),
-                    str(data_dict["lines_of_code"]), str(data_dict["markdown_word_count"]), str(data_dict["output_count"]),
-                    str(data_dict["types"]))
-                tuplst.append(row_tupe)
-            self.c.executemany(insert, tuplst)
-            self.conn.commit()
-            self.conn.close()
-            print("exported")
-        except:
-            print("exception")
-            self.conn.rollback()
-            self.conn.close()
-            raise
+            self.export_data_and_clean(job.nb_name, job.drop_all, job)
+        except Exception as e:
+            logging.getLogger(__name__).exception('Janus export failed')
+            job.finish('failed', str(e))
+        else:
+            if job.cancel_requested.is_set():
+                job.finish('cancelled')
+            else:
+                job.finish('done')
+
+
+    def get_export_job(self, job_id):
+        """
+        Return ExportJob with a particular id, or None if there is no such job
+
+        job_id: (str) id of the export job
+        """
+
+        with self.lock:
+            return self.export_jobs.get(job_id)
+
+
+    def export_data_and_clean(self, nb_name, drop_all = False, job = None):
+        """
+        copy cell versions recorded since the last export into an analysis
+        table that will scrub private nb data but keep relevant data like
+        metadata, loc, counts, etc. for analysis
+
+        nb_name: (str) hashed path to the notebook requesting the export
+        drop_all: if the analysis table is dropped and refreshed with cells table
+        job: (obj) ExportJob to report progress to and check for cancellation
+        """
+
+        self.flush()
+        if drop_all:
+            with self.lock:
+                c = self.conn.cursor()
+                c.execute('DELETE FROM cleaned_cells')
+                c.execute("UPDATE export_state SET last_rowid = 0 WHERE name = 'cleaned_cells'")
+                self.conn.commit()
+
+        with self.lock:
+            rows = self.execute_search(
+                "SELECT last_rowid FROM export_state WHERE name = 'cleaned_cells'")
+            last_rowid = rows[0][0] if rows else 0
+            if job is not None:
+                job.rows_total = self.execute_search(
+                    'SELECT COUNT(*) FROM cells WHERE rowid > ?', (last_rowid,))[0][0]
+
+        # summarize chunks in worker processes while we read the next ones,
+        # with a bounded number of chunks in flight so memory stays bounded
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.export_workers, mp_context=context) as pool:
+            pending = collections.deque()
+            while True:
+                rows = []
+                if job is None or not job.cancel_requested.is_set():
+                    rows = self.read_export_chunk(last_rowid)
+                if len(rows) > 0:
+                    last_rowid = rows[-1][0]
+                    pending.append((last_rowid, len(rows),
+                        pool.submit(summarize_rows, [r[1:] for r in rows])))
+                if len(pending) > 0 and (len(rows) == 0
+                                         or len(pending) > self.export_workers):
+                    chunk_rowid, num_rows, summaries = pending.popleft()
+                    self.save_export_chunk(summaries.result(), chunk_rowid)
+                    if job is not None:
+                        job.rows_done += num_rows
+                elif len(rows) == 0:
+                    break
+
+
+    def read_export_chunk(self, last_rowid):
+        """
+        Return next chunk of (rowid, time, cell_id, version_id, cell_data,
+        output_refs, source) rows of the cells table to export, where source
+        is the rebuilt source of versions stored as deltas, or None
+
+        last_rowid: (int) rowid of the last cell version already read
+        """
+
+        with self.lock:
+            search = '''SELECT rowid, * FROM cells WHERE rowid > ?
+                ORDER BY rowid LIMIT ?'''
+            rows = self.execute_search(search, (last_rowid, EXPORT_CHUNK_SIZE))
+        sources = self.resolve_sources([r[1:] for r in rows if r[8] is not None])
+        return [r[:5] + (r[6], sources[r[3]][0] if r[3] in sources else None)
+                for r in rows]
+
+
+    def save_export_chunk(self, summaries, last_rowid):
+        """
+        Save a chunk of cleaned_cells rows and move the export watermark past
+        it in one transaction, so an interrupted export resumes where it stopped
+
+        summaries: (list) rows of the cleaned_cells table
+        last_rowid: (int) rowid of the last cell version in the chunk
+        """
+
+        insert = '''INSERT INTO cleaned_cells (time, cell_id, version_id,
+            cell_data, meta_data, line_count, function_count, cell_count,
+            lines_of_code, words_of_markdown, output_count, types)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)'''
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                c.executemany(insert, summaries)
+                c.execute('''INSERT OR REPLACE INTO export_state (name, last_rowid)
+                    VALUES ('cleaned_cells', ?)''', (last_rowid,))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+
+
+def collect_db_metrics():
+    """
+    Return gauges of the queues, cache, and file size of every open database,
+    see janus_metrics.Registry.add_collector
+    """
+
+    queues = []
+    sizes = []
+    cached = []
+    for db in list(_open_managers):
+        if db.closed:
+            continue
+        name = os.path.basename(db.db_path)
+        for queue_name in ('action', 'cell', 'nb', 'log', 'comment', 'output',
+                            'search', 'checkpoint'):
+            depth = len(getattr(db, queue_name + '_queue'))
+            queues.append(({'db': name, 'queue': queue_name}, depth))
+        size = sum(os.path.getsize(p) for p in (db.db_path, db.db_path + '-wal')
+                    if os.path.exists(p))
+        sizes.append(({'db': name}, size))
+        stats = db.version_cache.stats()
+        for key in ('versions', 'bytes', 'hits', 'misses'):
+            cached.append(({'db': name, 'stat': key}, stats[key]))
+
+    return [
+        ('janus_queue_depth', 'Records waiting to be committed', queues),
+        ('janus_db_bytes', 'Size of the database and its write ahead log', sizes),
+        ('janus_version_cache', 'Size and hit counts of the version cache', cached)
+    ]
+
+
+REGISTRY.add_collector(collect_db_metrics)
@@ -48,7 +48,100 @@ define([
             contentType: 'application/json',
         };
 
-        // send the POST request,
+        // the export runs in the background, so show its progress until it
+        // stops, rather than waiting on the request
+        var progress = $('<p id="export-progress"/>').text('Starting export...');
+        var modal_body = $('<div/>').append(progress);
+        var jobId = null;
+        var mod = dialog.modal({
+            title: 'Export Cleaned DB',
+            body: modal_body,
+            buttons: {
+                'Cancel Export': {
+                    click: function () {
+                        if (jobId) {
+                            cancelExport(url, jobId);
+                        }
+                    }
+                },
+                'Close': {}
+            },
+            notebook: Jupyter.notebook,
+            keyboard_manager: Jupyter.notebook.keyboard_manager,
+        });
+
+        utils.promising_ajax(url, settings).then( function(value) {
+            jobId = value['export']['id'];
+            pollExportStatus(url, value['export'], progress);
+        });
+    }
+
+
+    function pollExportStatus(url, job, progress) {
+        /* show the progress of an export, checking again until it stops
+
+        Args:
+            url: url of the Janus handler for this notebook
+            job: last reported status of the export
+            progress: element to show the progress in
+        */
+
+        var text = job['rows_done'] + ' of ' + job['rows_total'] + ' cell versions exported'
+        if (job['status'] == 'running') {
+            text += ' (' + job['rows_per_second'] + ' per second)'
+        } else if (job['status'] == 'failed') {
+            text = 'Export failed: ' + job['error']
+        } else {
+            text += ', export ' + job['status']
+        }
+        progress.text(text);
+
+        if (job['status'] != 'running') {
+            return
+        }
+
+        var settings = {
+            type : 'GET',
+            cache: false,
+            data: {
+                q: 'export_status',
+                job_id: job['id']
+            },
+        };
+
+        setTimeout( function() {
+            utils.promising_ajax(url, settings).then( function(value) {
+                var d = JSON.parse(value);
+                if (d['export']) {
+                    pollExportStatus(url, d['export'], progress);
+                }
+            });
+        }, 1000);
+    }
+
+
+    function cancelExport(url, jobId) {
+        /* ask a running export to stop
+
+        Args:
+            url: url of the Janus handler for this notebook
+            jobId: id of the export to stop
+        */
+
+        var d = JSON.stringify({
+            time: Date.now(),
+            type: 'cancel_export',
+            job_id: jobId
+        });
+
+        var settings = {
+            processData : false,
+            type : 'POST',
+            dataType: 'json',
+            data: d,
+            contentType: 'application/json',
+        };
+
         utils.promising_ajax(url, settings);
     }
 
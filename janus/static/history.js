@@ -72,9 +72,26 @@ define([
     ];
 
 
+    // the notebook configuration the server last told us about, and the
+    // fingerprints of the cells we sent it, so we only send changed cells
+    var configToken = null;
+    var sentFingerprints = {};
+    var lastRequest = 0;
+    var lastAcked = 0;
+
+    // actions waiting to be sent together, how long (ms) to wait for more
+    // actions after each one, and the longest an action waits to be sent
+    var pendingActions = [];
+    var firstPending = null;
+    var sendTimer = null;
+    var COALESCE_DELAY = 300;
+    var COALESCE_MAX_WAIT = 2000;
+
+
     // TRACK GENERAL ACTIONS
     function trackAction(nb, t, actionName, selIndex, selIndices) {
-        /* Send information about action to server to process and save
+        /* Queue information about action to send to the server with any
+        other actions that follow it closely
 
         Args:
             nb: the notebook
@@ -85,62 +102,219 @@ define([
         */
 
         if (Notebook.metadata.janus.track_history) {
-
-            // get url to send POST request
-            var baseUrl = nb.base_url;
-            var nbUrl =  nb.notebook_path;
-            var url = utils.url_path_join(baseUrl, 'api/janus', nbUrl);
-
-            // get data ready
-            var mod = nb.toJSON();
-            var d = JSON.stringify({
+            pendingActions.push({
                 time: t,
                 name: actionName,
                 index: selIndex,
-                indices: selIndices,
-                model: mod,
-                type: 'action'
+                indices: selIndices
             });
 
-            // prepare POST settings
-            var settings = {
-                processData : false,
-                type : 'POST',
-                dataType: 'json',
-                data: d,
-                contentType: 'application/json',
+            // wait a little for more actions, but not past the longest wait
+            var now = Date.now();
+            if (firstPending == null) {
+                firstPending = now;
+            }
+            var wait = Math.min(COALESCE_DELAY,
+                                firstPending + COALESCE_MAX_WAIT - now);
+            clearTimeout(sendTimer);
+            sendTimer = setTimeout(function() {
+                sendActions(nb, takePendingActions(), false);
+            }, Math.max(wait, 0));
+        }
+    }
+
+
+    function takePendingActions() {
+        /* Return the actions waiting to be sent, and stop waiting to send them */
+
+        var actions = pendingActions;
+        pendingActions = [];
+        firstPending = null;
+        clearTimeout(sendTimer);
+        sendTimer = null;
+        return actions;
+    }
+
+
+    function actionBatch(nb, actions, sendFull) {
+        /* Return data to send the server about actions, with the notebook as
+        it is now, and the fingerprints of the cells in it
+
+        Args:
+            nb: the notebook
+            actions: list of actions, oldest first
+            sendFull: send the full notebook even if the server has seen it
+        */
+
+        var data = {
+            actions: actions,
+            type: 'action_batch',
+            nb_id: Notebook.metadata.janus.nb_id || null
+        };
+
+        // a notebook resent without actions is as it is now
+        if (actions.length == 0) {
+            data.time = Date.now();
+        }
+
+        // until the server gives the notebook an id, send the paths it
+        // was saved under so they are registered under that id
+        if (! data.nb_id) {
+            data.filepaths = Notebook.metadata.janus.filepaths;
+        }
+
+        // fingerprint each cell so we know which changed since last time
+        var fullModel = sendFull || configToken == null;
+        var mod = null;
+        var cellJSONs = [];
+        if (fullModel) {
+            mod = nb.toJSON();
+            cellJSONs = mod.cells;
+        } else {
+            var cells = nb.get_cells();
+            for (var i = 0; i < cells.length; i++) {
+                cellJSONs.push(cells[i].toJSON());
+            }
+        }
+
+        var fingerprints = {};
+        var cellOrder = [];
+        var changedCells = {};
+        for (var i = 0; i < cellJSONs.length; i++) {
+            var cellID = cellJSONs[i].metadata.janus.id;
+            fingerprints[cellID] = JanusUtils.hashCellContent(cellJSONs[i]);
+            cellOrder.push(cellID);
+            if (fingerprints[cellID] != sentFingerprints[cellID]) {
+                changedCells[cellID] = cellJSONs[i];
+            }
+        }
+
+        // send the whole notebook, or just the changes since last time
+        if (fullModel) {
+            data.model = mod;
+        } else {
+            data.delta = {
+                cell_order: cellOrder,
+                cells: changedCells,
+                base: configToken
             };
+        }
+        return {data: data, fingerprints: fingerprints};
+    }
+
+
+    function actionsUrl(nb) {
+        /* Return url to POST actions in the notebook to */
+
+        return utils.url_path_join(nb.base_url, 'api/janus', nb.notebook_path);
+    }
 
-            // send POST request,
-            utils.promising_ajax(url, settings).then( function(value) {
-                saveNBPath(value, t)
+
+    function sendActions(nb, actions, sendFull) {
+        /* Send actions to server to process and save in one request
+
+        Args:
+            nb: the notebook
+            actions: list of actions, oldest first
+            sendFull: send the full notebook even if the server has seen it
+        */
+
+        if (actions.length == 0 && ! sendFull) {
+            return;
+        }
+        var batch = actionBatch(nb, actions, sendFull);
+
+        // prepare POST settings
+        var settings = {
+            processData : false,
+            type : 'POST',
+            dataType: 'json',
+            data: JSON.stringify(batch.data),
+            contentType: 'application/json',
+        };
+
+        // send POST request,
+        var requestNum = ++lastRequest;
+        utils.promising_ajax(actionsUrl(nb), settings).then( function(value) {
+
+            // server lost track of our notebook, so send all of it, but not
+            // the actions again since those were saved already
+            if (value['resend']) {
+                sendActions(nb, [], true);
+                return;
+            }
+
+            // remember what the server has seen, unless a newer request
+            // already came back
+            if (requestNum > lastAcked) {
+                lastAcked = requestNum;
+                configToken = value['config_token'];
+                sentFingerprints = batch.fingerprints;
+            }
+            saveNBId(value);
+        });
+    }
+
+
+    function sendActionsOnUnload(nb, actions) {
+        /* Send actions as the page unloads, with a beacon the browser
+        delivers after the page is gone. Nothing can be resent once the page
+        is gone, so send the full notebook unless the server has seen every
+        earlier request
+
+        Args:
+            nb: the notebook
+            actions: list of actions, oldest first
+        */
+
+        // beacons can't set headers, so pass the XSRF token in the url
+        var xsrf = document.cookie.match(/(?:^|;\s*)_xsrf=([^;]*)/);
+        var url = actionsUrl(nb);
+        if (xsrf) {
+            url += '?_xsrf=' + encodeURIComponent(xsrf[1]);
+        }
+
+        var sendFull = lastRequest > lastAcked || configToken == null;
+        var data = JSON.stringify(actionBatch(nb, actions, sendFull).data);
+
+        // a text/plain beacon is sent without a CORS preflight
+        if (navigator.sendBeacon) {
+            var blob = new Blob([data], {type: 'text/plain;charset=UTF-8'});
+            if (navigator.sendBeacon(url, blob) || ! sendFull || configToken == null) {
+                return;
+            }
+
+            // the browser refuses beacons too large to queue, so send only
+            // the changes, the server saves the actions even if it can't
+            // apply them
+            data = JSON.stringify(actionBatch(nb, actions, false).data);
+            blob = new Blob([data], {type: 'text/plain;charset=UTF-8'});
+            navigator.sendBeacon(url, blob);
+        } else if (window.fetch) {
+            fetch(url, {
+                method: 'POST',
+                body: data,
+                keepalive: true,
+                credentials: 'same-origin',
+                headers: {'Content-Type': 'text/plain;charset=UTF-8'}
             });
         }
     }
 
 
-    function saveNBPath(value, t) {
-        /* save metadata that this nb path was in use at this time
+    function saveNBId(value) {
+        /* save the stable id the server knows the notebook by
 
-        used later when requesting historical data from the db. We need
-        to know all prior names of the notebook for an accurate query
+        used later when requesting historical data from the db. The server
+        keeps track of every path the notebook has been saved under, and
+        gives a copy of the notebook an id of its own
 
         Args:
             value: return value of the AJAX request
-            t: time of action that prompted check
         */
 
-        var hashedNBPath = value['hashed_nb_path']
-        var paths = Notebook.metadata.janus.filepaths
-        var numPaths = paths.length
-
-        // save any new filenames for future queries, or update time on current
-        if (numPaths == 0) {
-            paths.push([hashedNBPath, t, t])
-        } else if(paths[numPaths - 1][0] != hashedNBPath) {
-            paths.push([hashedNBPath, t, t])
-        } else {
-            paths[numPaths - 1][2] = t;
+        if (value['nb_id']) {
+            Notebook.metadata.janus.nb_id = value['nb_id'];
         }
     }
 
@@ -154,67 +328,57 @@ define([
         var notebookUrl =  Jupyter.notebook.notebook_path;
         var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
 
-        var paths = Jupyter.notebook.metadata.janus.filepaths
-        var numPaths = paths.length
-        var foundLast = false;
-
         // don't proceed if no record of
-        if (numPaths == 0) {
+        var janusMeta = Jupyter.notebook.metadata.janus;
+        if (! janusMeta.nb_id && janusMeta.filepaths.length == 0) {
             return
         }
 
-        // get time of last significant change to the notebook, checking from
-        // oldest to newest
-        var t = null;
-        for (var i = 0; i < numPaths; i++) {
-
-            // prepare GET request
-            var settings = {
-                type : 'GET',
-                data: {
-                    q: 'config',
-                    path: paths[i][0],
-                    start: paths[i][1],
-                    end: paths[i][2]
-                },
-            };
-
-            utils.promising_ajax(url, settings).then(function(value, i, t){
-                var d = JSON.parse(value)
-                var numConfigs = d['nb_configs'].length
-                if (numConfigs > 0) {
-                    t = d['nb_configs'][numConfigs - 1][0]
-
-                    // get time difference
-                    var t_now = Date.now();
-                    var t_diff = ( t_now - t ) / 1000;
-                    var date_string = "";
-
-                    // get a human readible version of the time
-                    if ( t_diff < 3600 ) {
-                        num_min = parseInt( t_diff / 60 );
-                        date_string = num_min.toString() + " min ago";
-                    } else if ( t_diff < 86400 ) {
-                        num_hours = parseInt( t_diff / 3600 );
-                        if (num_hours == 1){
-                            date_string = "1 hour ago";
-                        } else {
-                            date_string = num_hours.toString() + " hours ago";
-                        }
+        // get time of last significant change to the notebook, across all
+        // the paths the notebook has been saved under
+        var settings = {
+            type : 'GET',
+            data: JanusUtils.historyQuery(Jupyter.notebook, {
+                q: 'config_page',
+                limit: 1
+            }),
+        };
+
+        utils.promising_ajax(url, settings).then(function(value){
+            var d = JSON.parse(value)
+            var numConfigs = d['nb_configs'].length
+            if (numConfigs > 0) {
+                var t = d['nb_configs'][numConfigs - 1][0]
+
+                // get time difference
+                var t_now = Date.now();
+                var t_diff = ( t_now - t ) / 1000;
+                var date_string = "";
+
+                // get a human readible version of the time
+                if ( t_diff < 3600 ) {
+                    num_min = parseInt( t_diff / 60 );
+                    date_string = num_min.toString() + " min ago";
+                } else if ( t_diff < 86400 ) {
+                    num_hours = parseInt( t_diff / 3600 );
+                    if (num_hours == 1){
+                        date_string = "1 hour ago";
                     } else {
-                        num_days = parseInt( t_diff / 86400 );
-                        if (num_days == 1) {
-                            date_string = "1 day ago";
-                        } else {
-                            date_string = num_days.toString() + " days ago";
-                        }
+                        date_string = num_hours.toString() + " hours ago";
+                    }
+                } else {
+                    num_days = parseInt( t_diff / 86400 );
+                    if (num_days == 1) {
+                        date_string = "1 day ago";
+                    } else {
+                        date_string = num_days.toString() + " days ago";
                     }
-
-                    // update the label
-                    historyLabel.html("Last edit " + date_string)
                 }
-            })
-        }
+
+                // update the label
+                historyLabel.html("Last edit " + date_string)
+            }
+        })
     }
 
 
@@ -270,7 +434,16 @@ define([
 
         trackAction(Notebook, Date.now(), 'notebook-opened', 0, [0]);
         window.onbeforeunload = function(event) {
-            trackAction(Notebook, Date.now(), 'notebook-closed', 0, [0]);
+            if (Notebook.metadata.janus.track_history) {
+                var actions = takePendingActions();
+                actions.push({
+                    time: Date.now(),
+                    name: 'notebook-closed',
+                    index: 0,
+                    indices: [0]
+                });
+                sendActionsOnUnload(Notebook, actions);
+            }
         }
     }
 
@@ -19,6 +19,13 @@ define([
     JanusUtils
 ){
 
+    // number of notebook configurations to get from the server at a time
+    var CONFIG_PAGE_SIZE = 200;
+
+    // how many configurations either side of the slider to prefetch cell
+    // versions for, so nearby versions show without waiting for the server
+    var PREFETCH_WINDOW = 5;
+
     // TODO some cell versions may be saving before cell is fully executed
     // TODO break hidCells into smaller functions that are easier to maintain
 
@@ -35,55 +42,110 @@ define([
         this.notebook = nb;
         this.cells = [];
 
+        // cell versions we have fetched with version_id as keys, limited to
+        // the configurations near the slider
+        this.versionCache = {};
+
+        // slider position being shown, and the oldest configuration loaded
+        this.shownVersion = null;
+        this.firstLoaded = 0;
+
         // get notebook history and starting showing it
         this.getDataForModal()
     }
 
 
     HistoryModal.prototype.getDataForModal = function() {
-        /* get data about previous notebook cell orders
-           then render the modal using that data */
+        /* get data about the newest notebook cell orders, render the modal
+           using that data, then get older cell orders in the background */
 
         var that = this;
         this.nb_configs = [];
 
+        // show the modal window once we have the newest configurations
+        this.getConfigPage(null).then( function(d) {
+            that.nb_configs = new Array(d['total']);
+            that.firstLoaded = d['total'];
+            that.addConfigPage(d);
+            that.renderModal();
+            that.getOlderConfigs(d['before']);
+        });
+    }
+
+
+    HistoryModal.prototype.getConfigPage = function(before) {
+        /* return promise of a page of notebook cell orders, newest first
+
+        Args:
+            before: cursor returned with the previous page, or null for the
+                newest page
+        */
+
         // preapre url for GET request
         var baseUrl = Jupyter.notebook.base_url;
         var notebookUrl =  Jupyter.notebook.notebook_path;
         var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
-        var paths = Jupyter.notebook.metadata.janus.filepaths;
-
-        // format request for each previous notebook name
-        for ( var i = 0; i < paths.length; i++ ) {
-
-            // prepare POST settings
-            var settings = {
-                type : 'GET',
-                data: {
-                    q: 'config',
-                    path: paths[i][0],
-                    start: paths[i][1],
-                    end: paths[i][2]
-                },
-            };
-
-            // show the modal window only after we have all our data ready
-            if (i == paths.length - 1) {
-                utils.promising_ajax(url, settings).then( function(value, i) {
-                    var d = JSON.parse(value)
-                    that.nb_configs = that.nb_configs.concat(d['nb_configs']);
-                    that.renderModal();
-                });
-            } else {
-                utils.promising_ajax(url, settings).then(function(value, i){
-                    var d = JSON.parse(value)
-                    that.nb_configs = that.nb_configs.concat(d['nb_configs']);
-                });
-            }
+
+        // request configurations under every previous notebook name at once
+        var data = JanusUtils.historyQuery(Jupyter.notebook, {
+            q: 'config_page',
+            limit: CONFIG_PAGE_SIZE
+        });
+        if (before) {
+            data['before'] = JSON.stringify(before);
+        }
+        var settings = {
+            type : 'GET',
+            data: data
+        };
+
+        return utils.promising_ajax(url, settings).then( function(value) {
+            return JSON.parse(value)
+        });
+    }
+
+
+    HistoryModal.prototype.addConfigPage = function(d) {
+        /* put a page of configurations in its place in our list, which is
+           filled from the newest configuration back
+
+        Args:
+            d: page of configurations returned by the server
+        */
+
+        var page = d['nb_configs'];
+        this.firstLoaded = Math.max(this.firstLoaded - page.length, 0);
+        for (var i = 0; i < page.length; i++) {
+            this.nb_configs[this.firstLoaded + i] = page[i];
+        }
+
+        // the slider may be on a configuration that was still loading
+        if (this.shownVersion != null) {
+            this.updateUIText(this.shownVersion);
         }
     }
 
 
+    HistoryModal.prototype.getOlderConfigs = function(before) {
+        /* get older pages of configurations one after another
+
+        Args:
+            before: cursor of the next page to get, or null if there are no
+                older configurations
+        */
+
+        var that = this;
+        if (! before) {
+            return
+        }
+
+        this.getConfigPage(before).then( function(d) {
+            that.addConfigPage(d);
+            that.getOlderConfigs(d['before']);
+        });
+    }
+
+
     HistoryModal.prototype.renderModal = function() {
         /* show the modal, assuming we already have the nb history data */
 
@@ -155,10 +217,149 @@ define([
         */
 
         // update UI text, then update the cells
+        var that = this;
         this.updateUIText(version_num);
+        this.shownVersion = version_num;
 
-        var version_ids = this.nb_configs[version_num][3];
-        this.getCellVersionData(version_ids, version_num);
+        this.getSnapshot(version_num).then( function(version_ids) {
+
+            // unless the slider has moved on while we waited
+            if (that.shownVersion != version_num) {
+                return
+            }
+            that.updateUIText(version_num);
+            that.getCellVersionData(version_ids, version_num);
+            that.prefetchVersions(version_num);
+        });
+    }
+
+
+    HistoryModal.prototype.getSnapshot = function(version_num) {
+        /* return promise of the cell versions of a notebook configuration,
+           getting the whole notebook as it was then from the server in one
+           request unless we have its configuration and versions already
+
+        Args:
+            version_num: version of the notebook to show (int)
+        */
+
+        var that = this;
+        var config = this.nb_configs[version_num];
+        if (config) {
+            var cached = config[3].every( function(id) {
+                return id in that.versionCache;
+            });
+            if (cached) {
+                return Promise.resolve(config[3]);
+            }
+        }
+
+        // preapre url for GET request
+        var baseUrl = Jupyter.notebook.base_url;
+        var notebookUrl =  Jupyter.notebook.notebook_path;
+        var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
+
+        var settings = {
+            type : 'GET',
+            data: JanusUtils.historyQuery(Jupyter.notebook, {
+                q: 'snapshot',
+                index: version_num
+            })
+        };
+
+        return utils.promising_ajax(url, settings).then( function(value) {
+            var nb = JSON.parse(value);
+            var janus = nb.metadata.janus;
+
+            // keep the configuration if its page has not loaded yet
+            if (! that.nb_configs[version_num]) {
+                that.nb_configs[version_num] = [janus.time, janus.nb_name,
+                                        janus.cell_order, janus.version_order];
+            }
+            for (var i = 0; i < nb.cells.length; i++) {
+                that.versionCache[nb.cells[i].metadata.janus.version_id] = nb.cells[i];
+            }
+            return janus.version_order;
+        });
+    }
+
+
+    HistoryModal.prototype.getVersions = function(version_ids) {
+        /* return promise of a dict of cell versions with version_id as keys,
+           getting the ones we have not cached from the server
+
+        Args:
+            version_ids: cells versions we want to get data for
+        */
+
+        var that = this;
+        var cells = {};
+        var missing = [];
+        for (var i = 0; i < version_ids.length; i++) {
+            var cached = this.versionCache[version_ids[i]];
+            if (cached) {
+                cells[version_ids[i]] = cached;
+            } else {
+                missing.push(version_ids[i]);
+            }
+        }
+
+        if (missing.length == 0) {
+            return Promise.resolve(cells);
+        }
+
+        // preapre url for GET request
+        var baseUrl = Jupyter.notebook.base_url;
+        var notebookUrl =  Jupyter.notebook.notebook_path;
+        var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
+
+        //  GET settings, asking for data for each cell version
+        var settings = {
+            type : 'GET',
+            data: JanusUtils.historyQuery(Jupyter.notebook, {
+                q: 'versions',
+                version_ids: JSON.stringify(missing)
+            }),
+        };
+
+        return utils.promising_ajax(url, settings).then( function(value) {
+            var fetched = JSON.parse(value)['cells'];
+            for (var id in fetched) {
+                that.versionCache[id] = fetched[id];
+                cells[id] = fetched[id];
+            }
+            return cells;
+        });
+    }
+
+
+    HistoryModal.prototype.prefetchVersions = function(version_num) {
+        /* get cell versions of configurations near the slider, and forget the
+           ones far away from it
+
+        Args:
+            version_num: version of the notebook being shown (int)
+        */
+
+        var first = Math.max(version_num - PREFETCH_WINDOW, 0);
+        var last = Math.min(version_num + PREFETCH_WINDOW, this.nb_configs.length - 1);
+        var nearby = {};
+        for (var i = first; i <= last; i++) {
+            if (this.nb_configs[i]) {
+                var version_ids = this.nb_configs[i][3];
+                for (var j = 0; j < version_ids.length; j++) {
+                    nearby[version_ids[j]] = true;
+                }
+            }
+        }
+
+        for (var id in this.versionCache) {
+            if (! nearby[id]) {
+                delete this.versionCache[id];
+            }
+        }
+
+        this.getVersions(Object.keys(nearby));
     }
 
 
@@ -170,11 +371,20 @@ define([
         */
 
         // get the time since the edit being shown
+        var rev_string = ( version_num + 1 ).toString() + " of " + this.nb_configs.length.toString();
+        var date_string = "";
+
+        // older configurations may still be loading
+        if (! this.nb_configs[version_num]) {
+            date_string = "loading...";
+            $('#rev_num').html(rev_string);
+            $('#rev_time').html(date_string);
+            return
+        }
+
         var t = parseInt( this.nb_configs[version_num][0] );
         var t_now = Date.now();
         var t_diff = ( t_now - t ) / 1000;
-        var rev_string = ( version_num + 1 ).toString() + " of " + this.nb_configs.length.toString();
-        var date_string = "";
 
         // get a human readible version of the time
         if ( t_diff < 3600 ) {
@@ -216,27 +426,8 @@ define([
         var scrollY = $('.modal').scrollTop()
         var firstNew = null;
 
-        // preapre url for GET request
-        var baseUrl = Jupyter.notebook.base_url;
-        var notebookUrl =  Jupyter.notebook.notebook_path;
-        var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
-        var paths = Jupyter.notebook.metadata.janus.filepaths;
-
-        //  GET settings, asking for data for each cell version
-        var settings = {
-            type : 'GET',
-            data: {
-                q: 'versions',
-                version_ids: version_ids
-            },
-        };
-
         // add cell versions to the history modal once we have data
-        utils.promising_ajax(url, settings).then( function(value) {
-
-            version_ids = eval(version_ids);
-            var get_data = JSON.parse(value);
-            var cells = get_data['cells'];
+        this.getVersions(version_ids).then( function(cells) {
 
             // prepare list of previous cells for comparison
             var newCells = []
@@ -252,7 +443,7 @@ define([
             for (var i = 0; i < version_ids.length; i++) {
 
                 // check if this is a new cell from the immediately previous version
-                if (version_num > 0) {
+                if (version_num > 0 && Jupyter.historyViewer.nb_configs[version_num - 1]) {
                     var lastIndex = Jupyter.historyViewer.nb_configs[version_num - 1][3].indexOf(version_ids[i])
                     var newVersion = (lastIndex == -1)
                 }
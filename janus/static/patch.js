@@ -661,6 +661,7 @@ define([
 
         var defaultNBMeta = {
             'track_history': true,
+            'nb_id': null,
             'filepaths': [],
             // 'unexecutedCells': []
         }
@@ -34,6 +34,32 @@ define([
     }
 
 
+    function hashCellContent(cellJSON) {
+        /* return a fingerprint of the cell content the server diffs on
+
+        Args:
+            cellJSON: JSON of cell to fingerprint
+        */
+
+        var content = [cellJSON.cell_type, cellJSON.source];
+        if (cellJSON.cell_type == 'code') {
+            content.push(cellJSON.outputs);
+        }
+        var str = JSON.stringify(content);
+
+        // combine two 32 bit string hashes (FNV-1a and djb2) for fewer collisions
+        var h1 = 0x811c9dc5;
+        var h2 = 5381;
+        for (var i = 0; i < str.length; i++) {
+            var code = str.charCodeAt(i);
+            h1 = Math.imul(h1 ^ code, 0x01000193);
+            h2 = (Math.imul(h2, 33) + code) | 0;
+        }
+
+        return (h1 >>> 0).toString(16) + (h2 >>> 0).toString(16);
+    }
+
+
     function removeMarkerType(markerClass, element) {
         /* remove all markers of a particular type for a certain cell
 
@@ -273,6 +299,26 @@ define([
     }
 
 
+    // HISTORY QUERIES
+    function historyQuery(nb, data) {
+        /* add what identifies the notebook to the data of a history query,
+           its stable id, or the paths it was saved under before it had one
+
+        Args:
+            nb: the notebook
+            data: data of the GET request
+        */
+
+        var janusMeta = nb.metadata.janus;
+        if (janusMeta.nb_id) {
+            data.nb_id = janusMeta.nb_id;
+        } else {
+            data.paths = JSON.stringify(janusMeta.filepaths);
+        }
+        return data;
+    }
+
+
     // LOG ACTIONS
     function logJanusAction(nb, t, name, selID, selIDs) {
         /* Send information about action to server to process and save
@@ -315,6 +361,7 @@ define([
 
     return {
         getTimeAndSelection: getTimeAndSelection,
+        hashCellContent: hashCellContent,
         removeMarkerType: removeMarkerType,
         addMarkerToElement: addMarkerToElement,
         getMarkerContainer: getMarkerContainer,
@@ -322,7 +369,8 @@ define([
         showMinimap: showMinimap,
         hideMinimap: hideMinimap,
         moveMinimap: moveMinimap,
-        logJanusAction: logJanusAction
+        logJanusAction: logJanusAction,
+        historyQuery: historyQuery
     }
 
 
@@ -112,13 +112,6 @@ define([
         // update cell metadata
         cell.metadata.janus.current_version = v;
 
-        // update cell input and output to version
-        cell.set_text(versions[v]['content']['source']);
-        cell.output_area.clear_output()
-        for (var i = 0; i < versions[v]['content']['outputs'].length; i++){
-            cell.output_area.append_output(versions[v]['content']['outputs'][i]);
-        }
-
         // highlight marker for selected version
         for (var i = 0; i < markers.length; i++){
             if (i == v) {
@@ -127,6 +120,50 @@ define([
                 markers[i].classList.remove('selected-version')
             }
         }
+
+        // update cell input and output to version, once we have its content
+        loadVersionContent(versions[v]).then(function(content) {
+            if (cell.metadata.janus.current_version != v) {
+                return
+            }
+            cell.set_text(content['source']);
+            cell.output_area.clear_output()
+            for (var i = 0; i < content['outputs'].length; i++){
+                cell.output_area.append_output(content['outputs'][i]);
+            }
+        });
+    }
+
+
+    function loadVersionContent(version) {
+        /* Return promise of a version's content, fetching it from the database
+        if we have only loaded its summary
+
+        Args:
+            version: version of the cell to get the content of
+        */
+
+        if (version.content) {
+            return Promise.resolve(version.content)
+        }
+
+        var baseUrl = Jupyter.notebook.base_url;
+        var notebookUrl =  Jupyter.notebook.notebook_path;
+        var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
+
+        var settings = {
+            type : 'GET',
+            data: JanusUtils.historyQuery(Jupyter.notebook, {
+                q: 'versions',
+                version_ids: JSON.stringify([version.version_id])
+            }),
+        };
+
+        return utils.promising_ajax(url, settings).then( function(value) {
+            var d = JSON.parse(value)
+            version.content = d['cells'][version.version_id]
+            return version.content
+        });
     }
 
 
@@ -236,43 +273,40 @@ define([
             cell: cell to get history of versions for
         */
 
+        getVersionSummaries([cell]).then( function(summaries) {
+            renderVersions(cell, summaries[cell.metadata.janus.id] || [])
+        });
+    }
+
+
+    function getVersionSummaries(cells) {
+        /* Return promise of summaries of every version of these cells, with
+        cell ids as keys. Summaries do not include version content, which is
+        loaded when a version is shown
+
+        Args:
+            cells: cells to get summaries of versions for
+        */
+
         var baseUrl = Jupyter.notebook.base_url;
         var notebookUrl =  Jupyter.notebook.notebook_path;
         var url = utils.url_path_join(baseUrl, 'api/janus', notebookUrl);
 
-        var paths = Jupyter.notebook.metadata.janus.filepaths;
-        var cell_id = cell.metadata.janus.id
-        var cellVersions = []
-
-        for (var i = 0; i < paths.length; i++) {
-
-            // prepare POST settings
-            var settings = {
-                type : 'GET',
-                data: {
-                    q: 'cell_history',
-                    cell_id: cell_id,
-                    path: paths[i][0],
-                    start: paths[i][1],
-                    end: paths[i][2]
-                },
-            };
-
-            // combine results of all queries together before rendering markers
-            if(i == paths.length - 1) {
-                utils.promising_ajax(url, settings).then( function(value, i) {
-                    d = JSON.parse(value)
-                    cellVersions = cellVersions.concat(d['versions']);
-                    renderVersions(cell, cellVersions)
-                });
-            }
-            else{
-                utils.promising_ajax(url, settings).then( function(value, i) {
-                    d = JSON.parse(value)
-                    cellVersions = cellVersions.concat(d['versions']);
-                });
-            }
-        }
+        var cell_ids = cells.map( function(c) {return c.metadata.janus.id;} );
+
+        // get versions of all cells saved under every notebook name at once
+        var settings = {
+            type : 'GET',
+            data: JanusUtils.historyQuery(Jupyter.notebook, {
+                q: 'version_summary',
+                cell_ids: JSON.stringify(cell_ids)
+            }),
+        };
+
+        return utils.promising_ajax(url, settings).then( function(value) {
+            var d = JSON.parse(value)
+            return d['summaries']
+        });
     }
 
 
@@ -285,6 +319,23 @@ define([
             cellVersions: list of all cell versions retrieved from database
         */
 
+        // the server tells us which versions were in the last saved notebook,
+        // but the cell may have been edited since, so load their content and
+        // compare it with the cell before choosing the current version
+        var unloaded = cellVersions.filter( function(v) {return v.is_current && ! v.content;} );
+        if (unloaded.length > 0) {
+            var compare = function() {
+                for (var i = 0; i < unloaded.length; i++) {
+                    if (! unloaded[i].content) {
+                        unloaded[i].is_current = false;
+                    }
+                }
+                renderVersions(cell, cellVersions);
+            }
+            Promise.all(unloaded.map(loadVersionContent)).then(compare, compare);
+            return
+        }
+
         if (cellVersions.length > 0) {
 
             var inputArea = cell.element.find('div.input_area')[0];
@@ -395,6 +446,11 @@ define([
             version: version of cell to check
         */
 
+        // summaries tell us without loading the version's content
+        if (! version['content']) {
+            return version['has_content']
+        }
+
         if (version['content']['source'] == "" && version['content']['outputs'].length == 0) {
             return false
         } else {
@@ -411,6 +467,12 @@ define([
             cell: cell to compare to
         */
 
+        // versions we have not loaded cannot be compared, renderVersions
+        // loads any that could match
+        if (! ver.content) {
+            return false;
+        }
+
         // do sources not match
         if (ver.content.source != cell.get_text()) {
             return false;
@@ -460,14 +522,29 @@ define([
         /* create all markers based on metadata when notebook is opened */
 
         var cells = Jupyter.notebook.get_cells();
+        var versionCells = []
         for (var i = 0; i < cells.length; i++) {
             var cell = cells[i];
             if (cell instanceof CodeCell) {
-                var markerContainer = JanusUtils.getMarkerContainer(cell)
-                renderMarkers(cell);
+                if (cell.metadata.janus.show_versions) {
+                    renderSummaryMarker(cell);
+                    versionCells.push(cell);
+                } else {
+                    cell.metadata.janus.versions = [];
+                }
                 updateMarkerVisibility(cell);
             }
         }
+
+        // get versions of every cell in one request rather than one per cell
+        if (versionCells.length > 0) {
+            getVersionSummaries(versionCells).then( function(summaries) {
+                for (var i = 0; i < versionCells.length; i++) {
+                    var cell_id = versionCells[i].metadata.janus.id
+                    renderVersions(versionCells[i], summaries[cell_id] || [])
+                }
+            });
+        }
     }
 
 
@@ -568,34 +645,39 @@ define([
         var version_id = cur_version.version_id
         var new_name = element.innerHTML
 
-        // set the name in the cell's metadata
-        cur_version.name = new_name;
-
-        // determine if newly named version is already in our named version list
-        var namedVersionsIds = named_versions.map(function(a) { return a.version_id; });
-        var named_index = namedVersionsIds.indexOf(version_id)
-
-        // if the version now has no name, remove from our list
-        if(new_name == ""){
-            element.classList.remove('named-version')
-            element.classList.add('unnamed-version')
-            if (named_index > -1) {
-                named_versions.splice(named_index, 1)
-                renderMarkers(cell);
-                updateMarkerVisibility(cell);
-            }
-        } else {
-            element.classList.add('named-version')
-            element.classList.remove('unnamed-version')
-            if (named_index == -1) {
-                named_versions.push(cur_version)
-                named_versions[named_versions.length - 1].name = new_name
-                renderMarkers(cell);
-                updateMarkerVisibility(cell);
+        // named versions are kept in the notebook, so keep their content too,
+        // waiting for it to load rather than taking the cell's
+        loadVersionContent(cur_version).then( function() {
+
+            // set the name in the cell's metadata
+            cur_version.name = new_name;
+
+            // determine if newly named version is already in our named version list
+            var namedVersionsIds = named_versions.map(function(a) { return a.version_id; });
+            var named_index = namedVersionsIds.indexOf(version_id)
+
+            // if the version now has no name, remove from our list
+            if(new_name == ""){
+                element.classList.remove('named-version')
+                element.classList.add('unnamed-version')
+                if (named_index > -1) {
+                    named_versions.splice(named_index, 1)
+                    renderMarkers(cell);
+                    updateMarkerVisibility(cell);
+                }
             } else {
-                named_versions[named_index].name = new_name
+                element.classList.add('named-version')
+                element.classList.remove('unnamed-version')
+                if (named_index == -1) {
+                    named_versions.push(cur_version)
+                    named_versions[named_versions.length - 1].name = new_name
+                    renderMarkers(cell);
+                    updateMarkerVisibility(cell);
+                } else {
+                    named_versions[named_index].name = new_name
+                }
             }
-        }
+        });
     }
 
 
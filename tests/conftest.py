@@ -0,0 +1,122 @@
+"""
+Fixtures shared by the Janus tests
+"""
+
+import pickle
+import sqlite3
+
+import pytest
+
+from janus.janus_sqlite import DbManager
+
+
+def code_cell(cell_id, source, outputs = None):
+    """
+    Return JSON representation of a code cell, as the client sends it
+
+    cell_id: (str) unique cell identifier
+    source: (str) source of the cell
+    outputs: (list) outputs of the cell
+    """
+
+    return {
+        'cell_type': 'code',
+        'execution_count': 1,
+        'source': source,
+        'outputs': outputs or [],
+        'metadata': {'janus': {'id': cell_id, 'versions': [],
+                                'named_versions': []}}
+    }
+
+
+def stream_output(text):
+    """
+    Return a stream output printing some text
+
+    text: (str) text printed
+    """
+
+    return {'output_type': 'stream', 'name': 'stdout', 'text': text}
+
+
+def action(t, cells, name = 'run-cell'):
+    """
+    Return data about an action with the full notebook, as the client posts it
+
+    t: (int) time of the action
+    cells: (list) cells of the notebook after the action
+    name: (str) name of the action
+    """
+
+    return {'time': t, 'name': name, 'index': 0, 'indices': [0],
+            'model': {'cells': cells}}
+
+
+def create_baseline_db(db_path, notebooks):
+    """
+    Create a database the way the first release of Janus wrote it: no schema
+    version, cell outputs pickled inline and configurations stored as python
+    lists. Return list of the cell versions recorded, as the baseline stored
+    them
+
+    db_path: (str) path to the new database
+    notebooks: (dict) list of (time, list of cells) configurations with
+        nb_name as keys
+    """
+
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE actions (time integer, nb_name text, name text,
+        selected_cell integer, selected_cells text)''')
+    c.execute('''CREATE TABLE cells (time integer, cell_id text, version_id text,
+        cell_data text)''')
+    c.execute('''CREATE TABLE nb_configs (time integer, nb_name text,
+        cell_order text, version_order text)''')
+    c.execute('''CREATE TABLE janus_log (time integer, nb_name text, name text,
+        id text, ids text)''')
+    c.execute('''CREATE TABLE comments (time integer, comment text, nb_name text)''')
+    c.execute('''CREATE TABLE cleaned_cells (time integer, cell_id text,
+        version_id text, cell_data text, meta_data text, line_count integer,
+        function_count integer, cell_count integer, lines_of_code integer,
+        words_of_markdown integer, output_count integer, types text)''')
+
+    versions = []
+    for nb_name, configs in notebooks.items():
+        for t, cells in configs:
+            cell_order = []
+            version_order = []
+            for cell in cells:
+                cell_id = cell['metadata']['janus']['id']
+                version_id = '%s-%d' % (cell_id, t)
+                c.execute('INSERT INTO cells VALUES (?,?,?,?)',
+                            (t, cell_id, version_id, pickle.dumps(cell)))
+                versions.append((version_id, cell))
+                cell_order.append(cell_id)
+                version_order.append(version_id)
+            c.execute('INSERT INTO nb_configs VALUES (?,?,?,?)',
+                        (t, nb_name, str(cell_order), str(version_order)))
+            c.execute('INSERT INTO actions VALUES (?,?,?,?,?)',
+                        (str(t), nb_name, 'run-cell', '0', '[0]'))
+    conn.commit()
+    conn.close()
+    return versions
+
+
+@pytest.fixture
+def open_db(tmp_path):
+    """
+    Return function opening a DbManager on a database in a temporary
+    directory, closing every manager it opened when the test ends
+    """
+
+    managers = []
+
+    def open_db(name = 'nb_history.db', **settings):
+        settings.setdefault('commit_delay', 0.05)
+        db = DbManager(str(tmp_path / name), **settings)
+        managers.append(db)
+        return db
+
+    yield open_db
+    for db in managers:
+        db.close()
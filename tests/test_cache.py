@@ -0,0 +1,58 @@
+"""
+Keeping recently read cell versions decoded in a bounded cache
+"""
+
+import json
+
+from janus.janus_cache import VersionCache
+
+from conftest import code_cell, action
+
+
+def version(source):
+    return {'cell_type': 'code', 'source': source}
+
+
+def test_least_recently_used_versions_are_evicted():
+    size = len(json.dumps(version('x = 0')))
+    cache = VersionCache(max_bytes=size * 3)
+    for i in range(3):
+        cache.put('v%d' % i, version('x = %d' % i))
+
+    # reading a version keeps it, so the next oldest goes instead
+    assert cache.get('v0') == version('x = 0')
+    cache.put('v3', version('x = 3'))
+    assert cache.get('v1') is None
+    assert [cache.get('v%d' % i) is not None for i in (0, 2, 3)] == [True] * 3
+    assert cache.stats() == {'versions': 3, 'bytes': size * 3,
+                                'max_bytes': size * 3, 'hits': 4, 'misses': 1}
+
+    # versions larger than the whole cache are never kept
+    cache.put('big', version('x' * size * 3))
+    assert cache.get('big') is None
+    assert cache.stats()['versions'] == 3
+
+    cache.clear()
+    assert cache.get('v0') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_versions_are_read_from_the_cache(open_db):
+    db = open_db()
+    db.record_action(action(1000, [code_cell('c1', 'x = 1'), code_cell('c2', 'y = 2')]),
+                        'aaaa1111')
+    db.flush()
+    version_ids = [r[0] for r in db.execute_search('SELECT version_id FROM cells')]
+
+    first = db.get_versions(version_ids)
+    assert db.version_cache.stats()['versions'] == 2
+    hits = db.version_cache.stats()['hits']
+    assert db.get_versions(version_ids) == first
+    assert db.version_cache.stats()['hits'] == hits + 2
+
+    # a cache of no bytes keeps nothing
+    uncached = open_db('uncached.db', version_cache_bytes=0)
+    uncached.record_action(action(1000, [code_cell('c1', 'x = 1')]), 'aaaa1111')
+    uncached.flush()
+    uncached.get_versions(version_ids[:1])
+    assert uncached.version_cache.stats()['versions'] == 0
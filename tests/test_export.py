@@ -0,0 +1,67 @@
+"""
+Exporting cleaned cell versions for analysis
+"""
+
+import time
+
+import janus.janus_sqlite
+from janus.janus_export import ExportJob
+
+from conftest import code_cell, stream_output, action
+
+
+def record_cells(db, t, count):
+    cells = [code_cell('c%d' % i, 'x = %d\ny = x' % (t + i), [stream_output(str(i))])
+                for i in range(count)]
+    db.record_action(action(t, cells), 'aaaa1111')
+
+
+def test_exports_only_copy_new_versions(open_db, monkeypatch):
+    monkeypatch.setattr(janus.janus_sqlite, 'EXPORT_CHUNK_SIZE', 2)
+    db = open_db()
+    record_cells(db, 1000, 5)
+    db.export_data_and_clean('aaaa1111')
+    rows = db.execute_search('''SELECT version_id, line_count, output_count
+        FROM cleaned_cells ORDER BY rowid''')
+    versions = db.execute_search('SELECT version_id FROM cells ORDER BY rowid')
+    assert [r[0] for r in rows] == [v[0] for v in versions]
+    assert all(r[1:] == (2, 1) for r in rows)
+
+    # a second export picks up where the first stopped
+    record_cells(db, 2000, 3)
+    db.export_data_and_clean('aaaa1111')
+    assert db.execute_search('SELECT COUNT(*) FROM cleaned_cells')[0][0] == 8
+    assert db.execute_search('''SELECT COUNT(DISTINCT version_id)
+        FROM cleaned_cells''')[0][0] == 8
+
+    # and dropping the table exports every version again
+    db.export_data_and_clean('aaaa1111', drop_all=True)
+    assert db.execute_search('SELECT COUNT(*) FROM cleaned_cells')[0][0] == 8
+
+
+def test_export_jobs_report_progress(open_db):
+    db = open_db()
+    record_cells(db, 1000, 3)
+    job = db.start_export('aaaa1111')
+    assert db.start_export('aaaa1111') is job or not job.is_running()
+    deadline = time.time() + 60
+    while job.is_running() and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert db.get_export_job(job.id) is job
+    progress = job.to_dict()
+    assert progress['status'] == 'done'
+    assert progress['error'] is None
+    assert progress['rows_done'] == progress['rows_total'] == 3
+    assert db.get_export_job('unknown') is None
+
+
+def test_cancelled_export_jobs_stop_between_chunks(open_db):
+    db = open_db()
+    record_cells(db, 1000, 3)
+    job = ExportJob('aaaa1111')
+    job.cancel()
+    db.run_export(job)
+    assert job.to_dict()['status'] == 'cancelled'
+    assert job.rows_done == 0
+    assert db.execute_search('SELECT COUNT(*) FROM cleaned_cells')[0][0] == 0
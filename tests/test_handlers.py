@@ -0,0 +1,83 @@
+"""
+Answering history requests with ETags and cache headers
+"""
+
+import json
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+from notebook.services.contents.filemanager import FileContentsManager
+
+from janus import JanusHandler
+from janus.janus_sqlite import DbManager
+
+from conftest import code_cell, action
+
+
+class HistoryHandler(JanusHandler):
+    """Handler reading history from the database of the test."""
+
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def get_db(self):
+        return self.settings['janus_db']
+
+
+class TestHistoryCaching(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.db = DbManager(self.root_dir + '/nb_history.db', commit_delay=0.05)
+        return web.Application([(r'/api/janus/(.*)', HistoryHandler)],
+                                contents_manager=FileContentsManager(root_dir=self.root_dir),
+                                base_url='/', janus_db=self.db)
+
+    def tearDown(self):
+        super(TestHistoryCaching, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.root_dir)
+
+    def record(self, t, source):
+        self.db.record_action(action(t, [code_cell('c1', source)]), 'aaaa1111')
+
+    def query(self, etag = None, **args):
+        url = '/api/janus/nb.ipynb?path=aaaa1111&start=0&end=10000&'
+        url += '&'.join('%s=%s' % a for a in args.items())
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.fetch(url, headers=headers)
+
+    def test_unchanged_cell_history_is_not_modified(self):
+        self.record(1000, 'x = 1')
+        response = self.query(q='cell_history', cell_id='c1')
+        etag = response.headers['Etag']
+        assert response.code == 200
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+        assert self.query(etag, q='cell_history', cell_id='c1').code == 304
+
+        # queued and committed versions both change the history's ETag
+        self.record(2000, 'x = 2')
+        response = self.query(etag, q='cell_history', cell_id='c1')
+        assert response.code == 200
+        assert len(json.loads(response.body)['versions']) == 2
+        self.db.flush()
+        assert self.query(etag, q='cell_history', cell_id='c1').code == 200
+        assert self.query(response.headers['Etag'], q='cell_history',
+                            cell_id='c1').code == 200
+
+    def test_recorded_versions_are_cached_for_good(self):
+        self.record(1000, 'x = 1')
+        self.db.flush()
+        history = json.loads(self.query(q='cell_history', cell_id='c1').body)
+        version_ids = json.dumps([history['versions'][0]['version_id']])
+        response = self.query(q='versions', version_ids=version_ids)
+        assert response.code == 200
+        assert 'immutable' in response.headers['Cache-Control']
+        assert self.query(response.headers['Etag'], q='versions',
+                            version_ids=version_ids).code == 304
+
+        # versions that are not recorded yet must be asked for again
+        response = self.query(q='versions', version_ids=json.dumps(['unknown']))
+        assert response.headers['Cache-Control'] == 'no-cache'
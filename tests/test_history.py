@@ -0,0 +1,183 @@
+"""
+Recording notebook history and rebuilding it from keyframes and deltas
+"""
+
+from janus.janus_configs import (encode_config, decode_configs,
+    KEYFRAME_INTERVAL)
+from janus.janus_sources import (encode_source_delta, apply_source_delta,
+    SNAPSHOT_INTERVAL)
+
+from conftest import code_cell, stream_output, action
+
+
+def test_source_deltas_round_trip():
+    previous = 'a = 1\nb = 2\nc = 3\n'
+    for source in ['a = 1\nb = 20\nc = 3\n', '', 'b = 2\n', 'a = 1\nb = 2\nc = 3',
+                    'new\n' + previous + 'end']:
+        assert apply_source_delta(previous, encode_source_delta(previous, source)) == source
+
+
+def test_configs_decode_from_keyframes():
+    orders = [['c1'], ['c1', 'c2'], ['c2', 'c1'], ['c2'], [], ['c3', 'c2']]
+    rows = []
+    previous = None
+    for i, cell_order in enumerate(orders):
+        version_order = [c + '-v%d' % i for c in cell_order]
+        encoded = encode_config(previous if i % 3 else None, cell_order, version_order)
+        rows.append((i, 'nb') + encoded)
+        previous = (cell_order, version_order)
+
+    configs = decode_configs(rows)
+    assert [c[2] for c in configs] == orders
+    assert [c[3] for c in configs] == [[c + '-v%d' % i for c in order]
+                                        for i, order in enumerate(orders)]
+
+
+def test_cell_history_rebuilds_sources_from_deltas(open_db):
+    db = open_db()
+    lines = ['line %d\n' % i for i in range(20)]
+    sources = []
+    for i in range(SNAPSHOT_INTERVAL * 2 + 3):
+        lines[i % len(lines)] = 'edit %d\n' % i
+        sources.append(''.join(lines))
+        db.record_action(action(1000 + i, [code_cell('c1', sources[-1])]), 'aaaa1111')
+
+    # both while the versions are queued, and once they are committed
+    queued = db.get_cell_history([['aaaa1111', 0, 10 ** 6]], 'c1')
+    assert [v['content']['source'] for v in queued] == sources
+    db.flush()
+    db.version_cache.clear()
+    committed = db.get_cell_history([['aaaa1111', 0, 10 ** 6]], 'c1')
+    assert [v['content']['source'] for v in committed] == sources
+
+    # most versions are stored as deltas, in chains no longer than the interval
+    deltas = db.execute_search('''SELECT COUNT(*) FROM cells
+        WHERE source_delta IS NOT NULL''')[0][0]
+    assert deltas >= len(sources) // 2
+    depths = [depth for source, depth in db.resolve_sources(
+        db.execute_search('SELECT * FROM cells')).values()]
+    assert max(depths) < SNAPSHOT_INTERVAL
+
+
+def test_configs_rebuild_across_keyframes(open_db):
+    db = open_db()
+    cells = [code_cell('c0', 'x = 0')]
+    cell_orders = []
+    for i in range(1, KEYFRAME_INTERVAL * 2 + 5):
+        if i % 7 == 0:
+            cells = cells[1:]
+        cells = cells + [code_cell('c%d' % i, 'x = %d' % i, [stream_output(str(i))])]
+        db.record_action(action(1000 + i, cells), 'aaaa1111')
+        cell_orders.append([c['metadata']['janus']['id'] for c in cells])
+
+    paths = [['aaaa1111', 0, 10 ** 6]]
+    assert [c[2] for c in db.get_nb_configs(paths)] == cell_orders
+    db.flush()
+    assert [c[2] for c in db.get_nb_configs(paths)] == cell_orders
+    keyframes = db.execute_search('SELECT COUNT(*) FROM nb_configs WHERE keyframe = 1')[0][0]
+    assert keyframes == 3
+
+    # a page of the newest configurations decodes from its nearest keyframe
+    page = db.get_nb_config_page(paths, limit=10)
+    assert [c[2] for c in page['nb_configs']] == cell_orders[-10:]
+    older = db.get_nb_config_page(paths, before=page['before'], limit=10)
+    assert [c[2] for c in older['nb_configs']] == cell_orders[-20:-10]
+    assert page['total'] == len(cell_orders)
+
+    # and a snapshot has the cells the notebook had at the time
+    snapshot = db.get_snapshot(paths, at=1000 + KEYFRAME_INTERVAL + 3)
+    assert ([c['metadata']['janus']['id'] for c in snapshot['cells']]
+            == cell_orders[KEYFRAME_INTERVAL + 2])
+    assert snapshot['cells'][-1]['outputs'] == [stream_output(str(KEYFRAME_INTERVAL + 3))]
+
+
+def test_unchanged_cells_reuse_their_versions(open_db):
+    db = open_db()
+    cells = [code_cell('c1', 'x = 1', [stream_output('at 10:01:02')])]
+    db.record_action(action(1000, cells), 'aaaa1111')
+
+    # outputs that only differ in volatile details are the same version
+    rerun = [code_cell('c1', 'x = 1', [stream_output('at 11:12:13')])]
+    db.record_action(action(2000, rerun), 'aaaa1111')
+    db.flush()
+    assert db.execute_search('SELECT COUNT(*) FROM cells')[0][0] == 1
+    assert db.execute_search('SELECT COUNT(*) FROM nb_configs')[0][0] == 1
+
+
+def test_actions_are_saved_when_the_notebook_must_be_resent(open_db):
+    db = open_db()
+    actions = [{'time': 1000 + i, 'name': 'run-cell', 'index': 0, 'indices': [0]}
+                for i in range(3)]
+    stale = {'delta': {'cell_order': ['c1'], 'cells': {}, 'base': 'unknown'}}
+    assert db.record_action_batch(stale, actions, 'aaaa1111') is None
+
+    # the client resends only the notebook, at the time it sends it
+    state = {'time': 2000, 'model': {'cells': [code_cell('c1', 'x = 1')]}}
+    assert db.record_action_batch(state, [], 'aaaa1111') is not None
+    db.flush()
+    assert db.execute_search('SELECT time FROM actions ORDER BY rowid') == [
+        (1000,), (1001,), (1002,)]
+    assert [c[0] for c in db.get_nb_configs([['aaaa1111', 0, 3000]])] == [2000]
+
+
+def test_snapshots_read_queued_configs_without_committing(open_db):
+    db = open_db(commit_delay=3600)
+    cells = []
+    cell_orders = []
+    for i in range(KEYFRAME_INTERVAL * 2 + 10):
+        cells = cells[-5:] + [code_cell('c%d' % i, 'x = %d' % i)]
+        db.record_action(action(1000 + i, cells), 'aaaa1111')
+        cell_orders.append([c['metadata']['janus']['id'] for c in cells])
+        if i == KEYFRAME_INTERVAL + 10:
+            db.flush()
+
+    # snapshots and pages of queued configurations leave them queued
+    paths = [['aaaa1111', 0, 10 ** 6]]
+    queued = [db.get_snapshot(paths, index=i) for i in (0, KEYFRAME_INTERVAL + 20,
+                                                        KEYFRAME_INTERVAL * 2 + 5)]
+    queued.append(db.get_snapshot(paths, at=1000 + KEYFRAME_INTERVAL + 30))
+    queued.append(db.get_snapshot(paths))
+    page = db.get_nb_config_page(paths, limit=10)
+    assert db.num_queued() > 0
+    assert [c[2] for c in page['nb_configs']] == cell_orders[-10:]
+    assert page['total'] == len(cell_orders)
+
+    # and match what is read once they are committed
+    db.flush()
+    committed = [db.get_snapshot(paths, index=i) for i in (0, KEYFRAME_INTERVAL + 20,
+                                                            KEYFRAME_INTERVAL * 2 + 5)]
+    committed.append(db.get_snapshot(paths, at=1000 + KEYFRAME_INTERVAL + 30))
+    committed.append(db.get_snapshot(paths))
+    assert queued == committed
+    assert ([c['source'] for c in committed[2]['cells']]
+            == ['x = %d' % int(c[1:]) for c in cell_orders[KEYFRAME_INTERVAL * 2 + 5]])
+
+
+def test_keyframes_are_checkpointed_when_recorded(open_db):
+    db = open_db()
+    db.indexer.join()
+    cells = []
+    for i in range(KEYFRAME_INTERVAL + 5):
+        cells = cells[-5:] + [code_cell('c%d' % i, 'x = %d' % i)]
+        db.record_action(action(1000 + i, cells), 'aaaa1111')
+    db.flush()
+    assert db.execute_search('''SELECT config_rowid FROM nb_checkpoints''') == (
+        db.execute_search('SELECT rowid FROM nb_configs WHERE keyframe = 1'))
+
+
+def test_last_versions_are_looked_up_together(open_db):
+    db = open_db(commit_delay=3600)
+    db.record_action(action(1000, [code_cell('c1', 'x = 1'), code_cell('c2', 'y = 1')]),
+                        'aaaa1111')
+    db.flush()
+    db.record_action(action(2000, [code_cell('c1', 'x = 2'), code_cell('c2', 'y = 1')]),
+                        'aaaa1111')
+
+    # the newest version of each cell, committed or queued
+    last = db.get_last_cell_versions(['c1', 'c2', 'c3'])
+    assert sorted(last) == ['c1', 'c2']
+    assert [last[c][0] for c in ('c1', 'c2')] == [2000, 1000]
+    plan = ' '.join(r[3] for r in db.execute_search('''EXPLAIN QUERY PLAN
+        SELECT rowid FROM cells WHERE cell_id = ? ORDER BY time DESC, rowid DESC
+        LIMIT 1''', ('c1',)))
+    assert 'cells_cell_time' in plan
@@ -0,0 +1,92 @@
+"""
+Replaying queued history from the journal after a crash
+"""
+
+import os
+import shutil
+import sqlite3
+
+from janus.janus_journal import Journal, read_journal
+
+from conftest import code_cell, action
+
+
+def copy_database(db, dest_dir):
+    """
+    Copy a database and its journal as a crash would leave them, with
+    whatever is still queued uncommitted. Return path of the copy
+
+    db: (obj) DbManager of the database
+    dest_dir: (obj) directory to copy to
+    """
+
+    os.makedirs(str(dest_dir))
+    with db.lock:
+        for suffix in ('', '-wal', '.ingest'):
+            if os.path.exists(db.db_path + suffix):
+                shutil.copy(db.db_path + suffix, str(dest_dir / ('nb_history.db' + suffix)))
+    return str(dest_dir / 'nb_history.db')
+
+
+def test_queued_history_survives_a_crash(tmp_path, open_db):
+    db = open_db(commit_delay=3600)
+    cells = [code_cell('c1', 'x = 1'), code_cell('c2', 'y = 2')]
+    db.record_action(action(1000, cells, 'notebook-opened'), 'aaaa1111')
+    cells = [code_cell('c1', 'x = 10'), code_cell('c2', 'y = 2')]
+    db.record_action(action(2000, cells), 'aaaa1111')
+    assert db.execute_search('SELECT COUNT(*) FROM actions')[0][0] == 0
+
+    copy_database(db, tmp_path / 'crashed')
+    recovered = open_db('crashed/nb_history.db')
+    assert recovered.execute_search('SELECT COUNT(*) FROM actions')[0][0] == 2
+    assert recovered.execute_search('SELECT COUNT(*) FROM cells')[0][0] == 3
+    configs = recovered.get_nb_configs([['aaaa1111', 0, 3000]])
+    assert len(configs) == 2
+    versions = recovered.get_versions(configs[-1][3])
+    assert sorted(v['source'] for v in versions.values()) == ['x = 10', 'y = 2']
+
+    # and the journal is emptied once its records are committed
+    assert read_journal(recovered.db_path + '.ingest') == ([], 0)
+
+
+def test_records_are_replayed_once(tmp_path, open_db):
+    db_path = str(tmp_path / 'nb_history.db')
+    open_db().close()
+
+    # records up to the last one the database committed are skipped
+    journal = Journal(db_path + '.ingest')
+    for i in range(1, 4):
+        journal.append('action', (str(i), 'aaaa1111', 'run-cell', '0', '[0]'))
+    journal.sync()
+    journal.close()
+    conn = sqlite3.connect(db_path)
+    conn.execute('''INSERT OR REPLACE INTO journal_state VALUES ('applied', 2)''')
+    conn.commit()
+    conn.close()
+
+    db = open_db()
+    assert db.execute_search('SELECT time FROM actions') == [(3,)]
+    db.close()
+    db = open_db()
+    assert db.execute_search('SELECT time FROM actions') == [(3,)]
+
+
+def test_torn_records_are_dropped(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = Journal(path)
+    journal.append('action', ('1', 'aaaa1111', 'run-cell', '0', '[0]'))
+    journal.append('action', ('2', 'aaaa1111', 'run-cell', '0', '[0]'))
+    journal.sync()
+    journal.close()
+
+    # a crash part way through writing a record leaves it cut short
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    entries, valid_bytes = read_journal(path)
+    assert [e[0] for e in entries] == [1]
+
+    journal = Journal(path)
+    assert os.path.getsize(path) == valid_bytes
+    assert journal.append('action', ('3', 'aaaa1111', 'run-cell', '0', '[0]')) == 2
+    journal.close()
+    assert [e[2][0] for e in read_journal(path)[0]] == ['1', '3']
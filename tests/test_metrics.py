@@ -0,0 +1,60 @@
+"""
+Exposing metrics and profiling requests
+"""
+
+import os
+import time
+
+from janus.janus_metrics import Registry, REGISTRY, profile
+
+from conftest import code_cell, action
+
+
+def test_metrics_are_exposed_in_the_text_format():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Things counted')
+    histogram = registry.histogram('test_seconds', 'Time taken')
+    counter.inc(type='config')
+    counter.inc(2, type='config')
+    histogram.observe(0.003, type='versions')
+    histogram.observe(20, type='versions')
+    registry.add_collector(lambda: [('test_depth', 'Queued', [({'queue': 'cell'}, 4)])])
+
+    lines = registry.expose().splitlines()
+    assert 'test_total{type="config"} 3' in lines
+    assert 'test_seconds_bucket{type="versions",le="0.0025"} 0' in lines
+    assert 'test_seconds_bucket{type="versions",le="0.005"} 1' in lines
+    assert 'test_seconds_bucket{type="versions",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{type="versions"} 2' in lines
+    assert '# TYPE test_depth gauge' in lines
+    assert 'test_depth{queue="cell"} 4' in lines
+
+
+def test_open_databases_report_their_queues(open_db):
+    db = open_db(commit_delay=3600)
+    db.record_action(action(1000, [code_cell('c1', 'x = 1')]), 'aaaa1111')
+    name = os.path.basename(db.db_path)
+
+    lines = REGISTRY.expose().splitlines()
+    assert 'janus_queue_depth{db="%s",queue="cell"} 1' % name in lines
+    for queue in ('action', 'nb', 'log', 'comment', 'output', 'search', 'checkpoint'):
+        assert any(l.startswith('janus_queue_depth{db="%s",queue="%s"}' % (name, queue))
+                    for l in lines)
+    assert any(l.startswith('janus_db_bytes{db="%s"}' % name) for l in lines)
+
+    # closed databases are no longer reported
+    db.close()
+    assert 'db="%s"' % name not in REGISTRY.expose()
+
+
+def test_profiles_collect_the_profiled_stacks():
+    with profile(False) as profiler:
+        assert profiler is None
+
+    with profile(True) as profiler:
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            sum(range(1000))
+    stacks = profiler.collapsed()
+    assert len(stacks) > 0
+    assert any('test_profiles_collect_the_profiled_stacks' in s for s in stacks)
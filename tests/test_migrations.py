@@ -0,0 +1,120 @@
+"""
+Upgrading databases written by earlier versions of Janus
+"""
+
+import sqlite3
+
+from janus.janus_migrations import MIGRATIONS, migrate, get_schema_version
+from janus.janus_retention import vacuum_database
+
+from conftest import code_cell, stream_output, create_baseline_db
+
+
+def table_columns(db_path, table):
+    conn = sqlite3.connect(db_path)
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(%s)' % table)]
+    conn.close()
+    return columns
+
+
+def test_baseline_database_is_upgraded(tmp_path, open_db):
+    db_path = str(tmp_path / 'nb_history.db')
+    plot = stream_output('x' * 5000)
+    versions = create_baseline_db(db_path, {
+        'aaaa1111': [
+            (1000, [code_cell('c1', 'x = 1', [plot]), code_cell('c2', 'print(x)')]),
+            (2000, [code_cell('c1', 'x = 2', [plot]), code_cell('c2', 'print(x)')])
+        ],
+        'bbbb2222': [
+            (1500, [code_cell('c3', '# notes')])
+        ]
+    })
+
+    db = open_db()
+    assert get_schema_version(db.conn) == len(MIGRATIONS)
+
+    # configurations decode to the orders the baseline stored
+    configs = db.get_nb_configs([['aaaa1111', 0, 3000]])
+    assert [c[3] for c in configs] == [['c1-1000', 'c2-1000'], ['c1-2000', 'c2-2000']]
+    assert [c[2] for c in configs] == [['c1', 'c2'], ['c1', 'c2']]
+
+    # versions come back with their outputs, which are now stored once
+    cells = db.get_versions([v for v, cell in versions])
+    for version_id, cell in versions:
+        assert cells[version_id]['source'] == cell['source']
+        assert cells[version_id]['outputs'] == cell['outputs']
+    num_outputs = db.execute_search('SELECT COUNT(*) FROM outputs')[0][0]
+    assert num_outputs == 1
+
+    # and every version is fingerprinted, so new runs match old versions
+    missing = db.execute_search('''SELECT COUNT(*) FROM cells
+        WHERE fingerprint IS NULL OR has_content IS NULL''')[0][0]
+    assert missing == 0
+    token = db.record_action({'time': 3000, 'name': 'run-cell', 'index': 0,
+        'indices': [0], 'model': {'cells': [code_cell('c1', 'x = 2', [plot]),
+                                            code_cell('c2', 'print(x)')]}},
+        'aaaa1111')
+    assert token is not None
+    db.flush()
+    assert db.execute_search('SELECT COUNT(*) FROM cells')[0][0] == len(versions)
+
+
+def test_new_and_upgraded_databases_have_the_same_schema(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / 'old.db'), {})
+    open_db('old.db')
+    open_db('new.db')
+
+    for table in ('actions', 'cells', 'nb_configs', 'janus_log', 'comments',
+                    'cleaned_cells', 'outputs'):
+        assert (table_columns(str(tmp_path / 'old.db'), table)
+                == table_columns(str(tmp_path / 'new.db'), table))
+
+
+def test_migrations_can_be_rerun(tmp_path, open_db):
+    db_path = str(tmp_path / 'nb_history.db')
+    create_baseline_db(db_path, {
+        'aaaa1111': [(1000, [code_cell('c1', 'x = 1', [stream_output('1')])])]
+    })
+    open_db().close()
+
+    # a migration interrupted part way through is run again from the start
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+    migrate(conn)
+    assert get_schema_version(conn) == len(MIGRATIONS)
+    assert conn.execute('SELECT COUNT(*) FROM cells').fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM nb_configs').fetchone()[0] == 1
+    conn.close()
+
+    db = open_db()
+    cells = db.get_versions(['c1-1000'])
+    assert cells['c1-1000']['outputs'] == [stream_output('1')]
+
+
+def test_only_new_databases_vacuum_incrementally(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / 'old.db'), {
+        'aaaa1111': [(1000, [code_cell('c1', 'x = 1')])]
+    })
+    old = open_db('old.db')
+    new = open_db('new.db')
+    assert new.execute_search('PRAGMA auto_vacuum') == [(2,)]
+
+    # upgrading does not rewrite the whole file, the vacuum command does
+    assert old.execute_search('PRAGMA auto_vacuum') == [(0,)]
+    old.vacuum()
+    old.close()
+    vacuum_database(str(tmp_path / 'old.db'))
+    assert open_db('old.db').execute_search('PRAGMA auto_vacuum') == [(2,)]
+
+
+def test_versions_from_before_search_are_indexed(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / 'nb_history.db'), {
+        'aaaa1111': [(1000, [code_cell('c1', 'import numpy')]),
+                     (2000, [code_cell('c1', 'import pandas')])]
+    })
+    db = open_db()
+    db.indexer.join()
+    assert [r['version_id'] for r in db.search('pandas')] == ['c1-2000']
+    assert db.execute_search('SELECT indexed_rowid, end_rowid FROM search_state') == [(2, 2)]
+    assert db.execute_search('SELECT name FROM export_state') == [('cleaned_cells',)]
@@ -0,0 +1,82 @@
+"""
+Finding a notebook's history by its stable id across renames and copies
+"""
+
+from janus.janus_sqlite import history_clause
+
+from conftest import code_cell, action, create_baseline_db
+
+
+def record_at(db, nb_id, nb_name, t, source, path_exists = None):
+    """
+    Register a notebook at a path and record an action there, as posting an
+    action does. Return the id the notebook is registered under
+
+    db: (obj) DbManager to record to
+    nb_id: (str) id the client has for the notebook, or None
+    nb_name: (str) hashed path the notebook is saved at
+    t: (int) time of the action
+    source: (str) source of the notebook's only cell
+    path_exists: (function) telling whether a notebook is saved at a path
+    """
+
+    nb_id = db.register_notebook(nb_id, nb_name, t, None, path_exists)
+    db.record_action(action(t, [code_cell('c1', source)]), nb_name)
+    return nb_id
+
+
+def test_renamed_notebook_is_one_lookup(open_db):
+    db = open_db()
+    nb_id = record_at(db, None, 'aaaa1111', 1000, 'x = 1')
+    for i, nb_name in enumerate(['bbbb2222', 'cccc3333', 'dddd4444']):
+        assert record_at(db, nb_id, nb_name, 2000 + i, 'x = %d' % i,
+                            lambda path: False) == nb_id
+    db.flush()
+
+    paths = db.get_notebook_paths(nb_id)
+    assert [p[0] for p in paths] == ['aaaa1111', 'bbbb2222', 'cccc3333', 'dddd4444']
+    clause, params = history_clause(paths)
+    assert clause.count('nb_id = ?') == 1 and 'nb_name' not in clause
+    plan = ' '.join(r[3] for r in db.execute_search(
+        'EXPLAIN QUERY PLAN SELECT COUNT(*) FROM nb_configs WHERE ' + clause, params))
+    assert 'nb_configs_id' in plan
+    assert [c[1] for c in db.get_nb_configs(paths)] == [p[0] for p in paths]
+    assert db.get_snapshot(paths)['cells'][0]['source'] == 'x = 2'
+
+
+def test_copy_still_saved_gets_its_own_id(open_db):
+    db = open_db()
+    nb_id = record_at(db, None, 'aaaa1111', 1000, 'x = 1')
+
+    # the copy carries the original's id, but the original is still saved
+    copy_id = record_at(db, nb_id, 'bbbb2222', 2000, 'x = 2', lambda path: True)
+    assert copy_id != nb_id
+    record_at(db, nb_id, 'aaaa1111', 3000, 'x = 3', lambda path: True)
+    db.flush()
+
+    original = db.get_nb_configs(db.get_notebook_paths(nb_id))
+    assert [c[0] for c in original] == [1000, 3000]
+    copy = db.get_nb_configs(db.get_notebook_paths(copy_id))
+    assert [c[0] for c in copy] == [1000, 2000]
+
+
+def test_path_ranges_are_merged_into_one_id(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / 'nb_history.db'), {
+        'aaaa1111': [(1000, [code_cell('c1', 'x = 1')])],
+        'bbbb2222': [(2000, [code_cell('c1', 'x = 2')])]
+    })
+    db = open_db()
+
+    # the migration tags history with the id of the path it was recorded at
+    assert db.execute_search('SELECT nb_id FROM nb_configs ORDER BY rowid') == [
+        ('aaaa1111',), ('bbbb2222',)]
+
+    # until a client merges the paths it remembers into one notebook
+    nb_id = db.register_notebook(None, 'cccc3333', 3000,
+        [['aaaa1111', 0, 1500], ['bbbb2222', 1500, 3000]])
+    db.record_action(action(3000, [code_cell('c1', 'x = 3')]), 'cccc3333')
+    db.flush()
+    assert [r[0] for r in db.execute_search('SELECT nb_id FROM nb_configs')] == [nb_id] * 3
+    paths = db.get_notebook_paths(nb_id)
+    assert history_clause(paths)[0].count(' OR ') == 0
+    assert [c[0] for c in db.get_nb_configs(paths)] == [1000, 2000, 3000]
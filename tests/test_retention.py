@@ -0,0 +1,117 @@
+"""
+Thinning old history and reporting what thinning would reclaim
+"""
+
+import threading
+
+from janus.janus_retention import RetentionPolicy, current_time, DAY, HOUR
+
+from conftest import code_cell, stream_output, action
+
+
+def record_old_history(db, nb_name, start):
+    """
+    Record a run of edits to a cell, a minute apart
+
+    db: (obj) DbManager to record to
+    nb_name: (str) hashed path to the notebook
+    start: (int) time in the hour of the first edit
+    """
+
+    start = start // HOUR * HOUR
+    for i in range(20):
+        cells = [code_cell('c1', 'x = %d' % i, [stream_output('%d' % i * 100)]),
+                    code_cell('c2', '# notes')]
+        db.record_action(action(start + i * 60 * 1000, cells), nb_name)
+
+
+def test_report_matches_maintenance(open_db):
+    db = open_db()
+    now = current_time()
+    record_old_history(db, 'aaaa1111', now - 100 * DAY)
+    record_old_history(db, 'aaaa1111', now - 10 * DAY)
+    record_old_history(db, 'bbbb2222', now - 200 * DAY)
+    db.flush()
+    policy = RetentionPolicy(keep_all_days=30, hourly_days=180)
+
+    report = db.run_maintenance(policy, True)
+    assert report['dry_run']
+    assert report['nb_configs'] == 38
+    assert report['bytes_reclaimed'] > 0
+
+    # reporting changes nothing
+    assert db.execute_search('SELECT COUNT(*) FROM nb_configs')[0][0] == 60
+    done = db.run_maintenance(policy)
+    for key in ('nb_configs', 'cells', 'outputs', 'nb_checkpoints'):
+        assert report[key] == done[key]
+    assert db.execute_search('SELECT COUNT(*) FROM nb_configs')[0][0] == 22
+
+
+def test_report_does_not_wait_for_writes(open_db):
+    db = open_db()
+    record_old_history(db, 'aaaa1111', current_time() - 100 * DAY)
+    db.flush()
+
+    # a long commit holds the lock while the report is worked out
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with db.lock:
+            locked.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait()
+    try:
+        report = db.retention_report(RetentionPolicy())
+    finally:
+        release.set()
+        thread.join()
+    assert report['nb_configs'] == 19
+    assert report['cells'] == 19
+
+
+def test_queued_configurations_keep_their_versions(open_db):
+    db = open_db(commit_delay=3600)
+    now = current_time()
+    record_old_history(db, 'aaaa1111', now - 100 * DAY)
+    db.flush()
+
+    # a queued configuration that reverts to an old version keeps it
+    cells = [code_cell('c1', 'x = 3', [stream_output('3' * 100)]),
+                code_cell('c2', '# notes')]
+    db.record_action(action(now, cells), 'aaaa1111')
+    report = db.retention_report(RetentionPolicy())
+    assert report['cells'] == 18
+
+
+def test_versions_a_diff_reuses_are_kept(open_db):
+    db = open_db()
+    now = current_time()
+    record_old_history(db, 'aaaa1111', now - 100 * DAY)
+    db.flush()
+
+    # maintenance starts after a diff has matched an old version
+    lookup = db.get_cell_version_by_fingerprint
+    maintenance = []
+
+    def lookup_then_maintain(cell_id, fingerprint):
+        version_id = lookup(cell_id, fingerprint)
+        if version_id is not None and len(maintenance) == 0:
+            maintenance.append(threading.Thread(target=db.run_maintenance,
+                                                args=(RetentionPolicy(),)))
+            maintenance[0].start()
+            maintenance[0].join(0.5)
+        return version_id
+
+    db.get_cell_version_by_fingerprint = lookup_then_maintain
+    cells = [code_cell('c1', 'x = 3', [stream_output('3' * 100)]),
+                code_cell('c2', '# notes')]
+    db.record_action(action(now, cells), 'aaaa1111')
+    maintenance[0].join()
+
+    snapshot = db.get_snapshot([['aaaa1111', 0, now]])
+    assert [c['source'] for c in snapshot['cells']] == ['x = 3', '# notes']
+    assert snapshot['cells'][0]['outputs'] == [stream_output('3' * 100)]
@@ -0,0 +1,56 @@
+"""
+Searching the sources and outputs of every cell version
+"""
+
+from janus.janus_search import match_expression
+
+from conftest import code_cell, stream_output, action
+
+
+def test_search_words_are_quoted():
+    assert match_expression('  ') is None
+    assert match_expression('df.groupby plot*') == (
+        '{source outputs} : ("df.groupby" AND "plot"*)')
+    assert match_expression('say "hi"') == '{source outputs} : ("say" AND """hi""")'
+
+
+def test_committed_versions_are_found_by_word(open_db):
+    db = open_db()
+    db.indexer.join()
+    db.record_action(action(1000, [code_cell('c1', 'df = load_table()'),
+                                    code_cell('c2', 'df.plot()')]), 'aaaa1111')
+    db.record_action(action(2000, [code_cell('c1', 'df = load_table(cached=True)')]),
+                        'aaaa1111')
+    db.record_action(action(3000, [code_cell('c3', 'load_table()')]), 'bbbb2222')
+
+    # versions are searchable once committed
+    assert db.search('load_table') == []
+    db.flush()
+    results = db.search('load_table')
+    assert len(results) == 3
+    assert set(r['nb_name'] for r in results) == {'aaaa1111', 'bbbb2222'}
+    assert all('«load_table»' in r['snippet'] for r in results)
+
+    # every word has to match, and a trailing * matches word prefixes
+    assert [r['time'] for r in db.search('load_table cached')] == [2000]
+    assert [r['cell_id'] for r in db.search('plo*')] == ['c2']
+
+    # searches can be limited to a notebook's paths and a time range
+    paths = [['aaaa1111', 0, 5000]]
+    assert set(r['cell_id'] for r in db.search('load_table', paths)) == {'c1'}
+    assert [r['time'] for r in db.search('load_table', paths, since=1500)] == [2000]
+    assert [r['time'] for r in db.search('load_table', until=1500)] == [1000]
+    assert len(db.search('load_table', limit=1)) == 1
+
+
+def test_outputs_are_only_searched_if_enabled(open_db):
+    cells = [code_cell('c1', 'print(x)', [stream_output('needle')])]
+    db = open_db()
+    db.record_action(action(1000, cells), 'aaaa1111')
+    db.flush()
+    assert db.search('needle') == []
+
+    indexed = open_db('outputs.db', search_outputs=True)
+    indexed.record_action(action(1000, cells), 'aaaa1111')
+    indexed.flush()
+    assert [r['cell_id'] for r in indexed.search('needle')] == ['c1']
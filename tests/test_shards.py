@@ -0,0 +1,46 @@
+"""
+Storing the history of each notebook in a shard of its own
+"""
+
+from janus.janus_shards import ShardedDbManager
+
+from conftest import code_cell, action
+
+
+def test_reads_do_not_create_shards(tmp_path):
+    db = ShardedDbManager(str(tmp_path), commit_delay=0.05)
+    try:
+        db.record_action(action(1000, [code_cell('c1', 'x = 1')]), 'aaaa1111')
+        paths = [['aaaa1111', 0, 2000], ['bbbb2222', 0, 2000]]
+        assert len(db.get_nb_configs(paths)) == 1
+
+        # a client asking about notebooks with no history gets none
+        unknown = [['cccc3333', 0, 2000]]
+        assert db.get_nb_configs(unknown) == []
+        assert db.get_cell_history(unknown, 'c1') == []
+        assert db.get_version_summaries(unknown, ['c1'], 'cccc3333') == {}
+        assert db.get_nb_config_page(unknown)['nb_configs'] == []
+        assert db.find_snapshot(unknown) is None
+        assert db.shard_names() == ['aaaa1111']
+    finally:
+        db.close()
+        db.main.close()
+
+
+def test_unknown_versions_are_not_looked_for_in_every_shard(tmp_path):
+    db = ShardedDbManager(str(tmp_path), commit_delay=0.05, max_open_shards=1)
+    try:
+        db.record_action(action(1000, [code_cell('c1', 'x = 1')]), 'aaaa1111')
+        db.record_action(action(1000, [code_cell('c2', 'y = 1')]), 'bbbb2222')
+        db.flush()
+        assert list(db.shards) == ['bbbb2222']
+
+        paths = [['bbbb2222', 0, 2000]]
+        version_id = db.get_nb_configs([['aaaa1111', 0, 2000]])[0][3][0]
+        assert list(db.shards) == ['aaaa1111']
+        assert db.get_versions([version_id, 'unknown'], paths) == {}
+        assert db.get_version_diff(version_id, 'unknown', paths) is None
+        assert list(db.shards) == ['bbbb2222']
+    finally:
+        db.close()
+        db.main.close()